@@ -1,11 +1,99 @@
 from django.contrib import admin
-from .models import Customer, DemandTitle, Demand, PatientType, Action
+from .models import Customer, DemandTitle, Demand, PatientType, Action, CustomerDocument, SheetSnapshot, SheetSyncJob
+from .signals import notify_customer_changed, notify_customer_deleted
+from .utils.change_detection import mark_customer_edited
+from .utils.search import refresh_customer_search_index
 
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
     list_display = ('filetitle', 'name', 'did_number')  # Add fields you want to see
-# Keep other models registered as-is
-admin.site.register(DemandTitle)
-admin.site.register(Demand)
-admin.site.register(PatientType)
-admin.site.register(Action)
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        mark_customer_edited(obj.did_number)
+        notify_customer_changed(obj.did_number)
+
+    def delete_model(self, request, obj):
+        did_number = obj.did_number
+        super().delete_model(request, obj)
+        notify_customer_deleted(did_number)
+
+    def delete_queryset(self, request, queryset):
+        did_numbers = list(queryset.values_list('did_number', flat=True))
+        super().delete_queryset(request, queryset)
+        for did_number in did_numbers:
+            notify_customer_deleted(did_number)
+
+
+class CustomerTreeNodeAdmin(admin.ModelAdmin):
+    """
+    Admin of a tree node model: every save or delete refreshes the search
+    index of the customers owning the nodes and notifies them, like the API
+    and sheet syncs do.
+    """
+    # Lookup from the node to its customer's did_number
+    customer_lookup = None
+
+    def _customer_ids(self, queryset):
+        return set(queryset.values_list(self.customer_lookup, flat=True))
+
+    def _notify(self, did_numbers):
+        for did_number in did_numbers:
+            mark_customer_edited(did_number)
+            refresh_customer_search_index(did_number)
+            notify_customer_changed(did_number)
+
+    def save_model(self, request, obj, form, change):
+        # A node moved under another parent may change customers
+        nodes = self.model.objects.filter(pk=obj.pk)
+        did_numbers = self._customer_ids(nodes) if change else set()
+        super().save_model(request, obj, form, change)
+        self._notify(did_numbers | self._customer_ids(nodes))
+
+    def delete_model(self, request, obj):
+        did_numbers = self._customer_ids(self.model.objects.filter(pk=obj.pk))
+        super().delete_model(request, obj)
+        self._notify(did_numbers)
+
+    def delete_queryset(self, request, queryset):
+        did_numbers = self._customer_ids(queryset)
+        super().delete_queryset(request, queryset)
+        self._notify(did_numbers)
+
+
+@admin.register(DemandTitle)
+class DemandTitleAdmin(CustomerTreeNodeAdmin):
+    customer_lookup = 'customer_id'
+
+
+@admin.register(Demand)
+class DemandAdmin(CustomerTreeNodeAdmin):
+    customer_lookup = 'demand_title__customer_id'
+
+
+@admin.register(PatientType)
+class PatientTypeAdmin(CustomerTreeNodeAdmin):
+    customer_lookup = 'demand__demand_title__customer_id'
+
+
+@admin.register(Action)
+class ActionAdmin(CustomerTreeNodeAdmin):
+    customer_lookup = 'patient_type__demand__demand_title__customer_id'
+
+
+@admin.register(SheetSyncJob)
+class SheetSyncJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'customer', 'status', 'progress', 'created_at')
+    list_filter = ('status',)
+
+
+@admin.register(SheetSnapshot)
+class SheetSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('customer', 'spreadsheet_title', 'row_count', 'fetched_at')
+    exclude = ('data',)
+
+
+@admin.register(CustomerDocument)
+class CustomerDocumentAdmin(admin.ModelAdmin):
+    list_display = ('customer', 'version', 'size', 'built_at')
+    exclude = ('body',)
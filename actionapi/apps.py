@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ActionapiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "actionapi"
+
+    def ready(self):
+        # Connects the customer_tree_changed receivers
+        from .utils import documents, local_cache, response_cache  # noqa: F401
@@ -0,0 +1,110 @@
+# actionapi/management/commands/benchmark_customer_encodings.py
+import time
+
+import brotli
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.text import compress_string
+from rest_framework.renderers import JSONRenderer
+
+from actionapi.middleware import CompressionMiddleware
+from actionapi.models import Customer
+from actionapi.renderers import MessagePackRenderer
+from actionapi.serializers import (
+    customer_tree_representation,
+    indexed_customer_representation,
+)
+
+from .benchmark_customer_read import Rollback, build_benchmark_customer
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the size and encode time of the customer retrieve response "
+        "in each encoding (JSON, MessagePack) and layout (nested, indexed), "
+        "raw and compressed, on a synthetic or an existing customer tree."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--actions",
+            type=int,
+            default=10000,
+            help="Number of actions in the synthetic tree (default: 10000).",
+        )
+        parser.add_argument(
+            "--did",
+            help="Benchmark this existing customer instead of a synthetic tree.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Runs per encoding; the best time is reported (default: 5).",
+        )
+
+    def handle(self, *args, **options):
+        if options["actions"] < 1 or options["repeat"] < 1:
+            raise CommandError("--actions and --repeat must be at least 1.")
+        if options["did"]:
+            customer = Customer.objects.filter(pk=options["did"]).first()
+            if customer is None:
+                raise CommandError(f"Customer {options['did']} not found.")
+            self.run(customer, options["repeat"])
+            return
+        try:
+            with transaction.atomic():
+                self.run(build_benchmark_customer(options["actions"]), options["repeat"])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, customer, repeat):
+        representation = customer_tree_representation(customer)
+        renderers = [("json", JSONRenderer()), ("msgpack", MessagePackRenderer())]
+        quality = CompressionMiddleware.brotli_quality
+        compressors = [
+            ("gzip", compress_string),
+            ("br", lambda body: brotli.compress(body, quality=quality)),
+        ]
+
+        layouts = [
+            ("nested", lambda: representation),
+            ("indexed", lambda: indexed_customer_representation(representation)),
+        ]
+        header = f"{'encoding':>16} {'bytes':>10} {'encode ms':>10}"
+        for name, _ in compressors:
+            header += f" {name + ' bytes':>11} {name + ' ms':>8}"
+        self.stdout.write(header)
+
+        baseline = None
+        for renderer_name, renderer in renderers:
+            for layout_name, layout in layouts:
+                body, encode_time = self.best_of(
+                    repeat, lambda: renderer.render(layout())
+                )
+                baseline = baseline or len(body)
+                line = (
+                    f"{renderer_name + '/' + layout_name:>16} {len(body):>10} "
+                    f"{encode_time * 1000:>10.1f}"
+                )
+                for _, compress in compressors:
+                    compressed, compress_time = self.best_of(
+                        repeat, lambda: compress(body)
+                    )
+                    line += f" {len(compressed):>11} {compress_time * 1000:>8.1f}"
+                self.stdout.write(line)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Customer {customer.did_number}: {baseline} bytes as nested JSON."
+            )
+        )
+
+    def best_of(self, repeat, work):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            result = work()
+            timings.append(time.perf_counter() - started)
+        return result, min(timings)
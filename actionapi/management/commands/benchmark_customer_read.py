@@ -0,0 +1,125 @@
+# actionapi/management/commands/benchmark_customer_read.py
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from actionapi.models import Action, Customer, Demand, DemandTitle, PatientType
+from actionapi.serializers import (
+    CustomerSerializer,
+    customer_tree_prefetches,
+    customer_tree_representation,
+)
+
+BENCHMARK_DID = "benchmark"
+
+
+class Rollback(Exception):
+    pass
+
+
+def build_benchmark_customer(action_count):
+    """
+    Tree shaped like a real sheet: 10 actions per patient type, with the
+    patient type names and action texts recurring across the tree.
+    """
+    Customer.objects.filter(pk=BENCHMARK_DID).delete()
+    customer = Customer.objects.create(did_number=BENCHMARK_DID, name="Benchmark")
+    patient_type_count = max(1, action_count // 10)
+    demand_count = max(1, patient_type_count // 5)
+    title_count = max(1, demand_count // 10)
+
+    titles = DemandTitle.objects.bulk_create(
+        DemandTitle(customer=customer, title=f"Title {i}") for i in range(title_count)
+    )
+    demands = Demand.objects.bulk_create(
+        Demand(demand_title=titles[i % title_count], name=f"Demand {i}")
+        for i in range(demand_count)
+    )
+    patient_types = PatientType.objects.bulk_create(
+        PatientType(
+            demand=demands[i % demand_count], name=f"Patient type {i // demand_count}"
+        )
+        for i in range(patient_type_count)
+    )
+    Action.objects.bulk_create(
+        (
+            Action(
+                patient_type=patient_types[i % patient_type_count],
+                description=f"Action {i % 500}: tell the patient to call back",
+                dire_text=f"Dire {i % 50}",
+            )
+            for i in range(action_count)
+        ),
+        batch_size=1000,
+    )
+    return customer
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmark of the customer read path: CustomerSerializer vs "
+        "customer_tree_representation on a synthetic tree. Nothing is kept "
+        "in the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--actions",
+            type=int,
+            default=10000,
+            help="Number of actions in the synthetic tree (default: 10000).",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Runs per read path; the best time is reported (default: 5).",
+        )
+
+    def handle(self, *args, **options):
+        if options["actions"] < 1 or options["repeat"] < 1:
+            raise CommandError("--actions and --repeat must be at least 1.")
+        try:
+            with transaction.atomic():
+                self.run(options["actions"], options["repeat"])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, action_count, repeat):
+        customer = build_benchmark_customer(action_count)
+        renderer = JSONRenderer()
+
+        def serializer_path():
+            prefetched = Customer.objects.prefetch_related(
+                *customer_tree_prefetches()
+            ).get(pk=customer.pk)
+            return renderer.render(CustomerSerializer(prefetched).data)
+
+        def fast_path():
+            return renderer.render(customer_tree_representation(customer))
+
+        results = {}
+        for name, read in (("CustomerSerializer", serializer_path), ("fast read path", fast_path)):
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                body = read()
+                timings.append(time.perf_counter() - started)
+            results[name] = (min(timings), body)
+            self.stdout.write(
+                f"{name:>20}: {min(timings) * 1000:8.1f} ms best of {repeat} "
+                f"({len(body)} bytes)"
+            )
+
+        slow, fast = results["CustomerSerializer"], results["fast read path"]
+        if slow[1] != fast[1]:
+            raise CommandError("The two read paths rendered different bytes!")
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Identical output, fast read path {slow[0] / fast[0]:.1f}x faster "
+                f"on {action_count} actions."
+            )
+        )
@@ -0,0 +1,57 @@
+# actionapi/management/commands/rebuild_customer_documents.py
+import time
+
+from django.core.management.base import BaseCommand
+
+from actionapi.models import Customer
+from actionapi.utils.documents import refresh_customer_document
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-renders the materialized JSON document of every customer (or of "
+        "the given ones) from the relational tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--did",
+            action="append",
+            dest="did_numbers",
+            help="Only rebuild this customer's document (can be repeated).",
+        )
+
+    def handle(self, *args, **options):
+        customers = Customer.objects.order_by("did_number")
+        if options["did_numbers"]:
+            customers = customers.filter(did_number__in=options["did_numbers"])
+        did_numbers = list(customers.values_list("did_number", flat=True))
+        if not did_numbers:
+            self.stdout.write(self.style.WARNING("No customers found."))
+            return
+
+        self.stdout.write(f"Rebuilding {len(did_numbers)} customer documents...")
+        started = time.perf_counter()
+        total_bytes = 0
+        failed_count = 0
+        for did_number in did_numbers:
+            try:
+                document = refresh_customer_document(did_number)
+            except Exception as e:
+                failed_count += 1
+                self.stderr.write(
+                    self.style.ERROR(f"Failed to rebuild document of {did_number}: {e}")
+                )
+                continue
+            if document is not None:
+                total_bytes += document.size
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rebuilt {len(did_numbers) - failed_count} documents "
+                f"({total_bytes / 1024:.0f} KiB) in {elapsed:.1f}s."
+            )
+        )
+        if failed_count:
+            self.stdout.write(self.style.ERROR(f"Failed: {failed_count}"))
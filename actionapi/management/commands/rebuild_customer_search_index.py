@@ -0,0 +1,62 @@
+# actionapi/management/commands/rebuild_customer_search_index.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from actionapi.models import Customer
+from actionapi.utils.search import refresh_customer_search_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Brings the search index of every customer (or of the given ones) in "
+        "line with its active tree, e.g. to fill it for existing customers."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--did",
+            action="append",
+            dest="did_numbers",
+            help="Only refresh this customer's entries (can be repeated).",
+        )
+
+    def handle(self, *args, **options):
+        customers = Customer.objects.order_by("did_number")
+        if options["did_numbers"]:
+            customers = customers.filter(did_number__in=options["did_numbers"])
+        did_numbers = list(customers.values_list("did_number", flat=True))
+        if not did_numbers:
+            self.stdout.write(self.style.WARNING("No customers found."))
+            return
+
+        self.stdout.write(
+            f"Refreshing the search index of {len(did_numbers)} customers..."
+        )
+        started = time.perf_counter()
+        added = updated = removed = failed_count = 0
+        for did_number in did_numbers:
+            try:
+                with transaction.atomic():
+                    changes = refresh_customer_search_index(did_number)
+            except Exception as e:
+                failed_count += 1
+                self.stderr.write(
+                    self.style.ERROR(f"Failed to index customer {did_number}: {e}")
+                )
+                continue
+            added += changes["added"]
+            updated += changes["updated"]
+            removed += changes["removed"]
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {len(did_numbers) - failed_count} customers "
+                f"({added} entries added, {updated} re-pointed, {removed} removed) "
+                f"in {elapsed:.1f}s."
+            )
+        )
+        if failed_count:
+            self.stdout.write(self.style.ERROR(f"Failed: {failed_count}"))
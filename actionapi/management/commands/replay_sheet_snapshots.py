@@ -0,0 +1,115 @@
+# actionapi/management/commands/replay_sheet_snapshots.py
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from actionapi.models import SheetSnapshot
+from actionapi.utils.sheet_updater import (
+    SYNC_MODE_INCREMENTAL,
+    SYNC_MODE_REPLACE,
+    update_customer_from_sheet,
+)
+from actionapi.utils.snapshots import load_snapshot_as_fetched
+
+
+def replay_snapshot(snapshot, mode):
+    """Re-runs parsing and the DB write for one customer from its snapshot."""
+    try:
+        fetched = load_snapshot_as_fetched(snapshot)
+        return update_customer_from_sheet(
+            snapshot.customer, created=False, mode=mode, fetched=fetched, force=True
+        )
+    finally:
+        # Each worker thread has its own DB connection
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds customers' trees from their stored sheet snapshots, "
+        "without calling the Google API."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--did",
+            action="append",
+            dest="did_numbers",
+            help="Only replay this customer (can be repeated; default: all customers with a snapshot).",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=4,
+            help="Number of customers replayed at the same time (default: 4).",
+        )
+        parser.add_argument(
+            "--mode",
+            choices=[SYNC_MODE_REPLACE, SYNC_MODE_INCREMENTAL],
+            default=None,
+            help="How the trees are written (default: settings.SHEET_SYNC_MODE).",
+        )
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        if concurrency < 1:
+            raise CommandError("--concurrency must be at least 1.")
+
+        snapshots = SheetSnapshot.objects.select_related("customer")
+        if options["did_numbers"]:
+            snapshots = snapshots.filter(customer_id__in=options["did_numbers"])
+        snapshots = list(snapshots)
+        if not snapshots:
+            self.stdout.write(self.style.WARNING("No sheet snapshots found to replay."))
+            return
+
+        self.stdout.write(
+            f"Replaying {len(snapshots)} sheet snapshots "
+            f"(concurrency: {concurrency})..."
+        )
+        started = time.perf_counter()
+        updated_count = 0
+        failed_count = 0
+        rows_replayed = 0
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                executor.submit(replay_snapshot, snapshot, options["mode"]): snapshot
+                for snapshot in snapshots
+            }
+            for future in as_completed(futures):
+                snapshot = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {"status": "error", "error": str(e)}
+                if result.get("status") == "success":
+                    updated_count += 1
+                    rows_replayed += snapshot.row_count
+                    self.stdout.write(
+                        self.style.SUCCESS(
+                            f"Replayed customer {snapshot.customer_id} from the snapshot "
+                            f"fetched at {snapshot.fetched_at:%Y-%m-%d %H:%M}. "
+                            f"Message: {result.get('message', '')}"
+                        )
+                    )
+                else:
+                    failed_count += 1
+                    self.stderr.write(
+                        self.style.ERROR(
+                            f"Failed to replay customer {snapshot.customer_id}. "
+                            f"Error: {result.get('error', 'Unknown error')}"
+                        )
+                    )
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS("------------------------------------"))
+        self.stdout.write(self.style.SUCCESS("Snapshot replay finished."))
+        self.stdout.write(self.style.SUCCESS(f"Successfully replayed: {updated_count}"))
+        self.stdout.write(self.style.ERROR(f"Failed replays: {failed_count}"))
+        self.stdout.write(
+            f"Throughput: {len(snapshots) / elapsed:.2f} customers/sec, "
+            f"{rows_replayed / elapsed:.1f} rows/sec over {elapsed:.1f}s"
+        )
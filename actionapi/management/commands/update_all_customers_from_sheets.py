@@ -1,15 +1,42 @@
 # actionapi/management/commands/update_all_customers_from_sheets.py
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 from django.core.management.base import BaseCommand, CommandError
 from actionapi.models import Customer  # Make sure this path is correct
-from actionapi.utils.sheet_updater import update_customer_from_sheet  # Correct path
+from actionapi.utils.change_detection import (
+    mark_customer_synced,
+    select_customers_to_sync,
+)
+from actionapi.utils.rate_limiter import sheets_rate_limiter
+from actionapi.utils.sheet_updater import (  # Correct path
+    fetch_customer_sheet,
+    update_customer_from_sheet,
+)
 from django.conf import settings  # For any settings you might need
 
 
 class Command(BaseCommand):
     help = "Updates all customers from their linked Google Sheets daily."
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=1,
+            help="Number of sheets fetched from Google at the same time (default: 1).",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Update every customer, even if its sheet was not modified since the last sync.",
+        )
+
     def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        if concurrency < 1:
+            raise CommandError("--concurrency must be at least 1.")
+
         self.stdout.write(
             self.style.SUCCESS("Starting daily customer sheet update process...")
         )
@@ -17,58 +44,124 @@ class Command(BaseCommand):
         customers = Customer.objects.all()
         total_customers = customers.count()
         updated_count = 0
+        unchanged_count = 0
         failed_count = 0
+        quota_wait = 0.0
+        fetch_seconds = 0.0
+        apply_seconds = 0.0
+        rows_fetched = 0
 
         if not customers:
             self.stdout.write(self.style.WARNING("No customers found to update."))
             return
 
-        self.stdout.write(f"Found {total_customers} customers to process.")
+        self.stdout.write(
+            f"Found {total_customers} customers to process "
+            f"(fetch concurrency: {concurrency})."
+        )
+        started = time.perf_counter()
 
-        for customer in customers:
-            self.stdout.write(
-                f"Processing customer DID: {customer.did_number}, Name: {customer.name}..."
-            )
-            try:
-                # The 'created' flag is False because we are updating existing customers.
-                # The update_customer_from_sheet function handles the actual fetching
-                # and saving of new data from the sheet.
-                result = update_customer_from_sheet(customer, created=False)
+        # Pre-pass: skip customers whose sheet was not edited since their last sync
+        to_sync, skipped, modified_times = select_customers_to_sync(
+            customers, force=options["force"]
+        )
+        self.stdout.write(
+            f"{len(skipped)} sheets not modified since their last sync, "
+            f"{len(to_sync)} to update."
+        )
 
-                if result.get("status") == "success":
+        # Pipeline: up to `concurrency` sheets are fetched in worker threads,
+        # with at most 2 * concurrency fetched-but-unwritten sheets in flight.
+        # Parsing and DB writes happen one customer at a time in this thread.
+        pending_customers = iter(to_sync)
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+            def submit_next():
+                customer = next(pending_customers, None)
+                if customer is not None:
+                    future = executor.submit(fetch_customer_sheet, customer)
+                    in_flight[future] = customer
+
+            for _ in range(2 * concurrency):
+                submit_next()
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    customer = in_flight.pop(future)
+                    submit_next()
                     self.stdout.write(
-                        self.style.SUCCESS(
-                            f"Successfully updated customer {customer.did_number}. "
-                            f"Message: {result.get('message', '')}"
-                        )
+                        f"Processing customer DID: {customer.did_number}, Name: {customer.name}..."
                     )
-                    updated_count += 1
-                else:
-                    self.stderr.write(
-                        self.style.ERROR(
-                            f"Failed to update customer {customer.did_number}. "
-                            f"Error: {result.get('error', 'Unknown error from sheet_updater')}"
+                    try:
+                        fetched = future.result()
+                        fetch_seconds += fetched.get("fetch_seconds", 0.0)
+                        rows_fetched += len(fetched.get("all_values", []))
+                        apply_started = time.perf_counter()
+                        # The 'created' flag is False because we are updating existing customers.
+                        # The sheet was already fetched above; this parses it and saves the data.
+                        result = update_customer_from_sheet(
+                            customer, created=False, fetched=fetched
                         )
-                    )
-                    failed_count += 1
-            except Exception as e:
-                self.stderr.write(
-                    self.style.ERROR(
-                        f"Critical error updating customer {customer.did_number}: {e}"
-                    )
-                )
-                failed_count += 1
+                        apply_seconds += time.perf_counter() - apply_started
+                        quota_wait += result.get("quota_wait_seconds", 0.0)
+                        if result.get("status") in ("success", "unchanged"):
+                            mark_customer_synced(
+                                customer.did_number,
+                                modified_times[customer.did_number],
+                            )
 
-            # Optional: add a small delay to avoid hitting API rate limits too hard if you have many customers
-            # time.sleep(1) # e.g., 1 second delay
+                        if result.get("status") == "success":
+                            self.stdout.write(
+                                self.style.SUCCESS(
+                                    f"Successfully updated customer {customer.did_number}. "
+                                    f"Message: {result.get('message', '')}"
+                                )
+                            )
+                            updated_count += 1
+                        elif result.get("status") == "unchanged":
+                            self.stdout.write(
+                                f"Sheet unchanged for customer {customer.did_number}, skipped."
+                            )
+                            unchanged_count += 1
+                        else:
+                            self.stderr.write(
+                                self.style.ERROR(
+                                    f"Failed to update customer {customer.did_number}. "
+                                    f"Error: {result.get('error', 'Unknown error from sheet_updater')}"
+                                )
+                            )
+                            failed_count += 1
+                    except Exception as e:
+                        self.stderr.write(
+                            self.style.ERROR(
+                                f"Critical error updating customer {customer.did_number}: {e}"
+                            )
+                        )
+                        failed_count += 1
+
+        elapsed = time.perf_counter() - started
 
         self.stdout.write(self.style.SUCCESS("------------------------------------"))
         self.stdout.write(
             self.style.SUCCESS("Daily customer sheet update process finished.")
         )
         self.stdout.write(f"Total customers processed: {total_customers}")
+        self.stdout.write(f"Not modified since last sync: {len(skipped)}")
         self.stdout.write(self.style.SUCCESS(f"Successfully updated: {updated_count}"))
+        self.stdout.write(f"Unchanged (skipped): {unchanged_count}")
         self.stdout.write(self.style.ERROR(f"Failed updates: {failed_count}"))
+        self.stdout.write(
+            f"Throughput: {len(to_sync) / elapsed:.2f} synced customers/sec, "
+            f"{rows_fetched / elapsed:.1f} rows/sec over {elapsed:.1f}s"
+        )
+        self.stdout.write(
+            f"Stage time: fetch {fetch_seconds:.1f}s (summed over {concurrency} threads), "
+            f"parse + write {apply_seconds:.1f}s"
+        )
+        self.stdout.write(f"Time spent waiting for Sheets quota: {quota_wait:.1f}s")
+        self.stdout.write(f"Sheets rate limiter: {sheets_rate_limiter.stats()}")
 
         if failed_count > 0:
             self.stdout.write(
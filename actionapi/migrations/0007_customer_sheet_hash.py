@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 08:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0006_alter_customer_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='sheet_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='action',
+            name='description',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+def merge_duplicate_nodes(apps, schema_editor):
+    """
+    Trees created through the API may contain sibling nodes with the same
+    natural key. Keep the oldest one, move the duplicates' children under it
+    and delete the duplicates, top-down, so the unique constraints can apply.
+    """
+    levels = [
+        ("DemandTitle", "customer_id", "title", "Demand", "demand_title_id"),
+        ("Demand", "demand_title_id", "name", "PatientType", "demand_id"),
+        ("PatientType", "demand_id", "name", "Action", "patient_type_id"),
+    ]
+    for model_name, parent_field, key_field, child_name, child_fk in levels:
+        model = apps.get_model("actionapi", model_name)
+        child_model = apps.get_model("actionapi", child_name)
+        keepers = {}
+        duplicates = {}
+        for pk, parent_id, key in model.objects.order_by("id").values_list(
+            "id", parent_field, key_field
+        ):
+            keeper = keepers.setdefault((parent_id, key), pk)
+            if keeper != pk:
+                duplicates[pk] = keeper
+        for duplicate, keeper in duplicates.items():
+            child_model.objects.filter(**{child_fk: duplicate}).update(
+                **{child_fk: keeper}
+            )
+        model.objects.filter(id__in=list(duplicates)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0007_customer_sheet_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_nodes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='demand',
+            constraint=models.UniqueConstraint(fields=('demand_title', 'name'), name='unique_demand_per_title'),
+        ),
+        migrations.AddConstraint(
+            model_name='demandtitle',
+            constraint=models.UniqueConstraint(fields=('customer', 'title'), name='unique_demand_title_per_customer'),
+        ),
+        migrations.AddConstraint(
+            model_name='patienttype',
+            constraint=models.UniqueConstraint(fields=('demand', 'name'), name='unique_patient_type_per_demand'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0008_tree_natural_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='last_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='sheet_modified_time',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-18 09:04
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0009_customer_sheet_modified_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SheetSyncJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], default='queued', max_length=20)),
+                ('progress', models.CharField(blank=True, max_length=50)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_jobs', to='actionapi.customer')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status', 'queued')), fields=('customer',), name='one_queued_sync_job_per_customer')],
+            },
+        ),
+    ]
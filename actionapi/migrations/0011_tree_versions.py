@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-18 09:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0010_sheetsyncjob'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='demandtitle',
+            name='unique_demand_title_per_customer',
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='active_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='demandtitle',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddConstraint(
+            model_name='demandtitle',
+            constraint=models.UniqueConstraint(fields=('customer', 'version', 'title'), name='unique_demand_title_per_customer_version'),
+        ),
+    ]
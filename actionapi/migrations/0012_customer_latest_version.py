@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-18 09:10
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def set_latest_version(apps, schema_editor):
+    """Start each customer's version counter above every version in use."""
+    Customer = apps.get_model("actionapi", "Customer")
+    DemandTitle = apps.get_model("actionapi", "DemandTitle")
+    highest = dict(
+        DemandTitle.objects.values("customer_id")
+        .annotate(highest=Max("version"))
+        .values_list("customer_id", "highest")
+    )
+    for did_number, active_version in Customer.objects.values_list(
+        "did_number", "active_version"
+    ):
+        Customer.objects.filter(pk=did_number).update(
+            latest_version=max(active_version, highest.get(did_number, 0))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0011_tree_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='latest_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(set_latest_version, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-18 09:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0012_customer_latest_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SheetSnapshot',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sheet_snapshot', serialize=False, to='actionapi.customer')),
+                ('spreadsheet_title', models.CharField(blank=True, max_length=255)),
+                ('data', models.BinaryField()),
+                ('row_count', models.PositiveIntegerField(default=0)),
+                ('fetched_at', models.DateTimeField()),
+            ],
+        ),
+    ]
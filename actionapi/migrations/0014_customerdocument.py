@@ -0,0 +1,29 @@
+# Generated by Django 5.2 on 2026-10-18 09:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0013_sheetsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerDocument',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='document', serialize=False, to='actionapi.customer')),
+                ('body', models.BinaryField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('built_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='content_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
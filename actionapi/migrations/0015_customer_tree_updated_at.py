@@ -0,0 +1,19 @@
+# Generated by Django 5.2 on 2026-10-18 09:24
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0014_customerdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='tree_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2 on 2026-10-18 09:29
+
+from django.db import migrations, models
+from django.db.models import Count, F
+
+
+def count_tree_nodes(apps, schema_editor):
+    """Fill in the node counts of each customer's active tree."""
+    Customer = apps.get_model("actionapi", "Customer")
+    DemandTitle = apps.get_model("actionapi", "DemandTitle")
+    for did_number in Customer.objects.values_list("did_number", flat=True):
+        counts = DemandTitle.objects.filter(
+            customer_id=did_number, version=F("customer__active_version")
+        ).aggregate(
+            demand_title_count=Count("id", distinct=True),
+            demand_count=Count("demands", distinct=True),
+            patient_type_count=Count("demands__patient_types", distinct=True),
+            action_count=Count("demands__patient_types__actions"),
+        )
+        Customer.objects.filter(pk=did_number).update(**counts)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0015_customer_tree_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='action_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='demand_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='demand_title_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='patient_type_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_tree_nodes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,97 @@
+# Generated by Django 5.2 on 2026-10-18 09:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# SQLite: an external-content FTS5 table kept in step by triggers. SQLite
+# migrations that rebuild actionapi_customersearchentry drop the triggers with
+# the old table and must create them again.
+SQLITE_CREATE = [
+    """
+    CREATE VIRTUAL TABLE actionapi_customersearchentry_fts USING fts5(
+        text,
+        content='actionapi_customersearchentry',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER actionapi_customersearchentry_fts_insert
+    AFTER INSERT ON actionapi_customersearchentry BEGIN
+        INSERT INTO actionapi_customersearchentry_fts(rowid, text)
+        VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER actionapi_customersearchentry_fts_delete
+    AFTER DELETE ON actionapi_customersearchentry BEGIN
+        INSERT INTO actionapi_customersearchentry_fts(
+            actionapi_customersearchentry_fts, rowid, text
+        ) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER actionapi_customersearchentry_fts_update
+    AFTER UPDATE ON actionapi_customersearchentry BEGIN
+        INSERT INTO actionapi_customersearchentry_fts(
+            actionapi_customersearchentry_fts, rowid, text
+        ) VALUES ('delete', old.id, old.text);
+        INSERT INTO actionapi_customersearchentry_fts(rowid, text)
+        VALUES (new.id, new.text);
+    END
+    """,
+]
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS actionapi_customersearchentry_fts_insert",
+    "DROP TRIGGER IF EXISTS actionapi_customersearchentry_fts_delete",
+    "DROP TRIGGER IF EXISTS actionapi_customersearchentry_fts_update",
+    "DROP TABLE IF EXISTS actionapi_customersearchentry_fts",
+]
+
+# PostgreSQL: a GIN index on exactly the tsvector expression search queries use
+POSTGRESQL_CREATE = [
+    """
+    CREATE INDEX actionapi_customersearchentry_text_fts
+    ON actionapi_customersearchentry
+    USING gin (to_tsvector('simple', text))
+    """,
+]
+POSTGRESQL_DROP = ["DROP INDEX IF EXISTS actionapi_customersearchentry_text_fts"]
+
+
+def _run(schema_editor, statements_by_vendor):
+    for statement in statements_by_vendor.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def create_full_text_index(apps, schema_editor):
+    _run(schema_editor, {"sqlite": SQLITE_CREATE, "postgresql": POSTGRESQL_CREATE})
+
+
+def drop_full_text_index(apps, schema_editor):
+    _run(schema_editor, {"sqlite": SQLITE_DROP, "postgresql": POSTGRESQL_DROP})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0016_customer_node_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerSearchEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('demand', 'Demand'), ('patient_type', 'Patient type'), ('action', 'Action')], max_length=20)),
+                ('node_id', models.BigIntegerField()),
+                ('text', models.TextField()),
+                ('path', models.JSONField(default=list)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_entries', to='actionapi.customer')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('customer', 'kind', 'node_id'), name='unique_search_entry_per_node')],
+            },
+        ),
+        migrations.RunPython(create_full_text_index, drop_full_text_index),
+    ]
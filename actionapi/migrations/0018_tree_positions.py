@@ -0,0 +1,33 @@
+# Generated by Django 5.2 on 2026-10-18 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actionapi', '0017_customersearchentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='action',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='demand',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='demandtitle',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='patienttype',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
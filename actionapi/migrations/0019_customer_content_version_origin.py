@@ -0,0 +1,26 @@
+# Generated by Django 5.2 on 2026-10-18 09:57
+
+import actionapi.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("actionapi", "0018_tree_positions"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="customer",
+            name="content_version",
+            field=models.PositiveBigIntegerField(
+                default=actionapi.models.initial_content_version
+            ),
+        ),
+        migrations.AlterField(
+            model_name="customerdocument",
+            name="version",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# SQLite: the FTS5 update trigger of migration 0017 fired on any column, so
+# re-pointing an entry's node_id rewrote its full-text row; only text matters.
+SQLITE_FORWARD = [
+    "DROP TRIGGER IF EXISTS actionapi_customersearchentry_fts_update",
+    """
+    CREATE TRIGGER actionapi_customersearchentry_fts_update
+    AFTER UPDATE OF text ON actionapi_customersearchentry BEGIN
+        INSERT INTO actionapi_customersearchentry_fts(
+            actionapi_customersearchentry_fts, rowid, text
+        ) VALUES ('delete', old.id, old.text);
+        INSERT INTO actionapi_customersearchentry_fts(rowid, text)
+        VALUES (new.id, new.text);
+    END
+    """,
+]
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS actionapi_customersearchentry_fts_update",
+    """
+    CREATE TRIGGER actionapi_customersearchentry_fts_update
+    AFTER UPDATE ON actionapi_customersearchentry BEGIN
+        INSERT INTO actionapi_customersearchentry_fts(
+            actionapi_customersearchentry_fts, rowid, text
+        ) VALUES ('delete', old.id, old.text);
+        INSERT INTO actionapi_customersearchentry_fts(rowid, text)
+        VALUES (new.id, new.text);
+    END
+    """,
+]
+
+
+def _run(schema_editor, statements):
+    if schema_editor.connection.vendor == "sqlite":
+        for statement in statements:
+            schema_editor.execute(statement)
+
+
+def forward(apps, schema_editor):
+    _run(schema_editor, SQLITE_FORWARD)
+
+
+def backward(apps, schema_editor):
+    _run(schema_editor, SQLITE_BACKWARD)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("actionapi", "0019_customer_content_version_origin"),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, backward),
+    ]
@@ -1,4 +1,19 @@
+import time
+import uuid
+
 from django.db import models
+from django.utils import timezone
+
+
+def initial_content_version():
+    """
+    First content_version of a new customer: the creation time in
+    microseconds. A customer deleted and re-created under the same DID thus
+    starts above every version its previous incarnation reached (one bump
+    per write, each taking well over a microsecond), so cached bodies and
+    ETags of the old one can never match the new one.
+    """
+    return time.time_ns() // 1000
 
 
 # Main customer model with their DID number and name
@@ -12,6 +27,24 @@ class Customer(models.Model):
     sheet_url = models.URLField(blank=True, null=True)  # New
     worksheet_name = models.CharField(max_length=255, blank=True, null=True)  # New
     filetitle = models.CharField(max_length=255, blank=True)  #
+    # SHA-256 of the sheet values from the last successful sync
+    sheet_hash = models.CharField(max_length=64, blank=True, default="")
+    # Drive modifiedTime of the sheet as seen before the last successful sync
+    sheet_modified_time = models.DateTimeField(blank=True, null=True)
+    last_synced_at = models.DateTimeField(blank=True, null=True)
+    # Version of the demand titles tree that is served (see DemandTitle.version)
+    active_version = models.PositiveIntegerField(default=1)
+    # Highest tree version handed out to a sync so far
+    latest_version = models.PositiveIntegerField(default=1)
+    # Bumped whenever the data served for this customer changes
+    content_version = models.PositiveBigIntegerField(default=initial_content_version)
+    # When content_version was last bumped (Last-Modified of the customer endpoints)
+    tree_updated_at = models.DateTimeField(default=timezone.now)
+    # Nodes in the active tree, recounted by notify_customer_changed
+    demand_title_count = models.PositiveIntegerField(default=0)
+    demand_count = models.PositiveIntegerField(default=0)
+    patient_type_count = models.PositiveIntegerField(default=0)
+    action_count = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"{self.name} ({self.did_number})"
@@ -23,6 +56,19 @@ class DemandTitle(models.Model):
         Customer, related_name="demand_titles", on_delete=models.CASCADE
     )
     title = models.CharField(max_length=255)
+    # A full rebuild writes the tree under a new version, then flips
+    # Customer.active_version; superseded versions are deleted in the background
+    version = models.PositiveIntegerField(default=1)
+    # Order within the customer's tree, as in the sheet (ties broken by id)
+    position = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["customer", "version", "title"],
+                name="unique_demand_title_per_customer_version",
+            )
+        ]
 
 
 class Demand(models.Model):
@@ -30,6 +76,15 @@ class Demand(models.Model):
         DemandTitle, related_name="demands", on_delete=models.CASCADE
     )
     name = models.TextField()
+    # Order within the demand title, as in the sheet (ties broken by id)
+    position = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["demand_title", "name"], name="unique_demand_per_title"
+            )
+        ]
 
 
 class PatientType(models.Model):
@@ -37,6 +92,15 @@ class PatientType(models.Model):
         Demand, related_name="patient_types", on_delete=models.CASCADE
     )
     name = models.TextField()
+    # Order within the demand, as in the sheet (ties broken by id)
+    position = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["demand", "name"], name="unique_patient_type_per_demand"
+            )
+        ]
 
 
 class Action(models.Model):
@@ -45,3 +109,124 @@ class Action(models.Model):
     )
     description = models.TextField(blank=True, null=True)
     dire_text = models.TextField(blank=True, null=True)
+    # Order within the patient type, as in the sheet (ties broken by id)
+    position = models.PositiveIntegerField(default=0)
+
+
+# Background sheet sync requested through the API (async mode)
+class SheetSyncJob(models.Model):
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_FINISHED = "finished"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_FINISHED, "Finished"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    customer = models.ForeignKey(
+        Customer, related_name="sync_jobs", on_delete=models.CASCADE
+    )
+    # Whether the customer was created by the request that queued the job
+    created = models.BooleanField(default=False)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED
+    )
+    # Current stage of update_customer_from_sheet ("fetching", "parsing", ...)
+    progress = models.CharField(max_length=50, blank=True)
+    # The dict returned by update_customer_from_sheet
+    result = models.JSONField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["customer"],
+                condition=models.Q(status="queued"),
+                name="one_queued_sync_job_per_customer",
+            )
+        ]
+
+    def __str__(self):
+        return f"Sync job {self.id} for {self.customer_id} ({self.status})"
+
+
+# Raw 'detail' values of the customer's sheet as last fetched from Google,
+# so parsing and the DB rebuild can be replayed without any API call
+class SheetSnapshot(models.Model):
+    customer = models.OneToOneField(
+        Customer,
+        primary_key=True,
+        related_name="sheet_snapshot",
+        on_delete=models.CASCADE,
+    )
+    spreadsheet_title = models.CharField(max_length=255, blank=True)
+    # zlib-compressed JSON lines, one sheet row per line
+    data = models.BinaryField()
+    row_count = models.PositiveIntegerField(default=0)
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Snapshot of {self.customer_id} ({self.fetched_at})"
+
+
+# The customer's API representation, rendered once per change (see
+# Customer.content_version) so reads are a single primary key lookup.
+# The relational tables remain the source of truth.
+class CustomerDocument(models.Model):
+    customer = models.OneToOneField(
+        Customer,
+        primary_key=True,
+        related_name="document",
+        on_delete=models.CASCADE,
+    )
+    # Rendered JSON, byte-for-byte what CustomerSerializer + JSONRenderer produce
+    body = models.BinaryField()
+    size = models.PositiveIntegerField(default=0)
+    # Customer.content_version the body was rendered from
+    version = models.PositiveBigIntegerField(default=0)
+    built_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Document of {self.customer_id} (v{self.version}, {self.size} bytes)"
+
+
+# One searchable node of a customer's active tree (demand, patient type or
+# action), kept in step by refresh_customer_search_index. The full-text index
+# on `text` is backend specific (see migration 0017): FTS5 on SQLite, a GIN
+# tsvector index on PostgreSQL.
+class CustomerSearchEntry(models.Model):
+    KIND_DEMAND = "demand"
+    KIND_PATIENT_TYPE = "patient_type"
+    KIND_ACTION = "action"
+    KIND_CHOICES = [
+        (KIND_DEMAND, "Demand"),
+        (KIND_PATIENT_TYPE, "Patient type"),
+        (KIND_ACTION, "Action"),
+    ]
+
+    customer = models.ForeignKey(
+        Customer, related_name="search_entries", on_delete=models.CASCADE
+    )
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    # ID of the Demand, PatientType or Action
+    node_id = models.BigIntegerField()
+    # Name, or an action's description and dire text
+    text = models.TextField()
+    # Names of the ancestors, from the demand title down
+    path = models.JSONField(default=list)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["customer", "kind", "node_id"],
+                name="unique_search_entry_per_node",
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.node_id} of {self.customer_id}"
@@ -0,0 +1,14 @@
+# actionapi/pagination.py
+from rest_framework.pagination import CursorPagination
+
+
+class CustomerCursorPagination(CursorPagination):
+    """
+    Pages of customers by DID: stable while customers are added or removed,
+    and no COUNT(*) over the whole table per page.
+    """
+
+    ordering = "did_number"
+    page_size = 100
+    page_size_query_param = "page_size"
+    max_page_size = 1000
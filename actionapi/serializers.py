@@ -1,5 +1,9 @@
+from django.db.models import F, Prefetch
 from rest_framework import serializers
-from .models import Customer, DemandTitle, Demand, PatientType, Action
+from .models import Customer, DemandTitle, Demand, PatientType, Action, SheetSyncJob
+from .signals import notify_customer_changed
+from .utils.change_detection import mark_customer_edited
+from .utils.search import refresh_customer_search_index
 
 
 class ActionSerializer(serializers.ModelSerializer):
@@ -35,31 +39,269 @@ class DemandTitleSerializer(serializers.ModelSerializer):
         fields = ["title", "demands"]
 
 
+# Precomputed sizes of the active tree (see notify_customer_changed)
+CUSTOMER_NODE_COUNT_FIELDS = [
+    "demand_title_count",
+    "demand_count",
+    "patient_type_count",
+    "action_count",
+]
+
+
 class CustomerSerializer(serializers.ModelSerializer):
     # Make 'demand_titles' writable and optional
     demand_titles = DemandTitleSerializer(many=True, read_only=False, required=False)
 
     class Meta:
         model = Customer
-        fields = "__all__"  # did_number, name, sheet_url, worksheet_name, filetitle, demand_titles
+        # did_number, name, sheet_url, worksheet_name, filetitle, demand_titles
+        # (the sheet sync bookkeeping columns are not part of the API)
+        exclude = [
+            "sheet_hash",
+            "sheet_modified_time",
+            "last_synced_at",
+            "active_version",
+            "latest_version",
+            "content_version",
+            "tree_updated_at",
+            *CUSTOMER_NODE_COUNT_FIELDS,
+        ]
+
+    def validate(self, attrs):
+        # Sibling names are unique in the tree (as after merging sheet rows)
+        errors = _duplicate_names(
+            attrs.get("demand_titles", []),
+            [("title", "demands"), ("name", "patient_types"), ("name", "actions")],
+            "demand_titles",
+        )
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
 
     def create(self, validated_data):
         # Using .pop("key", []) is robust as it provides a default if the key is not present
         # (which can happen if required=False and the client doesn't send it)
         demand_titles_data = validated_data.pop("demand_titles", [])
         customer = Customer.objects.create(**validated_data)
-        for dt_data in demand_titles_data:
+        for dt_position, dt_data in enumerate(demand_titles_data):
             demands_data = dt_data.pop("demands", [])
-            demand_title = DemandTitle.objects.create(customer=customer, **dt_data)
-            for d_data in demands_data:
+            demand_title = DemandTitle.objects.create(
+                customer=customer, position=dt_position, **dt_data
+            )
+            for d_position, d_data in enumerate(demands_data):
                 patient_types_data = d_data.pop("patient_types", [])
-                demand = Demand.objects.create(demand_title=demand_title, **d_data)
-                for pt_data in patient_types_data:
+                demand = Demand.objects.create(
+                    demand_title=demand_title, position=d_position, **d_data
+                )
+                for pt_position, pt_data in enumerate(patient_types_data):
                     actions_data = pt_data.pop("actions", [])
                     patient_type_obj = PatientType.objects.create(
-                        demand=demand, **pt_data
+                        demand=demand, position=pt_position, **pt_data
                     )
-                    for a_data in actions_data:
+                    for a_position, a_data in enumerate(actions_data):
                         # 'a_data' now directly contains 'description' and 'dire_text'
-                        Action.objects.create(patient_type=patient_type_obj, **a_data)
+                        Action.objects.create(
+                            patient_type=patient_type_obj, position=a_position, **a_data
+                        )
+        mark_customer_edited(customer.did_number)
+        refresh_customer_search_index(customer.did_number)
+        notify_customer_changed(customer.did_number)
         return customer
+
+
+def _duplicate_names(nodes, levels, path):
+    """
+    Error messages for nodes sharing a name with a sibling, keyed by their
+    path in the payload ("demand_titles[0].demands[1].name"). `levels` gives
+    the name field and children field of each level, top-down.
+    """
+    if not levels:
+        return {}
+    (name_field, children_field), *child_levels = levels
+    errors = {}
+    seen = set()
+    for i, node in enumerate(nodes):
+        name = node[name_field]
+        if name in seen:
+            errors[f"{path}[{i}].{name_field}"] = [
+                f"Duplicate {name_field} {name!r} among its siblings."
+            ]
+        seen.add(name)
+        errors.update(
+            _duplicate_names(
+                node.get(children_field, []),
+                child_levels,
+                f"{path}[{i}].{children_field}",
+            )
+        )
+    return errors
+
+
+class CustomerListSerializer(CustomerSerializer):
+    """
+    CustomerSerializer plus the node counts, restricted to `fields` ("__all__"
+    keeps them all): by default a summary without the demand titles tree,
+    so that listing customers does not cost every tree in the system.
+    """
+
+    summary_fields = ["did_number", "name", "filetitle", *CUSTOMER_NODE_COUNT_FIELDS]
+
+    class Meta(CustomerSerializer.Meta):
+        exclude = [
+            name
+            for name in CustomerSerializer.Meta.exclude
+            if name not in CUSTOMER_NODE_COUNT_FIELDS
+        ]
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields == "__all__":
+            return
+        kept = set(fields or self.summary_fields)
+        for name in list(self.fields):
+            if name not in kept:
+                self.fields.pop(name)
+
+
+class SheetSyncJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.UUIDField(source="id", read_only=True)
+    did_number = serializers.CharField(source="customer_id", read_only=True)
+
+    class Meta:
+        model = SheetSyncJob
+        fields = [
+            "job_id",
+            "did_number",
+            "status",
+            "progress",
+            "result",
+            "created_at",
+            "updated_at",
+        ]
+
+
+def customer_tree_prefetches():
+    """
+    Prefetch plan loading customers' whole trees for CustomerSerializer with
+    one query per level. Only the active version of each tree is loaded; a
+    rebuild in progress (or not yet garbage-collected) lives under another.
+    """
+    return [
+        Prefetch(
+            "demand_titles",
+            queryset=DemandTitle.objects.filter(
+                version=F("customer__active_version")
+            ).order_by("position", "id"),
+        ),
+        Prefetch(
+            "demand_titles__demands",
+            queryset=Demand.objects.order_by("position", "id"),
+        ),
+        Prefetch(
+            "demand_titles__demands__patient_types",
+            queryset=PatientType.objects.order_by("position", "id"),
+        ),
+        Prefetch(
+            "demand_titles__demands__patient_types__actions",
+            queryset=Action.objects.order_by("position", "id"),
+        ),
+    ]
+
+
+def customer_tree_representation(customer, context=None):
+    """
+    Same data as CustomerSerializer(customer).data, but the demand titles
+    tree is built straight from values_list() rows (one query per level,
+    assembled in one pass with dict lookups) instead of instantiating a
+    model and a nested serializer for every node. The customer's own
+    fields still go through CustomerSerializer's fields.
+    """
+    representation = {}
+    for field in CustomerSerializer(customer, context=context).fields.values():
+        if field.write_only:
+            continue
+        if field.field_name == "demand_titles":
+            representation["demand_titles"] = _demand_titles_representation(customer)
+            continue
+        attribute = field.get_attribute(customer)
+        representation[field.field_name] = (
+            None if attribute is None else field.to_representation(attribute)
+        )
+    return representation
+
+
+def _demand_titles_representation(customer):
+    active_titles = DemandTitle.objects.filter(
+        customer=customer, version=customer.active_version
+    )
+    demand_titles = []
+    demands_by_title = {}
+    for title_id, title in active_titles.order_by("position", "id").values_list(
+        "id", "title"
+    ):
+        demands_by_title[title_id] = []
+        demand_titles.append({"title": title, "demands": demands_by_title[title_id]})
+
+    patient_types_by_demand = {}
+    for demand_id, title_id, name in (
+        Demand.objects.filter(demand_title__in=active_titles)
+        .order_by("position", "id")
+        .values_list("id", "demand_title_id", "name")
+    ):
+        patient_types_by_demand[demand_id] = []
+        demands_by_title[title_id].append(
+            {"name": name, "patient_types": patient_types_by_demand[demand_id]}
+        )
+
+    actions_by_patient_type = {}
+    for patient_type_id, demand_id, name in (
+        PatientType.objects.filter(demand__demand_title__in=active_titles)
+        .order_by("position", "id")
+        .values_list("id", "demand_id", "name")
+    ):
+        actions_by_patient_type[patient_type_id] = []
+        patient_types_by_demand[demand_id].append(
+            {"name": name, "actions": actions_by_patient_type[patient_type_id]}
+        )
+
+    for patient_type_id, description, dire_text in (
+        Action.objects.filter(patient_type__demand__demand_title__in=active_titles)
+        .order_by("position", "id")
+        .values_list("patient_type_id", "description", "dire_text")
+    ):
+        actions_by_patient_type[patient_type_id].append(
+            {"description": description, "dire_text": dire_text}
+        )
+    return demand_titles
+
+
+def indexed_customer_representation(representation):
+    """
+    Compact "indexed" layout of a customer representation: every tree node
+    becomes a list of values, with the field names of each level sent once
+    in "schema" and every string sent once in "strings" (nodes hold its
+    index). Repeated keys and texts (patient types, actions, dire texts)
+    make up most of a large tree in the nested layout.
+    """
+    schema = {}
+    strings = {}
+
+    def rows(level, nodes):
+        indexed = []
+        for node in nodes:
+            schema.setdefault(level, list(node))
+            row = []
+            for name, value in node.items():
+                if isinstance(value, list):
+                    value = rows(name, value)
+                elif isinstance(value, str):
+                    value = strings.setdefault(value, len(strings))
+                row.append(value)
+            indexed.append(row)
+        return indexed
+
+    indexed = dict(representation)
+    indexed["demand_titles"] = rows("demand_titles", representation["demand_titles"])
+    indexed["schema"] = schema
+    indexed["strings"] = list(strings)
+    return indexed
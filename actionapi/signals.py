@@ -0,0 +1,54 @@
+# actionapi/signals.py
+from django.db import transaction
+from django.db.models import Count, F
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .models import Customer, DemandTitle
+
+# Sent (once the transaction commits) with `did_number` after the data served
+# for a customer changed: its tree, or its own fields.
+customer_tree_changed = Signal()
+
+# Sent (once the transaction commits) with `did_number` after a customer was
+# deleted, so caches drop what they hold for it.
+customer_deleted = Signal()
+
+
+def tree_node_counts(did_number):
+    """Number of nodes at each level of the customer's active tree."""
+    return DemandTitle.objects.filter(
+        customer_id=did_number, version=F("customer__active_version")
+    ).aggregate(
+        demand_title_count=Count("id", distinct=True),
+        demand_count=Count("demands", distinct=True),
+        patient_type_count=Count("demands__patient_types", distinct=True),
+        action_count=Count("demands__patient_types__actions"),
+    )
+
+
+def notify_customer_changed(did_number):
+    """
+    Bumps the customer's content_version (and tree_updated_at), recounts its
+    tree nodes and sends customer_tree_changed after the current transaction
+    commits. Every code path that changes what the customer endpoints return
+    must call this.
+    """
+    Customer.objects.filter(pk=did_number).update(
+        content_version=F("content_version") + 1,
+        tree_updated_at=timezone.now(),
+        **tree_node_counts(did_number),
+    )
+    transaction.on_commit(
+        lambda: customer_tree_changed.send(sender=Customer, did_number=did_number)
+    )
+
+
+def notify_customer_deleted(did_number):
+    """
+    Sends customer_deleted after the current transaction commits. Every code
+    path that deletes customers must call this.
+    """
+    transaction.on_commit(
+        lambda: customer_deleted.send(sender=Customer, did_number=did_number)
+    )
@@ -1,65 +1,340 @@
 # actionapi/tasks.py
 import logging
 
-from celery import shared_task
+from celery import chain, chord, group, shared_task
+from celery.exceptions import Retry
+from celery.utils.time import get_exponential_backoff_interval
+from django.conf import settings
 
-from .models import Customer
-from .utils.sheet_updater import update_customer_from_sheet
+from .models import Customer, SheetSyncJob
+from .utils.change_detection import (
+    mark_customer_synced,
+    parse_modified_time,
+    select_customers_to_sync,
+)
+from .utils.rate_limiter import sheets_rate_limiter
+from .utils.sheet_updater import (
+    delete_superseded_tree_versions,
+    is_transient_error,
+    update_customer_from_sheet,
+)
+from .utils.sync_debounce import (
+    keep_customer_scheduled,
+    quiet_time_remaining,
+    release_customer,
+)
 
 # Get a logger instance
 logger = logging.getLogger(__name__)
 
 
-@shared_task(name="actionapi.tasks.update_all_customers_task")
-def update_all_customers_task():
+@shared_task(bind=True, name="actionapi.tasks.sync_customer_task")
+def sync_customer_task(
+    self, lane_results, did_number, modified_time=None, force=False
+):
     """
-    Celery task to update all customers from their linked Google Sheets.
+    Celery task to update one customer from its Google Sheet.
+    Runs as a link of a lane chain: it receives the outcomes of the customers
+    synced before it in the lane and returns them with its own appended.
+    Transient failures (quota, 5xx, connection errors and timeouts) are
+    retried with exponential backoff; any other failure is final. Nothing
+    but a scheduled retry raises out of the task, so one customer's failure
+    can neither stop the rest of its lane nor the chord's summary.
+    `modified_time` is the sheet's Drive modifiedTime (ISO string) seen by the
+    change-detection pre-pass; it is recorded on the customer after a success.
+    `force` rewrites the tree even if the sheet is unchanged.
     """
-    logger.info("Celery Task: Starting daily customer sheet update process...")
+    try:
+        result = _sync_customer(did_number, modified_time, force)
+    except Exception as e:
+        logger.error(
+            f"Celery Task: Critical error updating customer {did_number}: {e}",
+            exc_info=True,  # This will include the full traceback in the log
+        )
+        result = {
+            "status": "error",
+            "error": str(e),
+            "retryable": is_transient_error(e),
+        }
 
-    customers = Customer.objects.all()
-    total_customers = customers.count()
-    updated_count = 0
-    failed_count = 0
+    if (
+        result.get("retryable")
+        and self.request.retries < settings.SHEET_SYNC_MAX_RETRIES
+    ):
+        countdown = get_exponential_backoff_interval(
+            factor=settings.SHEET_SYNC_RETRY_BACKOFF,
+            retries=self.request.retries,
+            maximum=settings.SHEET_SYNC_RETRY_BACKOFF_MAX,
+            full_jitter=True,
+        )
+        logger.warning(
+            f"Celery Task: Transient failure for customer {did_number} "
+            f"({result.get('error')}), retrying in {countdown}s."
+        )
+        try:
+            raise self.retry(countdown=countdown, max_retries=None)
+        except Retry:
+            raise
+        except Exception as e:
+            # Could not schedule the retry (e.g. broker unreachable): give up
+            result["error"] = f"{result.get('error')} (retry failed: {e})"
 
-    if not customers:
-        logger.warning("Celery Task: No customers found to update.")
-        return "Process finished: No customers found."
+    if result.get("status") not in ("success", "unchanged"):
+        logger.error(
+            f"Celery Task: Failed to update customer {did_number}. "
+            f"Error: {result.get('error', 'Unknown error')}"
+        )
 
-    logger.info(f"Celery Task: Found {total_customers} customers to process.")
+    return lane_results + [
+        {
+            "did_number": did_number,
+            "status": result.get("status"),
+            "error": result.get("error"),
+            "retries": self.request.retries,
+            "quota_wait_seconds": result.get("quota_wait_seconds", 0.0),
+        }
+    ]
 
-    for customer in customers:
-        logger.info(
-            f"Celery Task: Processing customer DID: {customer.did_number}, Name: {customer.name}..."
-        )
+
+def _sync_customer(did_number, modified_time, force):
+    """Runs update_customer_from_sheet for sync_customer_task and records a success."""
+    customer = Customer.objects.filter(did_number=did_number).first()
+    if customer is None:
+        logger.warning(f"Celery Task: Customer {did_number} no longer exists.")
+        return {"status": "error", "error": "Customer not found."}
+
+    logger.info(
+        f"Celery Task: Processing customer DID: {customer.did_number}, Name: {customer.name}..."
+    )
+    # The pre-pass already read the sheet's modifiedTime
+    result = update_customer_from_sheet(
+        customer, created=False, force=force, prechecked=True
+    )
+    if result.get("status") in ("success", "unchanged"):
         try:
-            result = update_customer_from_sheet(customer, created=False)
-
-            if result.get("status") == "success":
-                logger.info(
-                    f"Celery Task: Successfully updated customer {customer.did_number}. "
-                    f"Message: {result.get('message', '')}"
-                )
-                updated_count += 1
-            else:
-                logger.error(
-                    f"Celery Task: Failed to update customer {customer.did_number}. "
-                    f"Error: {result.get('error', 'Unknown error')}"
-                )
-                failed_count += 1
+            mark_customer_synced(
+                did_number, modified_time and parse_modified_time(modified_time)
+            )
         except Exception as e:
-            logger.error(
-                f"Celery Task: Critical error updating customer {customer.did_number}: {e}",
-                exc_info=True,  # This will include the full traceback in the log
+            # The tree is already saved; the next run just re-reads the sheet
+            logger.warning(
+                f"Celery Task: Could not record sync of customer {did_number}: {e}"
             )
-            failed_count += 1
+    if result.get("status") == "success":
+        logger.info(
+            f"Celery Task: Successfully updated customer {did_number}. "
+            f"Message: {result.get('message', '')}"
+        )
+    elif result.get("status") == "unchanged":
+        logger.info(f"Celery Task: Sheet unchanged for customer {did_number}, skipped.")
+    return result
+
+
+@shared_task(name="actionapi.tasks.summarize_customer_updates_task")
+def summarize_customer_updates_task(lanes, not_modified_count=0):
+    """
+    Chord callback: aggregates the per-customer outcomes of every lane into
+    the summary update_all_customers_task reports. `not_modified_count` is
+    the number of customers the change-detection pre-pass skipped.
+    """
+    outcomes = [outcome for lane in lanes for outcome in lane]
+    updated_count = sum(1 for o in outcomes if o["status"] == "success")
+    unchanged_count = sum(1 for o in outcomes if o["status"] == "unchanged")
+    failed = [o for o in outcomes if o["status"] not in ("success", "unchanged")]
 
+    for outcome in failed:
+        logger.error(
+            f"Celery Task: Customer {outcome['did_number']} failed after "
+            f"{outcome['retries']} retries: {outcome['error']}"
+        )
+
+    quota_wait = sum(o.get("quota_wait_seconds", 0.0) for o in outcomes)
     summary = (
         f"Daily customer sheet update process finished. "
-        f"Total processed: {total_customers}, "
+        f"Total processed: {len(outcomes) + not_modified_count}, "
+        f"Not modified since last sync: {not_modified_count}, "
         f"Successfully updated: {updated_count}, "
-        f"Failed updates: {failed_count}."
+        f"Unchanged: {unchanged_count}, "
+        f"Failed updates: {len(failed)}, "
+        f"Sheets quota wait: {quota_wait:.1f}s."
     )
     logger.info(f"Celery Task: {summary}")
+    logger.info(f"Celery Task: Sheets rate limiter: {sheets_rate_limiter.stats()}")
 
     return summary
+
+
+@shared_task(bind=True, name="actionapi.tasks.update_all_customers_task")
+def update_all_customers_task(self, max_concurrency=None, force=False):
+    """
+    Celery task to update all customers from their linked Google Sheets.
+    A pre-pass reads every sheet's Drive modifiedTime in batched calls and
+    only customers whose sheet changed since their last successful sync are
+    updated, unless `force` is set. Those customers are dealt round-robin
+    into `max_concurrency` lanes (default:
+    settings.SHEET_SYNC_MAX_CONCURRENCY); each lane is a chain that syncs
+    its customers one after another, and the lanes run in parallel as a
+    chord.
+    The task replaces itself with that chord, so its result is the callback's
+    aggregated summary.
+    """
+    logger.info("Celery Task: Starting daily customer sheet update process...")
+
+    customers = Customer.objects.order_by("did_number")
+    if not customers:
+        logger.warning("Celery Task: No customers found to update.")
+        return "Process finished: No customers found."
+
+    to_sync, skipped, modified_times = select_customers_to_sync(customers, force=force)
+    logger.info(
+        f"Celery Task: {len(skipped)} customers' sheets not modified since their "
+        f"last sync; {len(to_sync)} to update."
+    )
+    if not to_sync:
+        return summarize_customer_updates_task([], not_modified_count=len(skipped))
+
+    did_numbers = [customer.did_number for customer in to_sync]
+    modified_isoformats = {
+        did: modified.isoformat() if modified else None
+        for did, modified in modified_times.items()
+    }
+
+    max_concurrency = max_concurrency or settings.SHEET_SYNC_MAX_CONCURRENCY
+    lane_count = max(1, min(max_concurrency, len(did_numbers)))
+    logger.info(
+        f"Celery Task: Found {len(did_numbers)} customers to process "
+        f"in {lane_count} parallel lanes."
+    )
+
+    lanes = []
+    for lane_index in range(lane_count):
+        lane_dids = did_numbers[lane_index::lane_count]
+        lanes.append(
+            chain(
+                sync_customer_task.s(
+                    [],
+                    lane_dids[0],
+                    modified_time=modified_isoformats[lane_dids[0]],
+                    force=force,
+                ),
+                *(
+                    sync_customer_task.s(
+                        did, modified_time=modified_isoformats[did], force=force
+                    )
+                    for did in lane_dids[1:]
+                ),
+            )
+        )
+
+    return self.replace(
+        chord(
+            group(lanes),
+            summarize_customer_updates_task.s(not_modified_count=len(skipped)),
+        )
+    )
+
+
+@shared_task(name="actionapi.tasks.delete_superseded_tree_versions_task")
+def delete_superseded_tree_versions_task(did_number):
+    """
+    Celery task queued after a full rebuild has flipped the customer's
+    active tree version: deletes the older versions in batches.
+    """
+    deleted = delete_superseded_tree_versions(did_number)
+    logger.info(
+        f"Celery Task: Deleted {deleted} rows of superseded tree versions "
+        f"for customer {did_number}."
+    )
+    return deleted
+
+
+@shared_task(bind=True, name="actionapi.tasks.debounced_sync_customer_task")
+def debounced_sync_customer_task(self, did_number, token):
+    """
+    Celery task scheduled by the sheet-edited webhook. Waits until the
+    customer's sheet has had no edit notification for
+    settings.SHEET_EDIT_QUIET_SECONDS (re-scheduling itself while edits keep
+    coming), then syncs the customer once for the whole burst of edits.
+    `token` identifies the task's hold on the customer's scheduled key; a
+    task that finds another one holding it steps aside.
+    """
+    remaining = quiet_time_remaining(did_number)
+    if remaining > 0:
+        if not keep_customer_scheduled(did_number, token):
+            logger.warning(
+                f"Celery Task: Another sync of customer {did_number} is "
+                f"scheduled, dropping this one."
+            )
+            return {"did_number": did_number, "status": "superseded"}
+        logger.info(
+            f"Celery Task: Customer {did_number} still being edited, "
+            f"syncing in {remaining:.1f}s."
+        )
+        self.apply_async((did_number, token), countdown=remaining)
+        return {"did_number": did_number, "status": "rescheduled"}
+
+    if not release_customer(did_number, token):
+        logger.warning(
+            f"Celery Task: Another sync of customer {did_number} is "
+            f"scheduled, dropping this one."
+        )
+        return {"did_number": did_number, "status": "superseded"}
+    customer = Customer.objects.filter(did_number=did_number).first()
+    if customer is None:
+        logger.warning(f"Celery Task: Customer {did_number} no longer exists.")
+        return {"did_number": did_number, "status": "error", "error": "Customer not found."}
+
+    logger.info(f"Celery Task: Syncing edited sheet of customer {did_number}...")
+    result = update_customer_from_sheet(customer, created=False)
+    if result.get("status") in ("success", "unchanged"):
+        mark_customer_synced(did_number)
+        logger.info(
+            f"Celery Task: Edited sheet of customer {did_number} synced "
+            f"({result.get('status')})."
+        )
+    else:
+        logger.error(
+            f"Celery Task: Failed to sync edited sheet of customer {did_number}. "
+            f"Error: {result.get('error', 'Unknown error')}"
+        )
+    return {"did_number": did_number, **result}
+
+
+@shared_task(name="actionapi.tasks.run_sheet_sync_job_task")
+def run_sheet_sync_job_task(job_id):
+    """
+    Celery task behind the async mode of the sheet sync endpoints: runs
+    update_customer_from_sheet for a SheetSyncJob, recording its stage as it
+    goes and storing the result dict for the status endpoint.
+    """
+    # Claim the job; once it leaves "queued", new requests get a fresh job
+    claimed = SheetSyncJob.objects.filter(
+        id=job_id, status=SheetSyncJob.STATUS_QUEUED
+    ).update(status=SheetSyncJob.STATUS_RUNNING)
+    if not claimed:
+        logger.warning(f"Celery Task: Sync job {job_id} is not queued, ignoring.")
+        return None
+    job = SheetSyncJob.objects.select_related("customer").get(id=job_id)
+
+    def record_progress(stage):
+        SheetSyncJob.objects.filter(id=job_id).update(progress=stage)
+
+    logger.info(f"Celery Task: Running sync job {job_id} for {job.customer}...")
+    try:
+        result = update_customer_from_sheet(
+            job.customer, created=job.created, progress=record_progress
+        )
+    except Exception as e:
+        logger.error(f"Celery Task: Sync job {job_id} crashed: {e}", exc_info=True)
+        result = {"status": "error", "error": str(e)}
+
+    if result.get("status") in ("success", "unchanged"):
+        mark_customer_synced(job.customer_id)
+        job_status = SheetSyncJob.STATUS_FINISHED
+    else:
+        job_status = SheetSyncJob.STATUS_FAILED
+    SheetSyncJob.objects.filter(id=job_id).update(
+        status=job_status, progress="done", result=result
+    )
+    logger.info(f"Celery Task: Sync job {job_id} {job_status}.")
+    return result
@@ -1,3 +1,2084 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import re
+import time
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+import brotli
+import gspread
+import msgpack
+import requests
+from django.contrib import admin
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.models import F
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from .admin import ActionAdmin, CustomerAdmin, DemandAdmin, PatientTypeAdmin
+from .models import (
+    Action,
+    Customer,
+    CustomerDocument,
+    Demand,
+    DemandTitle,
+    PatientType,
+    SheetSnapshot,
+    SheetSyncJob,
+)
+from .serializers import CustomerSerializer, customer_tree_representation
+from .utils import google_client
+from .utils.change_detection import (
+    DriveMetadataTransport,
+    FakeDriveTransport,
+    mark_customer_synced,
+    parse_modified_time,
+    select_customers_to_sync,
+)
+from .utils.documents import refresh_customer_document
+from .utils.rate_limiter import SheetsRateLimiter, sheets_rate_limiter
+from .utils.sheet_updater import (
+    DETAIL_COLUMN_COUNT,
+    DETAIL_WORKSHEET,
+    SHEET_FETCH_FIELDS,
+    SYNC_MODE_INCREMENTAL,
+    SYNC_MODE_REPLACE,
+    SYNC_MODE_STREAM,
+    _bulk_create_tree,
+    _grid_to_values,
+    _sheet_error_result,
+    apply_parsed_sheet,
+    compute_sheet_hash,
+    delete_superseded_tree_versions,
+    fetch_customer_sheet,
+    fetch_sheet_values,
+    parse_sheet_values,
+    update_customer_from_sheet,
+)
+from .utils.local_cache import INVALIDATION_CHANNEL, LocalCustomerCache
+from .signals import customer_deleted, notify_customer_changed
+from .tasks import (
+    debounced_sync_customer_task,
+    run_sheet_sync_job_task,
+    summarize_customer_updates_task,
+    sync_customer_task,
+    update_all_customers_task,
+)
+from .utils.response_cache import CachedBody, CustomerResponseCache
+from .utils.search import refresh_customer_search_index
+from .utils.snapshots import (
+    SnapshotEncoder,
+    decode_sheet_values,
+    encode_sheet_values,
+    load_snapshot_as_fetched,
+    save_sheet_snapshot,
+)
+from .utils.sync_debounce import DIRTY_KEY, SCHEDULED_KEY, mark_customer_dirty
+
+
+def build_tree(customer, size, version=1):
+    """Gives `customer` a tree with `size` nodes at each level below the titles."""
+    for t in range(size):
+        demand_title = DemandTitle.objects.create(
+            customer=customer, title=f"Title {t}", version=version
+        )
+        for d in range(size):
+            demand = Demand.objects.create(demand_title=demand_title, name=f"Demand {d}")
+            for p in range(size):
+                patient_type = PatientType.objects.create(
+                    demand=demand, name=f"Patient type {p}"
+                )
+                Action.objects.bulk_create(
+                    Action(patient_type=patient_type, description=f"Action {a}")
+                    for a in range(size)
+                )
+
+
+def detail_sheet(*rows):
+    """'detail' worksheet values: the customer's details, the headers, then `rows`."""
+    return [
+        ["Cabinet", "1 rue de la Paix", "Note 1", "Note 2", "Note 3"],
+        ["Titre", "Demande", "Patient", "Action", "Dire"],
+        *[list(row) for row in rows],
+    ]
+
+
+def generated_rows(count):
+    """`count` data rows spread over a few titles, demands and patient types."""
+    return [
+        (f"Title {i % 3}", f"Demand {i % 5}", f"Patient type {i % 7}", f"Action {i}", "")
+        for i in range(count)
+    ]
+
+
+def tree_of(customer):
+    """The customer's active tree as nested (name, children) tuples."""
+    customer.refresh_from_db()
+    return [
+        (
+            title["title"],
+            [
+                (
+                    demand["name"],
+                    [
+                        (
+                            patient_type["name"],
+                            [
+                                (action["description"], action["dire_text"])
+                                for action in patient_type["actions"]
+                            ],
+                        )
+                        for patient_type in demand["patient_types"]
+                    ],
+                )
+                for demand in title["demands"]
+            ],
+        )
+        for title in customer_tree_representation(customer)["demand_titles"]
+    ]
+
+
+def tree_of_rows(rows):
+    """tree_of() as parse_sheet_values builds it from `rows`."""
+    tree = {}
+    for title, demand, patient_type, description, dire_text in rows:
+        tree.setdefault(title, {}).setdefault(demand, {}).setdefault(
+            patient_type, []
+        ).append((description, dire_text))
+    return [
+        (
+            title,
+            [
+                (demand, list(patient_types.items()))
+                for demand, patient_types in demands.items()
+            ],
+        )
+        for title, demands in tree.items()
+    ]
+
+
+def apply_sheet(customer, values, mode=SYNC_MODE_REPLACE, created=False):
+    return apply_parsed_sheet(
+        customer, created, "Sheet-2", str(values), parse_sheet_values(values), mode
+    )
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class SheetBulkRebuildTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(did_number="10")
+
+    def test_rebuild_query_count_does_not_grow_with_the_sheet(self):
+        query_counts = []
+        # Both fit in one INSERT per level under SQLite's parameter limit
+        for did_number, count in (("11", 3), ("12", 60)):
+            customer = Customer.objects.create(did_number=did_number)
+            with CaptureQueriesContext(connection) as queries:
+                apply_sheet(customer, detail_sheet(*generated_rows(count)))
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(Customer.objects.get(pk="12").action_count, 60)
+
+    def test_rebuild_keeps_the_sheet_order_and_customer_fields(self):
+        apply_sheet(
+            self.customer,
+            detail_sheet(
+                ("B", "Demand", "Patient", "First", "Dire"),
+                ("A", "Demand", "Patient", "Second", ""),
+                ("B", "Demand", "Patient", "Third", ""),
+                ("B", "", "Patient", "Skipped", ""),
+            ),
+            created=True,
+        )
+        self.assertEqual(
+            tree_of(self.customer),
+            [
+                ("B", [("Demand", [("Patient", [("First", "Dire"), ("Third", "")])])]),
+                ("A", [("Demand", [("Patient", [("Second", "")])])]),
+            ],
+        )
+        self.assertEqual(self.customer.name, "Cabinet")
+        self.assertEqual(self.customer.note3, "Note 3")
+        self.assertEqual(self.customer.filetitle, "Sheet")
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class TreeVersionTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(did_number="13")
+        self.gc = mock.patch(
+            "actionapi.tasks.delete_superseded_tree_versions_task.delay"
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def test_rebuild_flips_the_version_and_queues_the_gc(self):
+        apply_sheet(
+            self.customer, detail_sheet(("A", "D", "P", "Old", "")), created=True
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_sheet(self.customer, detail_sheet(("B", "D", "P", "New", "")))
+        self.gc.assert_called_once_with("13")
+
+        self.customer.refresh_from_db()
+        self.assertEqual(
+            (self.customer.active_version, self.customer.latest_version), (3, 3)
+        )
+        self.assertEqual(
+            tree_of(self.customer), [("B", [("D", [("P", [("New", "")])])])]
+        )
+        # The superseded version stays until the GC task runs
+        self.assertTrue(DemandTitle.objects.filter(customer=self.customer, version=2))
+        self.assertEqual(delete_superseded_tree_versions("13"), 4)
+        self.assertEqual(
+            list(DemandTitle.objects.values_list("title", "version")), [("B", 3)]
+        )
+
+    def test_failed_rebuild_keeps_the_active_version(self):
+        apply_sheet(
+            self.customer, detail_sheet(("A", "D", "P", "Old", "")), created=True
+        )
+        with mock.patch(
+            "actionapi.utils.sheet_updater.refresh_customer_search_index",
+            side_effect=RuntimeError("boom"),
+        ), self.assertRaises(RuntimeError):
+            apply_sheet(self.customer, detail_sheet(("B", "D", "P", "New", "")))
+
+        customer = Customer.objects.get(pk="13")
+        self.assertEqual((customer.active_version, customer.latest_version), (2, 2))
+        self.assertEqual(tree_of(customer), [("A", [("D", [("P", [("Old", "")])])])])
+        self.assertFalse(DemandTitle.objects.filter(version=3).exists())
+
+    def test_gc_deletes_older_versions_in_batches(self):
+        Customer.objects.filter(pk="13").update(active_version=2, latest_version=3)
+        for version in (1, 2, 3):
+            build_tree(self.customer, 2, version=version)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(delete_superseded_tree_versions("13", batch_size=3), 30)
+        deletes = [q["sql"] for q in queries if q["sql"].startswith("DELETE")]
+        for sql in deletes:
+            ids = re.search(r"IN \((.*)\)", sql).group(1)
+            self.assertLessEqual(len(ids.split(",")), 3, sql)
+        # The active version and the one a sync may be writing are kept
+        self.assertEqual(
+            sorted(set(DemandTitle.objects.values_list("version", flat=True))), [2, 3]
+        )
+        self.assertEqual(Action.objects.count(), 32)
+        self.assertEqual(delete_superseded_tree_versions("13"), 0)
+
+
+def fetched_sheet(values):
+    """What fetch_customer_sheet returns for a sheet holding `values`."""
+    return {
+        "status": "fetched",
+        "spreadsheet_title": "Sheet",
+        "all_values": values,
+        "quota_wait_seconds": 0.0,
+        "fetch_seconds": 0.0,
+        "fetched_at": timezone.now(),
+    }
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class SheetHashTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(did_number="20")
+        self.values = detail_sheet(*generated_rows(5))
+
+    def sync(self, values, **kwargs):
+        return update_customer_from_sheet(
+            self.customer,
+            False,
+            mode=SYNC_MODE_REPLACE,
+            fetched=fetched_sheet(values),
+            **kwargs,
+        )
+
+    def test_hash_ignores_trailing_empty_cells_and_rows(self):
+        padded = [row + ["", ""] for row in self.values] + [[""] * 7, []]
+        self.assertEqual(compute_sheet_hash(padded), compute_sheet_hash(self.values))
+        edited = [row[:] for row in self.values]
+        edited[-1][4] = "Dire"
+        self.assertNotEqual(compute_sheet_hash(edited), compute_sheet_hash(self.values))
+
+    def test_unchanged_sheet_skips_the_rewrite(self):
+        self.assertEqual(self.sync(self.values)["status"], "success")
+        self.customer.refresh_from_db()
+        version = self.customer.content_version
+        node_ids = list(DemandTitle.objects.values_list("id", flat=True))
+
+        # Only the snapshot's fetch time is written
+        with self.assertNumQueries(1):
+            result = self.sync(self.values)
+        self.assertEqual(result["status"], "unchanged")
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.content_version, version)
+        self.assertEqual(list(DemandTitle.objects.values_list("id", flat=True)), node_ids)
+
+    def test_changed_or_forced_sheet_is_rewritten(self):
+        self.sync(self.values)
+        self.assertEqual(self.sync(self.values, force=True)["status"], "success")
+        edited = self.values + [["Title 9", "Demand", "Patient", "New", ""]]
+        self.assertEqual(self.sync(edited)["status"], "success")
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.sheet_hash, compute_sheet_hash(edited))
+        self.assertEqual(self.customer.action_count, 6)
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class IncrementalSyncTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(did_number="30")
+        self.rows = [
+            ("A", "Demand", "Patient", "Action A", ""),
+            ("B", "Demand", "Patient", "Action B1", ""),
+            ("B", "Demand", "Patient", "Action B2", ""),
+        ]
+        apply_sheet(self.customer, detail_sheet(*self.rows), SYNC_MODE_INCREMENTAL)
+
+    def node_ids(self):
+        return {
+            model: set(model.objects.values_list("id", flat=True))
+            for model in (DemandTitle, Demand, PatientType, Action)
+        }
+
+    def test_diff_only_touches_changed_nodes(self):
+        before = self.node_ids()
+        rows = [
+            self.rows[0],
+            ("B", "Demand", "Patient", "Action B1", "Dire"),
+            ("C", "Demand", "Patient", "Action C", ""),
+        ]
+        changes = apply_sheet(self.customer, detail_sheet(*rows), SYNC_MODE_INCREMENTAL)
+        # C's four nodes; B1's dire text; B2
+        self.assertEqual(changes, {"created": 4, "updated": 1, "deleted": 1})
+        after = self.node_ids()
+        self.assertEqual(after[DemandTitle] & before[DemandTitle], before[DemandTitle])
+        self.assertEqual(len(before[Action] - after[Action]), 1)
+        self.assertEqual(tree_of(self.customer), tree_of_rows(rows))
+
+    def test_reordered_sheet_is_served_in_the_new_order(self):
+        rows = [("C", "Demand", "Patient", "Action C", ""), *self.rows]
+        changes = apply_sheet(self.customer, detail_sheet(*rows), SYNC_MODE_INCREMENTAL)
+        # C's four nodes; A and B move down one place
+        self.assertEqual(changes, {"created": 4, "updated": 2, "deleted": 0})
+        expected = tree_of_rows(rows)
+        self.assertEqual([title for title, _ in expected], ["C", "A", "B"])
+        self.assertEqual(tree_of(self.customer), expected)
+        self.assertEqual(
+            [
+                title["title"]
+                for title in APIClient().get("/api/customers/30/").json()[
+                    "demand_titles"
+                ]
+            ],
+            ["C", "A", "B"],
+        )
+
+    def test_unchanged_tree_writes_nothing(self):
+        changes = apply_sheet(
+            self.customer, detail_sheet(*self.rows), SYNC_MODE_INCREMENTAL
+        )
+        self.assertEqual(changes, {"created": 0, "updated": 0, "deleted": 0})
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerCreateTests(TestCase):
+    def payload(self, *titles):
+        return {
+            "did_number": "40",
+            "demand_titles": [
+                {
+                    "title": title,
+                    "demands": [
+                        {
+                            "name": "Demand",
+                            "patient_types": [{"name": "B"}, {"name": "A"}],
+                        }
+                    ],
+                }
+                for title in titles
+            ],
+        }
+
+    def test_create_keeps_the_payload_order(self):
+        response = APIClient().post(
+            "/api/customers/", self.payload("Z", "Y"), format="json"
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            tree_of(Customer.objects.get(pk="40")),
+            [
+                ("Z", [("Demand", [("B", []), ("A", [])])]),
+                ("Y", [("Demand", [("B", []), ("A", [])])]),
+            ],
+        )
+
+    def test_duplicate_sibling_names_are_rejected(self):
+        response = APIClient().post(
+            "/api/customers/", self.payload("Z", "Y", "Z"), format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("demand_titles[2].title", response.json())
+        payload = self.payload("Z")
+        payload["demand_titles"][0]["demands"][0]["patient_types"].append({"name": "A"})
+        response = APIClient().post("/api/customers/", payload, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(
+            "demand_titles[0].demands[0].patient_types[2].name", response.json()
+        )
+        self.assertFalse(Customer.objects.exists())
+
+
+class SheetsClientTests(SimpleTestCase):
+    def setUp(self):
+        google_client.reset_sheets_client()
+        self.addCleanup(google_client.reset_sheets_client)
+        patcher = mock.patch.object(
+            google_client, "_build_client", side_effect=lambda: mock.Mock()
+        )
+        self.build_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_client_is_built_once_per_process(self):
+        client = google_client.get_sheets_client()
+        self.assertIs(google_client.get_sheets_client(), client)
+        self.assertEqual(self.build_client.call_count, 1)
+
+        # A forked worker builds its own client
+        with mock.patch("os.getpid", return_value=-1):
+            self.assertIsNot(google_client.get_sheets_client(), client)
+        self.assertEqual(self.build_client.call_count, 2)
+
+    def test_reset_closes_the_session_and_rebuilds(self):
+        client = google_client.get_sheets_client()
+        google_client.reset_sheets_client()
+        client.http_client.session.close.assert_called_once_with()
+        self.assertIsNot(google_client.get_sheets_client(), client)
+
+
+def api_error(status_code, message="Error"):
+    """A gspread APIError as raised for a Google API response with `status_code`."""
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = message
+    response._content = json.dumps(
+        {"error": {"code": status_code, "message": message, "status": ""}}
+    ).encode()
+    return gspread.exceptions.APIError(response)
+
+
+class FakeSheetsClient:
+    """
+    Stands in for the gspread client, serving `values` as the 'detail'
+    worksheet of every spreadsheet (padded to `row_count` grid rows).
+    """
+
+    def __init__(self, values, title="Sheet-1", row_count=None):
+        self.values = values
+        self.title = title
+        self.row_count = row_count or len(values)
+        self.http_client = mock.Mock()
+        self.http_client.fetch_sheet_metadata.side_effect = self.fetch_sheet_metadata
+        self.http_client.values_get.side_effect = self.values_get
+
+    def fetch_sheet_metadata(self, sheet_id, params):
+        if params["ranges"] != DETAIL_WORKSHEET:
+            raise api_error(400, f"Unable to parse range: {params['ranges']}")
+        sheet = {"properties": {"gridProperties": {"rowCount": self.row_count}}}
+        if params["includeGridData"] == "true":
+            row_data = [
+                {"values": [{"formattedValue": v} if v else {} for v in row]}
+                for row in self.values
+            ]
+            sheet["data"] = [{"rowData": row_data}]
+        return {"properties": {"title": self.title}, "sheets": [sheet]}
+
+    def values_get(self, sheet_id, cell_range):
+        first, last = map(int, re.findall(r"\d+", cell_range.split("!")[1]))
+        rows = [
+            list(row[:DETAIL_COLUMN_COUNT]) for row in self.values[first - 1 : last]
+        ]
+        # Like the API, trailing empty cells and rows are left out
+        for row in rows:
+            while row and row[-1] == "":
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        return {"values": rows}
+
+
+class SheetsApiTestCase(TestCase):
+    """Runs Sheets API calls unthrottled, without a Redis server."""
+
+    def setUp(self):
+        patcher = mock.patch.object(sheets_rate_limiter, "acquire", return_value=0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def use_sheet(self, values, **kwargs):
+        """Makes get_sheets_client() return a FakeSheetsClient serving `values`."""
+        client = FakeSheetsClient(values, **kwargs)
+        for module in ("sheet_updater", "change_detection"):
+            patcher = mock.patch(
+                f"actionapi.utils.{module}.get_sheets_client", return_value=client
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return client
+
+
+class SheetFetchTests(SheetsApiTestCase):
+    def test_grid_is_converted_like_get_values(self):
+        row_data = [
+            {"values": [{"formattedValue": "a"}, {}, {"formattedValue": "c"}]},
+            {},
+            {"values": [{"formattedValue": "d"}, {}]},
+            {"values": [{}]},
+        ]
+        self.assertEqual(
+            _grid_to_values(row_data), [["a", "", "c"], ["", "", ""], ["d", "", ""]]
+        )
+        self.assertEqual(_grid_to_values([]), [[]])
+
+    def test_title_and_values_come_from_one_request(self):
+        values = detail_sheet(("Title", "Demand", "Patient", "", ""))
+        client = FakeSheetsClient(values)
+        title, fetched, waited = fetch_sheet_values(client, "sheet-id")
+        self.assertEqual((title, waited), ("Sheet-1", 0.0))
+        self.assertEqual(fetched, values)
+        client.http_client.fetch_sheet_metadata.assert_called_once_with(
+            "sheet-id",
+            params={
+                "includeGridData": "true",
+                "ranges": DETAIL_WORKSHEET,
+                "fields": SHEET_FETCH_FIELDS,
+            },
+        )
+
+    def test_missing_worksheet_or_spreadsheet_is_reported(self):
+        client = FakeSheetsClient(detail_sheet())
+        with self.assertRaises(gspread.exceptions.WorksheetNotFound):
+            fetch_sheet_values(client, "sheet-id", "other")
+        client.http_client.fetch_sheet_metadata.side_effect = api_error(404)
+        with self.assertRaises(gspread.exceptions.SpreadsheetNotFound):
+            fetch_sheet_values(client, "sheet-id")
+
+    def test_fetch_customer_sheet_returns_the_values(self):
+        values = detail_sheet(*generated_rows(3))
+        client = self.use_sheet(values)
+        customer = Customer(
+            did_number="50", sheet_url="https://docs.google.com/spreadsheets/d/abc/edit"
+        )
+        fetched = fetch_customer_sheet(customer)
+        self.assertEqual(fetched["status"], "fetched")
+        self.assertEqual(fetched["all_values"], values)
+        self.assertEqual(fetched["spreadsheet_title"], "Sheet-1")
+        self.assertEqual(client.http_client.fetch_sheet_metadata.call_count, 1)
+
+    def test_sheet_is_fetched_outside_the_write_transaction(self):
+        client = self.use_sheet(detail_sheet(*generated_rows(3)))
+        customer = Customer.objects.create(
+            did_number="51", sheet_url=SHEET_URL.format("51")
+        )
+        depth = len(connection.atomic_blocks)
+        depths = {}
+        client.http_client.fetch_sheet_metadata.side_effect = _record_depth(
+            depths, "fetch", client.http_client.fetch_sheet_metadata.side_effect
+        )
+        with mock.patch(
+            "actionapi.utils.sheet_updater._bulk_create_tree",
+            side_effect=_record_depth(depths, "write", _bulk_create_tree),
+        ):
+            result = update_customer_from_sheet(
+                customer, created=True, mode=SYNC_MODE_REPLACE
+            )
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(depths["fetch"], depth)
+        self.assertGreater(depths["write"], depth)
+
+
+def _record_depth(depths, name, function):
+    """Wraps `function` to record the transaction depth it is called at."""
+
+    def wrapper(*args, **kwargs):
+        depths[name] = len(connection.atomic_blocks)
+        return function(*args, **kwargs)
+
+    return wrapper
+
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class SheetSnapshotTests(SheetsApiTestCase):
+    def test_sync_stores_the_fetched_values(self):
+        values = detail_sheet(*generated_rows(5))
+        self.use_sheet(values)
+        customer = Customer.objects.create(
+            did_number="150", sheet_url=SHEET_URL.format("150")
+        )
+        update_customer_from_sheet(customer, created=True, mode=SYNC_MODE_REPLACE)
+
+        snapshot = SheetSnapshot.objects.get(customer=customer)
+        self.assertEqual(snapshot.spreadsheet_title, "Sheet-1")
+        self.assertEqual(snapshot.row_count, 7)
+        self.assertEqual(decode_sheet_values(snapshot.data), values)
+        # A streaming sync encodes row by row into the same blob
+        encoder = SnapshotEncoder()
+        for row in values:
+            encoder.add(row)
+        self.assertEqual(encoder.finish(), bytes(snapshot.data))
+
+    def test_unchanged_sheet_only_touches_the_snapshot(self):
+        self.use_sheet(detail_sheet(*generated_rows(5)))
+        customer = Customer.objects.create(
+            did_number="151", sheet_url=SHEET_URL.format("151")
+        )
+        update_customer_from_sheet(customer, created=True, mode=SYNC_MODE_REPLACE)
+        first = SheetSnapshot.objects.get(customer=customer)
+
+        result = update_customer_from_sheet(customer, created=False)
+        self.assertEqual(result["status"], "unchanged")
+        second = SheetSnapshot.objects.get(customer=customer)
+        self.assertGreater(second.fetched_at, first.fetched_at)
+        self.assertEqual(bytes(second.data), bytes(first.data))
+
+    def test_replay_uses_the_snapshot_and_leaves_it_alone(self):
+        values = detail_sheet(("A", "D", "P", "From snapshot", ""))
+        customer = Customer.objects.create(
+            did_number="152", sheet_url=SHEET_URL.format("152")
+        )
+        fetched_at = timezone.now() - timedelta(days=1)
+        save_sheet_snapshot(
+            customer, "Sheet-3", encode_sheet_values(values), len(values), fetched_at
+        )
+        with mock.patch(
+            "actionapi.utils.sheet_updater.get_sheets_client",
+            side_effect=AssertionError("The Google API was called"),
+        ):
+            result = update_customer_from_sheet(
+                customer,
+                created=False,
+                mode=SYNC_MODE_REPLACE,
+                fetched=load_snapshot_as_fetched(customer.sheet_snapshot),
+                force=True,
+            )
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(
+            tree_of(customer), [("A", [("D", [("P", [("From snapshot", "")])])])]
+        )
+        self.assertEqual(
+            SheetSnapshot.objects.get(customer=customer).fetched_at, fetched_at
+        )
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class ReplaySheetSnapshotsCommandTests(TransactionTestCase):
+    def test_trees_are_rebuilt_from_the_snapshots(self):
+        for did_number, action in (("153", "First"), ("154", "Second")):
+            customer = Customer.objects.create(did_number=did_number)
+            values = detail_sheet(("A", "D", "P", action, ""))
+            save_sheet_snapshot(
+                customer, "Sheet-1", encode_sheet_values(values), 3, timezone.now()
+            )
+        stdout = io.StringIO()
+        with mock.patch(
+            "actionapi.utils.sheet_updater.get_sheets_client",
+            side_effect=AssertionError("The Google API was called"),
+        ), mock.patch("actionapi.tasks.delete_superseded_tree_versions_task.delay"):
+            call_command(
+                "replay_sheet_snapshots",
+                "--did",
+                "153",
+                "--mode",
+                SYNC_MODE_REPLACE,
+                stdout=stdout,
+                stderr=io.StringIO(),
+            )
+        self.assertIn("Successfully replayed: 1", stdout.getvalue())
+        self.assertEqual(
+            tree_of(Customer.objects.get(pk="153")),
+            [("A", [("D", [("P", [("First", "")])])])],
+        )
+        self.assertEqual(tree_of(Customer.objects.get(pk="154")), [])
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class TreeNodeAdminTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(did_number="180")
+        self.other = Customer.objects.create(did_number="181")
+        build_tree(self.customer, 2)
+        build_tree(self.other, 1)
+        self.request = RequestFactory().post("/admin/")
+
+    def content_versions(self):
+        return dict(Customer.objects.values_list("did_number", "content_version"))
+
+    def test_edited_node_notifies_its_customer(self):
+        before = self.content_versions()
+        action = Action.objects.filter(
+            patient_type__demand__demand_title__customer=self.customer
+        ).first()
+        action.description = "Edited"
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            ActionAdmin(Action, admin.site).save_model(self.request, action, None, True)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.content_versions()["180"], before["180"] + 1)
+        self.assertEqual(self.content_versions()["181"], before["181"])
+
+    def test_node_moved_across_customers_notifies_both(self):
+        before = self.content_versions()
+        demand = Demand.objects.filter(
+            demand_title__customer=self.customer, name="Demand 1"
+        ).first()
+        demand.demand_title = DemandTitle.objects.get(customer=self.other)
+        DemandAdmin(Demand, admin.site).save_model(self.request, demand, None, True)
+        after = Customer.objects.in_bulk()
+        self.assertEqual(after["180"].content_version, before["180"] + 1)
+        self.assertEqual(after["181"].content_version, before["181"] + 1)
+        self.assertEqual((after["180"].demand_count, after["181"].demand_count), (3, 2))
+
+    def test_deleted_nodes_notify_their_customers(self):
+        before = self.content_versions()
+        patient_type = PatientType.objects.filter(
+            demand__demand_title__customer=self.customer
+        ).first()
+        admin_view = PatientTypeAdmin(PatientType, admin.site)
+        admin_view.delete_model(self.request, patient_type)
+        ActionAdmin(Action, admin.site).delete_queryset(
+            self.request, Action.objects.filter(description="Action 0")
+        )
+        after = Customer.objects.in_bulk()
+        self.assertEqual(after["180"].content_version, before["180"] + 2)
+        self.assertEqual(after["181"].content_version, before["181"] + 1)
+        self.assertEqual((after["180"].action_count, after["181"].action_count), (7, 0))
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class ManualEditTests(SheetsApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.values = detail_sheet(("A", "D", "P", "From the sheet", ""))
+        self.use_sheet(self.values)
+        self.customer = Customer.objects.create(
+            did_number="160", sheet_url=SHEET_URL.format("160")
+        )
+        update_customer_from_sheet(self.customer, created=True)
+        self.request = RequestFactory().post("/admin/")
+
+    def sync(self):
+        return update_customer_from_sheet(
+            Customer.objects.get(pk="160"), created=False
+        )
+
+    def test_sheet_sync_restores_an_admin_edit(self):
+        action = Action.objects.get(description="From the sheet")
+        action.description = "Edited in the admin"
+        ActionAdmin(Action, admin.site).save_model(self.request, action, None, True)
+        customer = Customer.objects.get(pk="160")
+        self.assertEqual(customer.sheet_hash, "")
+        self.assertIsNone(customer.sheet_modified_time)
+
+        self.assertEqual(self.sync()["status"], "success")
+        self.assertEqual(
+            tree_of(Customer.objects.get(pk="160")),
+            [("A", [("D", [("P", [("From the sheet", "")])])])],
+        )
+        self.assertEqual(self.sync()["status"], "unchanged")
+
+    def test_sheet_sync_restores_an_api_edit(self):
+        response = APIClient().patch(
+            "/api/customers/160/", {"name": "Edited"}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sync()["status"], "success")
+        self.assertEqual(Customer.objects.get(pk="160").name, "Cabinet")
+
+    def post_sheet(self, sheet_url):
+        customer = Customer.objects.get(pk="160")
+        with mock.patch("actionapi.views.notify_customer_changed") as notify:
+            response = APIClient().post(
+                "/api/customers/create-or-update-from-sheet/",
+                {"name": customer.name, "did_number": "160", "sheet_url": sheet_url},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 200)
+        return notify
+
+    def test_resubmitting_the_same_sheet_does_not_notify(self):
+        self.post_sheet(SHEET_URL.format("160")).assert_not_called()
+
+    def test_pointing_at_another_sheet_forgets_the_old_one(self):
+        with mock.patch(
+            "actionapi.views.update_customer_from_sheet",
+            return_value={"status": "success"},
+        ) as update:
+            notify = self.post_sheet(SHEET_URL.format("161"))
+        notify.assert_called_once_with("160")
+        # The new sheet is read in full, not compared with the old one's hash
+        customer = update.call_args.args[0]
+        self.assertEqual(customer.sheet_url, SHEET_URL.format("161"))
+        self.assertEqual(customer.sheet_hash, "")
+
+
+SHEET_URL = "https://docs.google.com/spreadsheets/d/{}/edit"
+FAKE_DRIVE = "actionapi.utils.change_detection.FakeDriveTransport"
+
+
+@override_settings(
+    CUSTOMER_CACHE_ENABLED=False,
+    CUSTOMER_LOCAL_CACHE_ENABLED=False,
+    SHEET_SYNC_MODE=SYNC_MODE_STREAM,
+    SHEET_SYNC_STREAM_CHUNK_ROWS=4,
+    SHEET_CHANGE_TRANSPORT=FAKE_DRIVE,
+)
+class StreamSyncTests(SheetsApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = Customer.objects.create(
+            did_number="140", sheet_url=SHEET_URL.format("140")
+        )
+        self.modified_times = {"140": timezone.now() - timedelta(hours=1)}
+        patcher = mock.patch.object(
+            FakeDriveTransport, "modified_times", self.modified_times
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.gc = mock.patch(
+            "actionapi.tasks.delete_superseded_tree_versions_task.delay"
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def sync(self, created=False):
+        return update_customer_from_sheet(self.customer, created=created)
+
+    def test_streamed_tree_matches_a_whole_sheet_rebuild(self):
+        rows = [("C", "D", "P", "First", "")] + generated_rows(8)
+        values = detail_sheet(*rows)
+        # Trailing empty grid rows come back from the API as missing rows
+        client = self.use_sheet(values, row_count=len(values) + 5)
+        self.assertEqual(self.sync(created=True)["status"], "success")
+        self.assertEqual(client.http_client.values_get.call_count, 4)
+
+        whole = Customer.objects.create(did_number="141")
+        apply_sheet(whole, values, created=True)
+        self.customer.refresh_from_db()
+        self.assertEqual(tree_of(self.customer), tree_of(whole))
+        self.assertEqual(tree_of(self.customer)[0][0], "C")
+        self.assertEqual(self.customer.sheet_hash, compute_sheet_hash(values))
+        self.assertEqual(self.customer.note3, "Note 3")
+
+    def test_unmodified_sheet_is_skipped_before_writing(self):
+        client = self.use_sheet(detail_sheet(*generated_rows(6)))
+        self.assertEqual(self.sync()["status"], "success")
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.sheet_modified_time, self.modified_times["140"])
+        client.http_client.reset_mock()
+
+        self.assertEqual(self.sync()["status"], "unchanged")
+        client.http_client.values_get.assert_not_called()
+        self.assertEqual(Customer.objects.get(pk="140").latest_version, 2)
+
+    def test_prechecked_sync_skips_the_drive_call(self):
+        self.use_sheet(detail_sheet(*generated_rows(6)))
+        self.sync()
+        with mock.patch(
+            "actionapi.utils.sheet_updater.select_customers_to_sync"
+        ) as select:
+            result = update_customer_from_sheet(
+                self.customer, created=False, prechecked=True
+            )
+        select.assert_not_called()
+        # Not skipped as unmodified: the values are read and found unchanged
+        self.assertEqual(result["status"], "unchanged")
+
+    def test_modified_but_identical_sheet_is_discarded(self):
+        self.use_sheet(detail_sheet(*generated_rows(6)))
+        self.sync()
+        self.customer.refresh_from_db()
+        self.modified_times["140"] += timedelta(minutes=5)
+
+        self.assertEqual(self.sync()["status"], "unchanged")
+        customer = Customer.objects.get(pk="140")
+        self.assertEqual((customer.active_version, customer.latest_version), (2, 3))
+        self.assertFalse(DemandTitle.objects.filter(version=3).exists())
+        self.assertEqual(customer.sheet_modified_time, self.modified_times["140"])
+
+    def test_failed_chunk_discards_the_partial_version(self):
+        client = self.use_sheet(detail_sheet(*generated_rows(6)))
+        values_get = client.http_client.values_get.side_effect
+        client.http_client.values_get.side_effect = [
+            values_get("140", "'detail'!A1:E4"),
+            api_error(500),
+        ]
+        result = self.sync()
+        self.assertEqual(result["status"], "error")
+        self.assertTrue(result["retryable"])
+        customer = Customer.objects.get(pk="140")
+        self.assertEqual((customer.active_version, customer.latest_version), (1, 2))
+        self.assertFalse(DemandTitle.objects.exists())
+
+
+@override_settings(
+    CUSTOMER_CACHE_ENABLED=False,
+    CUSTOMER_LOCAL_CACHE_ENABLED=False,
+    SHEET_CHANGE_TRANSPORT=FAKE_DRIVE,
+)
+class UpdateAllCustomersTaskTests(TestCase):
+    def test_customers_are_dealt_round_robin_into_lanes(self):
+        for did_number in ("61", "62", "63", "64", "65"):
+            Customer.objects.create(
+                did_number=did_number, sheet_url=SHEET_URL.format(did_number)
+            )
+        with mock.patch.object(
+            update_all_customers_task, "replace", side_effect=lambda sig: sig
+        ):
+            workflow = update_all_customers_task.apply(
+                kwargs={"max_concurrency": 2}
+            ).get()
+        lanes = [
+            [task.args[-1] for task in lane.tasks] for lane in workflow.tasks
+        ]
+        self.assertEqual(lanes, [["61", "63", "65"], ["62", "64"]])
+        # The first link of each lane starts from an empty list of outcomes
+        self.assertEqual(workflow.tasks[0].tasks[0].args, ([], "61"))
+        self.assertEqual(workflow.body.kwargs, {"not_modified_count": 0})
+
+    def test_summary_aggregates_every_lane(self):
+        def outcome(did_number, status, error=None):
+            return {
+                "did_number": did_number,
+                "status": status,
+                "error": error,
+                "retries": 0,
+                "quota_wait_seconds": 1.5,
+            }
+
+        with self.assertLogs("actionapi.tasks", "ERROR"):
+            summary = summarize_customer_updates_task(
+                [
+                    [outcome("61", "success"), outcome("63", "unchanged")],
+                    [outcome("62", "error", "Sheet not found")],
+                ],
+                not_modified_count=2,
+            )
+        self.assertEqual(
+            summary,
+            "Daily customer sheet update process finished. Total processed: 5, "
+            "Not modified since last sync: 2, Successfully updated: 1, "
+            "Unchanged: 1, Failed updates: 1, Sheets quota wait: 4.5s.",
+        )
+
+    def test_lane_link_appends_its_outcome(self):
+        Customer.objects.create(did_number="66")
+        with mock.patch(
+            "actionapi.tasks.update_customer_from_sheet",
+            return_value={"status": "success", "quota_wait_seconds": 0.5},
+        ):
+            outcomes = sync_customer_task.apply(args=([{"did_number": "61"}], "66"))
+        self.assertEqual(
+            outcomes.get(),
+            [
+                {"did_number": "61"},
+                {
+                    "did_number": "66",
+                    "status": "success",
+                    "error": None,
+                    "retries": 0,
+                    "quota_wait_seconds": 0.5,
+                },
+            ],
+        )
+        self.assertIsNotNone(Customer.objects.get(pk="66").last_synced_at)
+
+    def test_force_reaches_every_sync(self):
+        for did_number in ("61", "62", "63"):
+            Customer.objects.create(
+                did_number=did_number, sheet_url=SHEET_URL.format(did_number)
+            )
+        with mock.patch.object(
+            update_all_customers_task, "replace", side_effect=lambda sig: sig
+        ):
+            workflow = update_all_customers_task.apply(
+                kwargs={"max_concurrency": 2, "force": True}
+            ).get()
+        links = [task for lane in workflow.tasks for task in lane.tasks]
+        self.assertEqual(len(links), 3)
+        self.assertTrue(all(task.kwargs["force"] for task in links))
+
+        with mock.patch(
+            "actionapi.tasks.update_customer_from_sheet",
+            return_value={"status": "success"},
+        ) as update:
+            with self.assertLogs("actionapi.tasks", "INFO"):
+                sync_customer_task.apply(args=([], "61"), kwargs={"force": True})
+        self.assertEqual(
+            update.call_args.kwargs,
+            {"created": False, "force": True, "prechecked": True},
+        )
+
+
+class ChangeDetectionTests(TestCase):
+    def setUp(self):
+        self.synced_at = timezone.now() - timedelta(days=1)
+        for did_number in ("81", "82", "83", "84"):
+            Customer.objects.create(
+                did_number=did_number,
+                sheet_url=SHEET_URL.format(did_number),
+                sheet_modified_time=self.synced_at,
+            )
+        # Never synced through the pre-pass
+        Customer.objects.create(did_number="85", sheet_url=SHEET_URL.format("85"))
+        # No usable sheet URL
+        Customer.objects.create(
+            did_number="86", sheet_url=None, sheet_modified_time=self.synced_at
+        )
+        self.transport = FakeDriveTransport(
+            {
+                "81": self.synced_at,
+                "82": self.synced_at + timedelta(minutes=5),
+                "83": self.synced_at - timedelta(minutes=5),
+                # "84" missing: deleted, no access or a failed lookup
+                "85": self.synced_at,
+            }
+        )
+
+    def select(self, **kwargs):
+        to_sync, skipped, modified_times = select_customers_to_sync(
+            Customer.objects.order_by("did_number"), transport=self.transport, **kwargs
+        )
+        return (
+            [c.did_number for c in to_sync],
+            [c.did_number for c in skipped],
+            modified_times,
+        )
+
+    def test_only_modified_or_unknown_sheets_are_synced(self):
+        to_sync, skipped, modified_times = self.select()
+        self.assertEqual(to_sync, ["82", "84", "85", "86"])
+        self.assertEqual(skipped, ["81", "83"])
+        self.assertEqual(modified_times["82"], self.synced_at + timedelta(minutes=5))
+        self.assertIsNone(modified_times["84"])
+
+    def test_force_syncs_everyone(self):
+        to_sync, skipped, _ = self.select(force=True)
+        self.assertEqual(len(to_sync), 6)
+        self.assertEqual(skipped, [])
+
+    def test_failed_lookup_syncs_everyone(self):
+        self.transport = mock.Mock()
+        self.transport.fetch_modified_times.side_effect = api_error(500)
+        with self.assertLogs("actionapi.utils.change_detection", "WARNING"):
+            to_sync, skipped, modified_times = self.select()
+        self.assertEqual(len(to_sync), 6)
+        self.assertEqual(skipped, [])
+        self.assertEqual(set(modified_times.values()), {None})
+
+    def test_successful_sync_records_the_modified_time(self):
+        modified = self.synced_at + timedelta(minutes=5)
+        mark_customer_synced("82", modified)
+        self.assertEqual(self.select()[1], ["81", "82", "83"])
+        # A sync without a pre-pass leaves the recorded time alone
+        mark_customer_synced("82")
+        customer = Customer.objects.get(pk="82")
+        self.assertEqual(customer.sheet_modified_time, modified)
+        self.assertIsNotNone(customer.last_synced_at)
+
+    def test_batch_response_leaves_failed_lookups_out(self):
+        response = mock.Mock(
+            headers={"Content-Type": "multipart/mixed; boundary=batch_x"},
+            text=(
+                "--batch_x\r\nContent-Type: application/http\r\n"
+                "Content-ID: <response-81>\r\n\r\nHTTP/1.1 200 OK\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                '{"modifiedTime": "2025-05-20T16:48:00.000Z"}\r\n'
+                "--batch_x\r\nContent-Type: application/http\r\n"
+                "Content-ID: <response-84>\r\n\r\nHTTP/1.1 404 Not Found\r\n"
+                "Content-Type: application/json\r\n\r\n"
+                '{"error": {"code": 404}}\r\n'
+                "--batch_x--\r\n"
+            ),
+        )
+        with self.assertLogs("actionapi.utils.change_detection", "WARNING"):
+            modified_times = DriveMetadataTransport._parse_batch(response)
+        self.assertEqual(
+            modified_times, {"81": parse_modified_time("2025-05-20T16:48:00.000Z")}
+        )
+
+
+@override_settings(SHEET_SYNC_JOB_STALE_SECONDS=600)
+class SheetSyncJobTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(
+            did_number="95", sheet_url=SHEET_URL.format("95")
+        )
+        self.delay = mock.patch(
+            "actionapi.utils.sync_jobs.run_sheet_sync_job_task.delay"
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+
+    def request_sync(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return APIClient().post(
+                "/api/customers/95/update_from_sheet/?async=true", format="json"
+            )
+
+    def test_requests_share_the_queued_job(self):
+        first = self.request_sync()
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(self.request_sync().json()["job_id"], first.json()["job_id"])
+        self.delay.assert_called_once_with(first.json()["job_id"])
+
+        status_url = first.json()["status_url"]
+        self.assertEqual(
+            status_url,
+            f"http://testserver/api/customers/95/sync-jobs/{first.json()['job_id']}/",
+        )
+        self.assertEqual(APIClient().get(status_url).json()["status"], "queued")
+
+    def test_stale_queued_job_is_failed_and_replaced(self):
+        stale = SheetSyncJob.objects.create(customer=self.customer)
+        SheetSyncJob.objects.filter(id=stale.id).update(
+            created_at=timezone.now() - timedelta(seconds=601)
+        )
+        response = self.request_sync()
+        self.assertNotEqual(response.json()["job_id"], str(stale.id))
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, SheetSyncJob.STATUS_FAILED)
+        self.assertEqual(
+            stale.result["error"], "Sync job was never picked up by a worker."
+        )
+
+    def test_job_is_failed_when_it_cannot_be_queued(self):
+        self.delay.side_effect = ConnectionError("broker down")
+        with self.assertLogs("actionapi.utils.sync_jobs", "ERROR"):
+            self.request_sync()
+        job = SheetSyncJob.objects.get()
+        self.assertEqual(job.status, SheetSyncJob.STATUS_FAILED)
+        self.assertEqual(job.result["error"], "Failed to queue: broker down")
+        # The next request gets a fresh job
+        self.delay.side_effect = None
+        self.assertEqual(self.request_sync().json()["status"], "queued")
+
+    def test_worker_runs_the_job_once(self):
+        job_id = self.request_sync().json()["job_id"]
+        with mock.patch(
+            "actionapi.tasks.update_customer_from_sheet",
+            return_value={"status": "success", "message": "Updated."},
+        ) as sync:
+            run_sheet_sync_job_task.apply(args=(job_id,))
+            run_sheet_sync_job_task.apply(args=(job_id,))
+        sync.assert_called_once()
+        job = SheetSyncJob.objects.get(id=job_id)
+        self.assertEqual(job.status, SheetSyncJob.STATUS_FINISHED)
+        self.assertEqual(job.result, {"status": "success", "message": "Updated."})
+
+
+@override_settings(SHEET_SYNC_MAX_RETRIES=2)
+class SyncRetryTests(TestCase):
+    def setUp(self):
+        Customer.objects.create(did_number="67")
+
+    def run_task(self, *outcomes):
+        with mock.patch(
+            "actionapi.tasks.update_customer_from_sheet", side_effect=outcomes
+        ) as update:
+            with self.assertLogs("actionapi.tasks", "INFO"):
+                (outcome,) = sync_customer_task.apply(args=([], "67")).get()
+        return outcome, update.call_count
+
+    def test_transient_errors_are_retried(self):
+        for error in (
+            api_error(429),
+            api_error(503),
+            requests.exceptions.ConnectionError("reset"),
+            requests.exceptions.ReadTimeout("slow"),
+        ):
+            with self.subTest(error=error):
+                outcome, calls = self.run_task(error, {"status": "success"})
+                self.assertEqual((outcome["status"], outcome["retries"]), ("success", 1))
+                self.assertEqual(calls, 2)
+
+    def test_retries_stop_at_the_limit(self):
+        outcome, calls = self.run_task(*[api_error(500)] * 3)
+        self.assertEqual((outcome["status"], outcome["retries"]), ("error", 2))
+        self.assertEqual(calls, 3)
+
+    def test_other_errors_fail_immediately(self):
+        for error in (
+            api_error(403),
+            api_error(400),
+            ValueError("bad sheet"),
+            requests.exceptions.InvalidURL("no host"),
+        ):
+            with self.subTest(error=error):
+                outcome, calls = self.run_task(error)
+                self.assertEqual((outcome["status"], outcome["retries"]), ("error", 0))
+                self.assertEqual(calls, 1)
+
+    def test_failed_bookkeeping_keeps_the_outcome(self):
+        with mock.patch(
+            "actionapi.tasks.mark_customer_synced",
+            side_effect=OperationalError("locked"),
+        ):
+            outcome, calls = self.run_task({"status": "success"})
+        self.assertEqual((outcome["status"], calls), ("success", 1))
+
+    def test_failed_retry_scheduling_ends_in_an_error_outcome(self):
+        with mock.patch.object(
+            sync_customer_task, "retry", side_effect=ConnectionError("broker down")
+        ):
+            outcome, calls = self.run_task(api_error(503))
+        self.assertEqual(outcome["status"], "error")
+        self.assertIn("broker down", outcome["error"])
+
+    def test_sheet_error_results_carry_the_classification(self):
+        self.assertTrue(
+            _sheet_error_result(api_error(502), "test", "")["retryable"]
+        )
+        self.assertFalse(
+            _sheet_error_result(api_error(403), "test", "")["retryable"]
+        )
+        self.assertFalse(
+            _sheet_error_result(
+                requests.exceptions.TooManyRedirects(), "test", ""
+            )["retryable"]
+        )
+
+
+@override_settings(
+    CUSTOMER_CACHE_ENABLED=False,
+    CUSTOMER_LOCAL_CACHE_ENABLED=False,
+    SHEET_CHANGE_TRANSPORT=FAKE_DRIVE,
+)
+class UpdateAllCustomersCommandTests(SheetsApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_sheet(detail_sheet(*generated_rows(4)))
+        self.modified = timezone.now()
+        for did_number in ("71", "72", "73"):
+            Customer.objects.create(
+                did_number=did_number,
+                sheet_url=SHEET_URL.format(did_number),
+                sheet_modified_time=self.modified,
+            )
+        patcher = mock.patch.object(
+            FakeDriveTransport,
+            "modified_times",
+            {"71": self.modified, "72": self.modified, "73": timezone.now()},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_command(self, *args):
+        out = io.StringIO()
+        call_command(
+            "update_all_customers_from_sheets", *args, stdout=out, stderr=io.StringIO()
+        )
+        return out.getvalue()
+
+    def test_throughput_counts_only_synced_customers(self):
+        with mock.patch(
+            "actionapi.management.commands.update_all_customers_from_sheets.time"
+        ) as clock:
+            # started, then before and after the one write, then the end
+            clock.perf_counter.side_effect = [0.0, 1.0, 2.0, 4.0]
+            out = self.run_command()
+        self.assertIn("Not modified since last sync: 2", out)
+        self.assertIn("Successfully updated: 1", out)
+        self.assertIn("Throughput: 0.25 synced customers/sec", out)
+        self.assertEqual(Customer.objects.get(pk="73").action_count, 4)
+
+
+class FakeRedisTestCase(TestCase):
+    """Points every redis.Redis.from_url() client at one in-memory fakeredis server."""
+
+    def setUp(self):
+        super().setUp()
+        server = fakeredis.FakeServer()
+        patcher = mock.patch(
+            "redis.Redis.from_url",
+            side_effect=lambda url, **kwargs: fakeredis.FakeRedis(server=server),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis = fakeredis.FakeRedis(server=server)
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+@override_settings(
+    SHEETS_RATE_LIMIT_PER_MINUTE=60,
+    SHEETS_RATE_LIMIT_MIN_PER_MINUTE=6,
+    SHEETS_RATE_LIMIT_BURST=3,
+    SHEETS_RATE_LIMIT_RECOVERY_SECONDS=300,
+)
+class SheetsRateLimiterTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        self.limiter = SheetsRateLimiter()
+        patcher = mock.patch("actionapi.utils.rate_limiter.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_is_free_then_callers_wait_their_turn(self):
+        self.assertEqual([self.limiter.acquire() for _ in range(3)], [0.0] * 3)
+        # One token per second: the 4th and 5th callers queue up behind each other
+        fourth, fifth = self.limiter.acquire(), self.limiter.acquire()
+        self.assertAlmostEqual(fourth, 1.0, delta=0.1)
+        self.assertAlmostEqual(fifth, 2.0, delta=0.1)
+        self.assertEqual(self.sleep.call_count, 2)
+        stats = self.limiter.stats()
+        self.assertAlmostEqual(stats["total_wait_seconds"], 3.0, delta=0.2)
+
+    def test_429_halves_the_shared_rate_and_retries(self):
+        func = mock.Mock(side_effect=[api_error(429), "values"])
+        with self.assertLogs("actionapi.utils.rate_limiter", "WARNING"):
+            result, waited = self.limiter.call(func, "sheet-id")
+        self.assertEqual(result, "values")
+        self.assertEqual(func.call_count, 2)
+        stats = self.limiter.stats()
+        self.assertEqual(stats["rate_per_minute"], 30.0)
+        self.assertEqual(stats["throttled_responses"], 1)
+        # Another process sharing the bucket sees the lowered rate
+        self.assertEqual(SheetsRateLimiter().stats()["rate_per_minute"], 30.0)
+
+    def test_rate_never_drops_below_the_floor(self):
+        for _ in range(10):
+            with self.assertLogs("actionapi.utils.rate_limiter", "WARNING"):
+                self.limiter.penalize()
+        self.assertEqual(self.limiter.stats()["rate_per_minute"], 6.0)
+
+    def test_other_errors_are_not_retried(self):
+        func = mock.Mock(side_effect=api_error(403))
+        with self.assertRaises(gspread.exceptions.APIError):
+            self.limiter.call(func)
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(self.limiter.stats()["throttled_responses"], 0)
+
+    def test_persistent_429_is_raised_after_the_last_attempt(self):
+        func = mock.Mock(side_effect=api_error(429))
+        with self.assertLogs("actionapi.utils.rate_limiter", "WARNING"):
+            with self.assertRaises(gspread.exceptions.APIError):
+                self.limiter.call(func)
+        self.assertEqual(func.call_count, SheetsRateLimiter.max_throttled_attempts)
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+@override_settings(SHEET_EDIT_QUIET_SECONDS=15, APPS_SCRIPT_API_KEY="apps-script-key")
+class DebouncedSyncTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("actionapi.utils.sync_debounce._redis", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.customer = Customer.objects.create(
+            did_number="91", sheet_url=SHEET_URL.format("91")
+        )
+        self.scheduled_key = SCHEDULED_KEY.format(did_number="91")
+        self.sync = mock.patch(
+            "actionapi.tasks.update_customer_from_sheet",
+            return_value={"status": "unchanged"},
+        ).start()
+        self.addCleanup(mock.patch.stopall)
+        self.reschedule = mock.patch.object(
+            debounced_sync_customer_task, "apply_async"
+        ).start()
+
+    def run_task(self, token):
+        return debounced_sync_customer_task.apply(args=("91", token)).get()
+
+    def settle(self):
+        self.redis.set(DIRTY_KEY.format(did_number="91"), time.time() - 60)
+
+    def test_burst_of_edits_schedules_one_sync(self):
+        client = APIClient()
+        with mock.patch(
+            "actionapi.views.debounced_sync_customer_task.apply_async"
+        ) as schedule:
+            for _ in range(3):
+                response = client.post(
+                    "/api/customers/91/sheet-edited/", HTTP_X_API_KEY="apps-script-key"
+                )
+                self.assertEqual(response.status_code, 202)
+        schedule.assert_called_once()
+        (did_number, token), = schedule.call_args.args
+        self.assertEqual(did_number, "91")
+        self.assertEqual(self.redis.get(self.scheduled_key).decode(), token)
+
+    def test_reschedule_refreshes_the_scheduled_key(self):
+        token = mark_customer_dirty("91")
+        self.redis.expire(self.scheduled_key, 5)
+        self.assertEqual(self.run_task(token)["status"], "rescheduled")
+        self.assertEqual(self.redis.ttl(self.scheduled_key), 150)
+        self.assertEqual(self.reschedule.call_args.args[0], ("91", token))
+        self.assertIsNone(mark_customer_dirty("91"))
+        self.sync.assert_not_called()
+
+    def test_settled_sheet_is_synced_once(self):
+        token = mark_customer_dirty("91")
+        self.settle()
+        self.assertEqual(self.run_task(token)["status"], "unchanged")
+        self.sync.assert_called_once()
+        self.assertIsNone(self.redis.get(self.scheduled_key))
+        # Later edits schedule a new sync
+        self.assertIsNotNone(mark_customer_dirty("91"))
+
+    def test_task_holding_an_expired_key_still_syncs(self):
+        token = mark_customer_dirty("91")
+        self.redis.delete(self.scheduled_key)
+        self.assertEqual(self.run_task(token)["status"], "rescheduled")
+        self.assertEqual(self.redis.get(self.scheduled_key).decode(), token)
+        self.settle()
+        self.redis.delete(self.scheduled_key)
+        self.assertEqual(self.run_task(token)["status"], "unchanged")
+
+    def test_task_steps_aside_for_the_key_owner(self):
+        token = mark_customer_dirty("91")
+        self.redis.set(self.scheduled_key, "other-task")
+        self.assertEqual(self.run_task(token)["status"], "superseded")
+        self.reschedule.assert_not_called()
+        self.settle()
+        self.assertEqual(self.run_task(token)["status"], "superseded")
+        self.sync.assert_not_called()
+        self.assertEqual(self.redis.get(self.scheduled_key), b"other-task")
+
+
+@override_settings(SHEETS_RATE_LIMIT_REDIS_URL="redis://127.0.0.1:1/0")
+class SheetsRateLimiterUnavailableTests(SimpleTestCase):
+    def test_unreachable_redis_does_not_throttle(self):
+        limiter = SheetsRateLimiter()
+        with self.assertLogs("actionapi.utils.rate_limiter", "WARNING"):
+            self.assertEqual(limiter.call(lambda: "values"), ("values", 0.0))
+        self.assertFalse(limiter.stats()["available"])
+
+    def test_unreachable_redis_is_bypassed_for_a_while(self):
+        limiter = SheetsRateLimiter()
+        with self.assertLogs("actionapi.utils.rate_limiter", "WARNING") as logs:
+            limiter.acquire()
+            with mock.patch.object(limiter, "_acquire") as acquire:
+                for _ in range(3):
+                    self.assertEqual(limiter.acquire(), 0.0)
+                limiter.penalize()
+        acquire.assert_not_called()
+        self.assertEqual(len(logs.records), 1)
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerQueryCountTests(TestCase):
+    # 1 for the customer(s) + 1 per tree level
+    EXPECTED_QUERIES = 5
+    # retrieve first looks for a materialized document
+    EXPECTED_RETRIEVE_QUERIES = 6
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_retrieve_query_count_does_not_grow_with_tree(self):
+        for did_number, size in (("100", 1), ("200", 4)):
+            customer = Customer.objects.create(did_number=did_number, name="Cabinet")
+            build_tree(customer, size)
+            with self.assertNumQueries(self.EXPECTED_RETRIEVE_QUERIES):
+                response = self.client.get(f"/api/customers/{did_number}/")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()["demand_titles"]), size)
+
+    def test_list_query_count_does_not_grow_with_customers(self):
+        for count in (1, 3):
+            for i in range(Customer.objects.count(), count):
+                build_tree(Customer.objects.create(did_number=str(300 + i)), 2)
+            with self.assertNumQueries(self.EXPECTED_QUERIES):
+                response = self.client.get("/api/customers/?expand=demand_titles")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()["results"]), count)
+
+    def test_retrieve_serves_only_the_active_version(self):
+        customer = Customer.objects.create(did_number="400", active_version=2)
+        build_tree(customer, 1, version=1)
+        build_tree(customer, 2, version=2)
+        build_tree(customer, 3, version=3)
+        response = self.client.get("/api/customers/400/")
+        self.assertEqual(len(response.json()["demand_titles"]), 2)
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerReadPathTests(TestCase):
+    def test_retrieve_matches_customer_serializer_byte_for_byte(self):
+        customer = Customer.objects.create(
+            did_number="500",
+            name="Cabinet Médical \u2028 Zoé",
+            note1="“quotes” and \\ backslash",
+            last_synced_at=timezone.now(),
+        )
+        build_tree(customer, 3)
+        patient_type = PatientType.objects.first()
+        Action.objects.create(patient_type=patient_type, description=None)
+        Action.objects.create(
+            patient_type=patient_type, description="Line\nbreak \u2029", dire_text="é"
+        )
+
+        response = APIClient().get("/api/customers/500/")
+        customer = Customer.objects.get(pk="500")
+        expected = JSONRenderer().render(CustomerSerializer(customer).data)
+        self.assertEqual(response.content, expected)
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerDocumentTests(TestCase):
+    def test_retrieve_serves_the_document_with_one_query(self):
+        customer = Customer.objects.create(did_number="600", name="Zoé")
+        build_tree(customer, 3)
+        expected = APIClient().get("/api/customers/600/").content
+        refresh_customer_document("600")
+        with self.assertNumQueries(1):
+            response = APIClient().get("/api/customers/600/")
+        self.assertEqual(response.content, expected)
+        self.assertEqual(response["Content-Type"], "application/json")
+
+    def test_create_materializes_the_document(self):
+        payload = {
+            "did_number": "700",
+            "name": "Cabinet",
+            "demand_titles": [
+                {
+                    "title": "Urgences",
+                    "demands": [
+                        {
+                            "name": "Rendez-vous",
+                            "patient_types": [
+                                {"name": "Nouveau", "actions": [{"description": "Noter"}]}
+                            ],
+                        }
+                    ],
+                }
+            ],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = APIClient().post("/api/customers/", payload, format="json")
+        self.assertEqual(response.status_code, 201)
+        document = CustomerDocument.objects.get(pk="700")
+        self.assertEqual(document.version, Customer.objects.get(pk="700").content_version)
+        self.assertEqual(document.size, len(bytes(document.body)))
+        self.assertIn("Rendez-vous", bytes(document.body).decode())
+
+
+@override_settings(
+    CUSTOMER_CACHE_REDIS_URL="redis://127.0.0.1:1/0", CUSTOMER_LOCAL_CACHE_ENABLED=False
+)
+class CustomerResponseCacheTests(TestCase):
+    def test_unreachable_cache_falls_back_to_the_database(self):
+        customer = Customer.objects.create(did_number="800", name="Cabinet")
+        build_tree(customer, 2)
+        refresh_customer_document("800")
+        cache = CustomerResponseCache()
+        with mock.patch("actionapi.views.customer_response_cache", cache):
+            with self.assertLogs("actionapi.utils.response_cache", "WARNING"):
+                first = APIClient().get("/api/customers/800/")
+            # The cache is now bypassed without trying Redis again
+            with self.assertNoLogs("actionapi.utils.response_cache", "WARNING"):
+                second = APIClient().get("/api/customers/800/")
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(
+            first.content, bytes(CustomerDocument.objects.get(pk="800").body)
+        )
+
+
+
+@skipIf(fakeredis is None, "fakeredis is not installed")
+@override_settings(CUSTOMER_CACHE_ENABLED=True, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerDeletionTests(FakeRedisTestCase):
+    def setUp(self):
+        super().setUp()
+        cache = CustomerResponseCache()
+        for module in ("views", "utils.response_cache"):
+            patcher = mock.patch(f"actionapi.{module}.customer_response_cache", cache)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create(self, name):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = APIClient().post(
+                "/api/customers/",
+                {"did_number": "190", "name": name, "demand_titles": []},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 201)
+
+    def cache_keys(self):
+        keys = self.redis.scan_iter("customer-cache:*:190*")
+        return sorted(key.decode() for key in keys)
+
+    def test_delete_drops_the_cached_bodies(self):
+        self.create("First")
+        first = APIClient().get("/api/customers/190/")
+        self.assertEqual(APIClient().get("/api/customers/190/").content, first.content)
+        self.assertEqual(len(self.cache_keys()), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = APIClient().delete("/api/customers/190/")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.cache_keys(), [])
+        self.assertEqual(APIClient().get("/api/customers/190/").status_code, 404)
+
+    def test_recreated_customer_never_matches_the_old_one(self):
+        self.create("First")
+        first = APIClient().get("/api/customers/190/")
+        APIClient().get("/api/customers/190/")
+        # Deleted without the cache hearing of it (e.g. Redis was unreachable)
+        Customer.objects.filter(pk="190").delete()
+        self.create("Second")
+
+        second = APIClient().get("/api/customers/190/")
+        self.assertEqual(second.json()["name"], "Second")
+        self.assertNotEqual(second["ETag"], first["ETag"])
+        not_modified = APIClient().get(
+            "/api/customers/190/", HTTP_IF_NONE_MATCH=first["ETag"]
+        )
+        self.assertEqual(not_modified.status_code, 200)
+
+    def test_admin_delete_notifies(self):
+        for did_number in ("191", "192"):
+            Customer.objects.create(did_number=did_number)
+        receiver = mock.Mock()
+        customer_deleted.connect(receiver)
+        self.addCleanup(customer_deleted.disconnect, receiver)
+        request = RequestFactory().post("/admin/")
+        with self.captureOnCommitCallbacks(execute=True):
+            CustomerAdmin(Customer, admin.site).delete_queryset(
+                request, Customer.objects.filter(pk__in=["191", "192"])
+            )
+        self.assertEqual(
+            sorted(c.kwargs["did_number"] for c in receiver.call_args_list),
+            ["191", "192"],
+        )
+
+def _subscribed(cache):
+    """Stands in for a live invalidation subscription."""
+    cache._listening = True
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=True)
+class LocalCustomerCacheTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(LocalCustomerCache, "_listen", _subscribed)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = LocalCustomerCache()
+        self.cache.get("900")
+
+    def test_invalidation_evicts_the_body(self):
+        entry = CachedBody(1, 0, b"{}")
+        self.cache.set("900", entry, self.cache.generation("900"))
+        self.assertEqual(self.cache.get("900"), entry)
+        self.cache.invalidate("900")
+        self.assertIsNone(self.cache.get("900"))
+
+    def test_body_read_before_an_invalidation_is_not_cached(self):
+        generation = self.cache.generation("900")
+        self.cache.invalidate("900")
+        self.cache.set("900", CachedBody(1, 0, b"stale"), generation)
+        self.assertIsNone(self.cache.get("900"))
+
+    def test_deleted_customer_is_evicted_everywhere(self):
+        Customer.objects.create(did_number="900")
+        self.cache.set("900", CachedBody(1, 0, b"{}"), self.cache.generation("900"))
+        publisher = mock.Mock()
+        with mock.patch(
+            "actionapi.utils.local_cache.local_customer_cache", self.cache
+        ), mock.patch("actionapi.utils.local_cache._publisher", publisher):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = APIClient().delete("/api/customers/900/")
+        self.assertEqual(response.status_code, 204)
+        self.assertIsNone(self.cache.get("900"))
+        publisher.publish.assert_called_once_with(INVALIDATION_CHANNEL, "900")
+
+    @override_settings(CUSTOMER_LOCAL_CACHE_MAX_BYTES=10)
+    def test_cache_is_bounded_in_bytes(self):
+        cache = LocalCustomerCache()
+        cache.get("900")
+        cache.set("900", CachedBody(1, 0, b"123456"), cache.generation("900"))
+        cache.set("901", CachedBody(1, 0, b"123456"), cache.generation("901"))
+        self.assertIsNone(cache.get("900"))
+        self.assertEqual(cache.get("901").body, b"123456")
+        cache.set("902", CachedBody(1, 0, b"12345678901"), cache.generation("902"))
+        self.assertIsNone(cache.get("902"))
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerConditionalRetrieveTests(TestCase):
+    def test_matching_etag_is_answered_before_any_tree_query(self):
+        build_tree(Customer.objects.create(did_number="1000"), 3)
+        response = APIClient().get("/api/customers/1000/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Last-Modified", response)
+        # No document yet: the document lookup and the customer, no tree query
+        with self.assertNumQueries(2):
+            not_modified = APIClient().get(
+                "/api/customers/1000/", HTTP_IF_NONE_MATCH=response["ETag"]
+            )
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified["ETag"], response["ETag"])
+        self.assertEqual(not_modified.content, b"")
+
+    def test_document_and_tree_paths_agree_on_the_etag(self):
+        build_tree(Customer.objects.create(did_number="1100"), 2)
+        from_tree = APIClient().get("/api/customers/1100/")
+        refresh_customer_document("1100")
+        from_document = APIClient().get("/api/customers/1100/")
+        self.assertEqual(from_tree["ETag"], from_document["ETag"])
+        self.assertEqual(from_tree["Last-Modified"], from_document["Last-Modified"])
+        self.assertEqual(
+            APIClient()
+            .get("/api/customers/1100/", HTTP_IF_NONE_MATCH=from_tree["ETag"])
+            .status_code,
+            304,
+        )
+
+    def test_change_invalidates_the_etag(self):
+        build_tree(Customer.objects.create(did_number="1200"), 2)
+        etag = APIClient().get("/api/customers/1200/")["ETag"]
+        notify_customer_changed("1200")
+        response = APIClient().get("/api/customers/1200/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+
+def expand_indexed(indexed):
+    """Rebuilds the nested layout from the indexed one, as a client would."""
+
+    def nodes(level, rows):
+        expanded = []
+        for row in rows:
+            node = {}
+            for name, value in zip(indexed["schema"][level], row):
+                if isinstance(value, list):
+                    value = nodes(name, value)
+                elif value is not None:
+                    value = indexed["strings"][value]
+                node[name] = value
+            expanded.append(node)
+        return expanded
+
+    nested = {k: v for k, v in indexed.items() if k not in ("schema", "strings")}
+    nested["demand_titles"] = nodes("demand_titles", indexed["demand_titles"])
+    return nested
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerEncodingTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(did_number="1300", name="Cabinet")
+        build_tree(self.customer, 3)
+        Action.objects.create(patient_type=PatientType.objects.first(), description=None)
+        self.nested = APIClient().get("/api/customers/1300/").json()
+
+    def test_indexed_layout_holds_the_same_tree(self):
+        response = APIClient().get("/api/customers/1300/?layout=indexed")
+        self.assertEqual(response.status_code, 200)
+        indexed = response.json()
+        self.assertEqual(expand_indexed(indexed), self.nested)
+        # Every text is sent once
+        self.assertEqual(len(indexed["strings"]), len(set(indexed["strings"])))
+        nested_etag = APIClient().get("/api/customers/1300/")["ETag"]
+        self.assertNotEqual(response["ETag"], nested_etag)
+
+    def test_list_supports_the_indexed_layout(self):
+        fields = ",".join(self.nested)
+        response = APIClient().get(f"/api/customers/?layout=indexed&fields={fields}")
+        self.assertEqual(
+            [expand_indexed(c) for c in response.json()["results"]], [self.nested]
+        )
+
+    def test_unknown_layout_is_rejected(self):
+        response = APIClient().get("/api/customers/1300/?layout=flat")
+        self.assertEqual(response.status_code, 400)
+
+    def test_messagepack_is_negotiated(self):
+        response = APIClient().get(
+            "/api/customers/1300/", HTTP_ACCEPT="application/msgpack"
+        )
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(response.content), self.nested)
+
+    def test_json_is_gzipped_when_accepted(self):
+        response = APIClient().get("/api/customers/1300/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertTrue(response["ETag"].startswith('W/"'))
+        body = customer_tree_representation(self.customer)
+        self.assertEqual(JSONRenderer().render(body), gzip.decompress(response.content))
+
+    def test_json_prefers_brotli(self):
+        response = APIClient().get(
+            "/api/customers/1300/", HTTP_ACCEPT_ENCODING="gzip, deflate, br"
+        )
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertEqual(
+            brotli.decompress(response.content),
+            APIClient().get("/api/customers/1300/").content,
+        )
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerListTests(TestCase):
+    def setUp(self):
+        for did_number in ("1401", "1402", "1403"):
+            customer = Customer.objects.create(did_number=did_number, filetitle="F")
+            build_tree(customer, 2)
+            notify_customer_changed(did_number)
+
+    def test_list_returns_precomputed_summaries_with_one_query(self):
+        with self.assertNumQueries(1):
+            response = APIClient().get("/api/customers/")
+        first = response.json()["results"][0]
+        self.assertEqual(
+            first,
+            {
+                "did_number": "1401",
+                "name": None,
+                "filetitle": "F",
+                "demand_title_count": 2,
+                "demand_count": 4,
+                "patient_type_count": 8,
+                "action_count": 16,
+            },
+        )
+
+    def test_list_is_cursor_paginated(self):
+        client = APIClient()
+        url, seen = "/api/customers/?page_size=2", []
+        while url:
+            page = client.get(url).json()
+            seen += [customer["did_number"] for customer in page["results"]]
+            url = page["next"]
+        self.assertEqual(seen, ["1401", "1402", "1403"])
+
+    def test_fields_and_expand_select_the_data(self):
+        response = APIClient().get(
+            "/api/customers/?fields=did_number&expand=demand_titles"
+        )
+        first = response.json()["results"][0]
+        self.assertEqual(list(first), ["did_number", "demand_titles"])
+        self.assertEqual(len(first["demand_titles"]), 2)
+        self.assertEqual(
+            APIClient().get("/api/customers/?fields=sheet_hash").status_code, 400
+        )
+        self.assertEqual(
+            APIClient().get("/api/customers/?expand=notes").status_code, 400
+        )
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerDrillDownTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(did_number="1500", active_version=2)
+        build_tree(self.customer, 1, version=1)
+        build_tree(self.customer, 3, version=2)
+        self.client = APIClient()
+
+    def get(self, path, **headers):
+        # The parent lookup, then the level itself
+        with self.assertNumQueries(2):
+            response = self.client.get(f"/api/customers/1500/{path}/", **headers)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_drill_down_one_level_at_a_time(self):
+        titles = self.get("demand-titles").json()
+        self.assertEqual(len(titles), 3)
+        self.assertEqual(titles[0]["demand_count"], 3)
+        demands = self.get(f"demand-titles/{titles[0]['id']}/demands").json()
+        self.assertEqual(
+            [demand["name"] for demand in demands], ["Demand 0", "Demand 1", "Demand 2"]
+        )
+        self.assertEqual(demands[0]["patient_type_count"], 3)
+        patient_types = self.get(f"demands/{demands[0]['id']}/patient-types").json()
+        self.assertEqual(patient_types[0]["action_count"], 3)
+        actions = self.get(f"patient-types/{patient_types[0]['id']}/actions").json()
+        self.assertEqual(
+            actions[0],
+            {"id": actions[0]["id"], "description": "Action 0", "dire_text": None},
+        )
+
+    def test_nodes_outside_the_active_tree_are_not_found(self):
+        stale_title = DemandTitle.objects.get(customer=self.customer, version=1)
+        response = self.client.get(
+            f"/api/customers/1500/demand-titles/{stale_title.id}/demands/"
+        )
+        self.assertEqual(response.status_code, 404)
+        other = Customer.objects.create(did_number="1501")
+        build_tree(other, 1)
+        title = DemandTitle.objects.get(customer=other)
+        response = self.client.get(
+            f"/api/customers/1500/demand-titles/{title.id}/demands/"
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(
+            self.client.get("/api/customers/1502/demand-titles/").status_code, 404
+        )
+
+    def test_levels_answer_conditional_requests_without_reading_the_level(self):
+        etag = self.get("demand-titles")["ETag"]
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                "/api/customers/1500/demand-titles/", HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+
+
+SEARCH_SHEET = [
+    ["Cabinet Zoé", "", "", "", ""],
+    ["Titre", "Demande", "Patient", "Action", "Dire"],
+    ["Urgences", "Rendez-vous urgent", "Nouveau patient", "Orienter vers le 15", ""],
+    [
+        "Urgences",
+        "Rendez-vous urgent",
+        "Patient suivi",
+        "Proposer un créneau",
+        "Dire: rappeler",
+    ],
+    ["Consultations", "Renouvellement", "Patient suivi", "Envoyer l'ordonnance", ""],
+]
+
+
+@override_settings(CUSTOMER_CACHE_ENABLED=False, CUSTOMER_LOCAL_CACHE_ENABLED=False)
+class CustomerSearchTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.create(did_number="1600")
+
+    def sync(self, values, mode=SYNC_MODE_INCREMENTAL):
+        return apply_parsed_sheet(
+            self.customer, False, "Sheet", str(values), parse_sheet_values(values), mode
+        )
+
+    def search(self, q):
+        response = APIClient().get("/api/customers/1600/search/", {"q": q})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_search_ranks_nodes_with_their_ancestor_path(self):
+        self.sync(SEARCH_SHEET)
+        results = self.search("patient suivi")
+        self.assertEqual(
+            [(r["kind"], r["path"]) for r in results],
+            [
+                ("patient_type", ["Urgences", "Rendez-vous urgent"]),
+                ("patient_type", ["Consultations", "Renouvellement"]),
+            ],
+        )
+        # Word prefixes, accents and the dire text all match
+        action = self.search("creneau rappel")[0]
+        self.assertEqual(action["kind"], "action")
+        self.assertEqual(
+            action["path"], ["Urgences", "Rendez-vous urgent", "Patient suivi"]
+        )
+        self.assertEqual(
+            action["id"], Action.objects.get(description="Proposer un créneau").id
+        )
+        self.assertEqual(self.search("inconnu"), [])
+
+    def test_sync_only_rewrites_changed_entries(self):
+        self.sync(SEARCH_SHEET)
+        entry_ids = set(self.customer.search_entries.values_list("id", flat=True))
+        edited = [row[:] for row in SEARCH_SHEET]
+        edited[4][3] = "Faxer l'ordonnance"
+        self.sync(edited)
+        new_ids = set(self.customer.search_entries.values_list("id", flat=True))
+        self.assertEqual(len(entry_ids - new_ids), 1)
+        self.assertEqual(len(new_ids - entry_ids), 1)
+        self.assertEqual(self.search("envoyer"), [])
+        self.assertEqual(len(self.search("faxer")), 1)
+
+    def test_full_rebuild_repoints_the_entries(self):
+        self.sync(SEARCH_SHEET, mode=SYNC_MODE_REPLACE)
+        entries = set(self.customer.search_entries.values_list("id", "text"))
+        self.sync(SEARCH_SHEET, mode=SYNC_MODE_REPLACE)
+        self.assertEqual(
+            set(self.customer.search_entries.values_list("id", "text")), entries
+        )
+        self.assertEqual(
+            refresh_customer_search_index("1600"),
+            {"added": 0, "updated": 0, "removed": 0},
+        )
+        active_ids = set(
+            Action.objects.filter(
+                patient_type__demand__demand_title__version=F(
+                    "patient_type__demand__demand_title__customer__active_version"
+                )
+            ).values_list("id", flat=True)
+        )
+        self.assertEqual(
+            set(
+                self.customer.search_entries.filter(kind="action").values_list(
+                    "node_id", flat=True
+                )
+            ),
+            active_ids,
+        )
+        self.assertIn(self.search("orienter")[0]["id"], active_ids)
+
+    def test_swapped_texts_are_reindexed(self):
+        rows = [
+            ["Urgences", "Rendez-vous", "Patient", "Orienter", ""],
+            ["Urgences", "Rendez-vous", "Patient", "Rappeler", ""],
+        ]
+        self.sync(SEARCH_SHEET[:2] + rows)
+        self.sync(SEARCH_SHEET[:2] + rows[::-1])
+        actions = dict(Action.objects.values_list("description", "id"))
+        self.assertEqual(self.search("orienter")[0]["id"], actions["Orienter"])
+        self.assertEqual(self.search("rappeler")[0]["id"], actions["Rappeler"])
+        self.assertEqual(self.customer.search_entries.count(), 4)
+
+    def test_admin_edits_are_reindexed(self):
+        self.sync(SEARCH_SHEET)
+        demand = Demand.objects.get(name="Renouvellement")
+        demand.name = "Prolongation"
+        DemandAdmin(Demand, admin.site).save_model(
+            RequestFactory().post("/admin/"), demand, None, True
+        )
+        self.assertEqual(self.search("renouvellement"), [])
+        self.assertEqual(
+            [(r["kind"], r["path"]) for r in self.search("prolongation")],
+            [("demand", ["Consultations"])],
+        )
+        self.assertEqual(
+            self.search("ordonnance")[0]["path"],
+            ["Consultations", "Prolongation", "Patient suivi"],
+        )
+
+    def test_full_rebuild_reindexes_the_new_tree(self):
+        self.sync(SEARCH_SHEET, mode=SYNC_MODE_REPLACE)
+        self.sync(SEARCH_SHEET[:3], mode=SYNC_MODE_REPLACE)
+        self.assertEqual(self.search("suivi"), [])
+        self.assertEqual(
+            self.search("orienter")[0]["id"],
+            Action.objects.get(
+                description="Orienter vers le 15",
+                patient_type__demand__demand_title__version=F(
+                    "patient_type__demand__demand_title__customer__active_version"
+                ),
+            ).id,
+        )
+
+    def test_search_requires_a_query(self):
+        self.assertEqual(
+            APIClient().get("/api/customers/1600/search/").status_code, 400
+        )
+        self.assertEqual(
+            APIClient().get("/api/customers/1601/search/?q=x").status_code, 404
+        )
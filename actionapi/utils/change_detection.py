@@ -0,0 +1,191 @@
+# actionapi/utils/change_detection.py
+import json
+import logging
+import uuid
+from datetime import datetime
+
+import gspread
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from ..models import Customer
+from .google_client import get_sheets_client
+from .rate_limiter import sheets_rate_limiter
+
+logger = logging.getLogger(__name__)
+
+DRIVE_BATCH_URL = "https://www.googleapis.com/batch/drive/v3"
+# Google caps a batch request at 100 calls
+DRIVE_BATCH_SIZE = 100
+
+
+def sheet_id_from_url(sheet_url):
+    """Extracts the spreadsheet ID from a docs.google.com URL."""
+    return sheet_url.split("/d/")[1].split("/")[0]
+
+
+def parse_modified_time(value):
+    """Parses an RFC 3339 modifiedTime ("2025-05-20T16:48:00.000Z")."""
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class DriveMetadataTransport:
+    """
+    Reads files' modifiedTime from the Drive v3 API, packing up to
+    DRIVE_BATCH_SIZE files.get calls into one multipart/mixed batch request.
+    Each batch goes through the shared Sheets rate limiter.
+    """
+
+    def __init__(self, client=None):
+        self.client = client or get_sheets_client()
+
+    def fetch_modified_times(self, sheet_ids):
+        modified_times = {}
+        sheet_ids = list(dict.fromkeys(sheet_ids))
+        for start in range(0, len(sheet_ids), DRIVE_BATCH_SIZE):
+            batch = sheet_ids[start : start + DRIVE_BATCH_SIZE]
+            response, _ = sheets_rate_limiter.call(self._post_batch, batch)
+            modified_times.update(self._parse_batch(response))
+        return modified_times
+
+    def _post_batch(self, sheet_ids):
+        boundary = f"batch_{uuid.uuid4().hex}"
+        parts = [
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <{sheet_id}>\r\n\r\n"
+            f"GET /drive/v3/files/{sheet_id}?fields=modifiedTime&supportsAllDrives=true\r\n\r\n"
+            for sheet_id in sheet_ids
+        ]
+        body = "".join(parts) + f"--{boundary}--\r\n"
+        response = self.client.http_client.session.post(
+            DRIVE_BATCH_URL,
+            data=body.encode("utf-8"),
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+            timeout=self.client.http_client.timeout,
+        )
+        if not response.ok:
+            raise gspread.exceptions.APIError(response)
+        return response
+
+    @staticmethod
+    def _parse_batch(response):
+        """
+        Splits a batch response into its parts. Each part carries the
+        Content-ID of its request ("<response-SHEET_ID>"), an HTTP status line
+        and a JSON body. Failed lookups are left out of the result.
+        """
+        content_type = response.headers.get("Content-Type", "")
+        boundary = content_type.split("boundary=")[-1].strip('"')
+        modified_times = {}
+        for part in response.text.split(f"--{boundary}"):
+            if "Content-ID:" not in part:
+                continue
+            content_id = part.split("Content-ID:", 1)[1].split("\n", 1)[0].strip()
+            sheet_id = content_id.strip("<>").removeprefix("response-")
+            status_line = part[part.find("HTTP/") :].split("\n", 1)[0]
+            if " 200 " not in f"{status_line} ":
+                logger.warning(
+                    f"Drive metadata lookup failed for {sheet_id}: {status_line.strip()}"
+                )
+                continue
+            payload = json.loads(part[part.find("{") : part.rfind("}") + 1])
+            modified_times[sheet_id] = parse_modified_time(payload["modifiedTime"])
+        return modified_times
+
+
+class FakeDriveTransport:
+    """
+    Offline stand-in for DriveMetadataTransport (tests, local development).
+    Serves modified times from `modified_times`, or from the class-level
+    dict when none is given; unknown sheets are reported as missing.
+    """
+
+    modified_times = {}
+
+    def __init__(self, modified_times=None):
+        if modified_times is not None:
+            self.modified_times = modified_times
+
+    def fetch_modified_times(self, sheet_ids):
+        return {
+            sheet_id: self.modified_times[sheet_id]
+            for sheet_id in sheet_ids
+            if sheet_id in self.modified_times
+        }
+
+
+def get_change_transport():
+    """Instantiates the transport named by settings.SHEET_CHANGE_TRANSPORT."""
+    return import_string(settings.SHEET_CHANGE_TRANSPORT)()
+
+
+def select_customers_to_sync(customers, force=False, transport=None):
+    """
+    Pre-pass of the nightly sync: looks up every customer's spreadsheet
+    modifiedTime in a few batched metadata calls and keeps only the
+    customers whose sheet changed since the last successful sync.
+    Customers whose modifiedTime is unknown are kept, and so is everyone
+    when `force` is set or the lookup itself fails.
+    Returns (to_sync, skipped, modified_times) where modified_times maps
+    did_number to the observed modifiedTime (or None).
+    """
+    customers = list(customers)
+    sheet_ids = {}
+    for customer in customers:
+        try:
+            sheet_ids[customer.did_number] = sheet_id_from_url(customer.sheet_url)
+        except (AttributeError, IndexError):
+            sheet_ids[customer.did_number] = None
+
+    try:
+        transport = transport or get_change_transport()
+        by_sheet = transport.fetch_modified_times(
+            [sheet_id for sheet_id in sheet_ids.values() if sheet_id]
+        )
+    except Exception as e:
+        logger.warning(f"Sheet change detection failed, syncing everyone: {e}")
+        by_sheet = {}
+        force = True
+
+    modified_times = {
+        did: by_sheet.get(sheet_id) for did, sheet_id in sheet_ids.items()
+    }
+    to_sync = []
+    skipped = []
+    for customer in customers:
+        modified = modified_times[customer.did_number]
+        if (
+            force
+            or modified is None
+            or customer.sheet_modified_time is None
+            or modified > customer.sheet_modified_time
+        ):
+            to_sync.append(customer)
+        else:
+            skipped.append(customer)
+    return to_sync, skipped, modified_times
+
+
+def mark_customer_synced(did_number, modified_time=None):
+    """
+    Records a successful sync, together with the modifiedTime observed by
+    the pre-pass (if any), so the next run can skip an unedited sheet.
+    """
+    fields = {"last_synced_at": timezone.now()}
+    if modified_time is not None:
+        fields["sheet_modified_time"] = modified_time
+    Customer.objects.filter(did_number=did_number).update(**fields)
+
+
+def mark_customer_edited(did_number):
+    """
+    Records that the customer's tree or sheet-derived fields were written
+    outside a sheet sync (admin, API): forgets the sheet hash and the
+    modifiedTime of the last sync, so the next sync restores the sheet's
+    data instead of finding the sheet unchanged.
+    """
+    Customer.objects.filter(did_number=did_number).update(
+        sheet_hash="", sheet_modified_time=None
+    )
@@ -0,0 +1,52 @@
+# actionapi/utils/documents.py
+import logging
+
+from django.db import IntegrityError
+from django.dispatch import receiver
+from rest_framework.renderers import JSONRenderer
+
+from ..models import Customer, CustomerDocument
+from ..serializers import customer_tree_representation
+from ..signals import customer_tree_changed
+
+logger = logging.getLogger(__name__)
+
+
+def render_customer_document(customer):
+    """The customer's API representation, rendered exactly like retrieve does."""
+    return JSONRenderer().render(customer_tree_representation(customer))
+
+
+def refresh_customer_document(did_number):
+    """
+    Re-renders and stores the customer's CustomerDocument. A document built
+    from an older content_version never overwrites a newer one. Returns the
+    document, or None if the customer no longer exists.
+    """
+    customer = Customer.objects.filter(pk=did_number).first()
+    if customer is None:
+        return None
+    body = render_customer_document(customer)
+    fields = {"body": body, "size": len(body), "version": customer.content_version}
+    updated = CustomerDocument.objects.filter(
+        customer=customer, version__lte=customer.content_version
+    ).update(**fields)
+    if not updated and not CustomerDocument.objects.filter(customer=customer).exists():
+        try:
+            CustomerDocument.objects.create(customer=customer, **fields)
+        except IntegrityError:
+            # Built concurrently by another process; theirs is at least as new
+            pass
+    return CustomerDocument(customer=customer, **fields)
+
+
+@receiver(customer_tree_changed)
+def refresh_document_on_change(sender, did_number, **kwargs):
+    try:
+        refresh_customer_document(did_number)
+    except Exception as e:
+        # Reads fall back to the relational tables; the rebuild command fixes it
+        logger.error(
+            f"Could not refresh the document of customer {did_number}: {e}",
+            exc_info=True,
+        )
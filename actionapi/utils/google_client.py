@@ -0,0 +1,87 @@
+# actionapi/utils/google_client.py
+import os
+import threading
+from pathlib import Path
+
+import gspread
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+GOOGLE_SHEET_CREDENTIALS_FILE = BASE_DIR / "utils" / "urlvalidate.json"
+GOOGLE_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    # modifiedTime lookups for change detection
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+]
+
+# Keep-alive connections kept per host by the shared session
+HTTP_POOL_MAXSIZE = 10
+# (connect, read) timeout in seconds for every Google API call
+HTTP_TIMEOUT = (10, 120)
+
+_client_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+
+def _build_client():
+    """
+    Loads the service account credentials once and wraps them in a gspread
+    client whose AuthorizedSession pools keep-alive connections. The session
+    refreshes the OAuth token itself, only when it is close to expiry.
+    """
+    creds = Credentials.from_service_account_file(
+        GOOGLE_SHEET_CREDENTIALS_FILE, scopes=GOOGLE_SCOPES
+    )
+    client = gspread.authorize(creds)
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_MAXSIZE, pool_maxsize=HTTP_POOL_MAXSIZE
+    )
+    client.http_client.session.mount("https://", adapter)
+    client.set_timeout(HTTP_TIMEOUT)
+    print("✅ Google Sheets client authorized.")
+    return client
+
+
+def get_sheets_client():
+    """
+    Returns the process-wide gspread client, building it on first use.
+    A client inherited through fork() is never reused: the pid check makes
+    the first call in a new gunicorn/Celery worker build its own client.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = _build_client()
+                _client_pid = pid
+    return _client
+
+
+def reset_sheets_client():
+    """
+    Closes and drops the cached client so the next get_sheets_client()
+    builds a new one (e.g. after rotating the service account key).
+    """
+    global _client, _client_pid
+    with _client_lock:
+        client, _client, _client_pid = _client, None, None
+    if client is not None:
+        client.http_client.session.close()
+
+
+def _reset_after_fork():
+    """
+    Forgets the parent's client in a forked child without closing it: the
+    pooled sockets are still shared with the parent process.
+    """
+    global _client, _client_pid, _client_lock
+    # The lock may have been held by another thread at fork time
+    _client_lock = threading.Lock()
+    _client, _client_pid = None, None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,140 @@
+# actionapi/utils/local_cache.py
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+import redis
+from cachetools import TTLCache
+from django.conf import settings
+from django.dispatch import receiver
+
+from ..signals import customer_deleted, customer_tree_changed
+
+logger = logging.getLogger(__name__)
+
+# Sync code publishes a DID here whenever that customer's data changes
+INVALIDATION_CHANNEL = "customer-cache:invalidate"
+
+
+class LocalCustomerCache:
+    """
+    Per-process LRU of CachedBody entries, bounded in body bytes
+    (CUSTOMER_LOCAL_CACHE_MAX_BYTES) and in age (CUSTOMER_LOCAL_CACHE_TTL).
+    A daemon thread subscribed to INVALIDATION_CHANNEL evicts a DID as soon
+    as any process publishes it. Bodies are only cached while that
+    subscription is up, and the whole cache is dropped when it breaks, so
+    a missed message cannot leave a stale body behind; the TTL is a last
+    safety net.
+    """
+
+    reconnect_delay = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = None
+        # Bumped on every eviction of a DID, so a body read before an
+        # invalidation is not stored after it
+        self._generations = defaultdict(int)
+        self._pid = None
+        self._listening = False
+
+    def _ensure_started(self):
+        """(Re)starts the cache and its subscriber in this process (e.g. after a fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._cache = TTLCache(
+                maxsize=settings.CUSTOMER_LOCAL_CACHE_MAX_BYTES,
+                ttl=settings.CUSTOMER_LOCAL_CACHE_TTL,
+                getsizeof=lambda entry: len(entry.body),
+            )
+            self._generations.clear()
+            self._listening = False
+            self._pid = os.getpid()
+            threading.Thread(
+                target=self._listen, name="customer-cache-invalidation", daemon=True
+            ).start()
+
+    def _listen(self):
+        while True:
+            try:
+                client = redis.Redis.from_url(
+                    settings.CUSTOMER_CACHE_REDIS_URL, socket_keepalive=True
+                )
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                self._listening = True
+                for message in pubsub.listen():
+                    self.invalidate(message["data"].decode())
+            except redis.RedisError as e:
+                logger.warning(
+                    f"Customer cache invalidation channel lost, retrying in "
+                    f"{self.reconnect_delay}s: {e}"
+                )
+            finally:
+                self._listening = False
+                self.clear()
+            time.sleep(self.reconnect_delay)
+
+    def get(self, did_number):
+        if not settings.CUSTOMER_LOCAL_CACHE_ENABLED:
+            return None
+        self._ensure_started()
+        with self._lock:
+            return self._cache.get(did_number)
+
+    def generation(self, did_number):
+        """Token to pass to set() for an entry about to be read elsewhere."""
+        with self._lock:
+            return self._generations[did_number]
+
+    def set(self, did_number, entry, generation):
+        if not settings.CUSTOMER_LOCAL_CACHE_ENABLED or not self._listening:
+            return
+        with self._lock:
+            if self._generations[did_number] != generation:
+                return
+            if len(entry.body) <= self._cache.maxsize:
+                self._cache[did_number] = entry
+
+    def invalidate(self, did_number):
+        with self._lock:
+            self._generations[did_number] += 1
+            if self._cache is not None:
+                self._cache.pop(did_number, None)
+
+    def clear(self):
+        with self._lock:
+            for did_number in self._generations:
+                self._generations[did_number] += 1
+            if self._cache is not None:
+                self._cache.clear()
+
+
+local_customer_cache = LocalCustomerCache()
+
+_publisher = None
+
+
+@receiver(customer_tree_changed)
+@receiver(customer_deleted)
+def publish_invalidation_on_change(sender, did_number, **kwargs):
+    global _publisher
+    local_customer_cache.invalidate(did_number)
+    if not settings.CUSTOMER_LOCAL_CACHE_ENABLED:
+        return
+    try:
+        if _publisher is None:
+            _publisher = redis.Redis.from_url(
+                settings.CUSTOMER_CACHE_REDIS_URL,
+                socket_timeout=settings.CUSTOMER_CACHE_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.CUSTOMER_CACHE_SOCKET_TIMEOUT,
+            )
+        _publisher.publish(INVALIDATION_CHANNEL, did_number)
+    except redis.RedisError as e:
+        # Subscribers that missed it rely on CUSTOMER_LOCAL_CACHE_TTL
+        logger.warning(f"Could not publish invalidation of customer {did_number}: {e}")
@@ -0,0 +1,176 @@
+# actionapi/utils/rate_limiter.py
+import logging
+import time
+
+import gspread
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Token bucket shared by every process through one Redis hash.
+# Fields: tokens, ts (last refill, server time), rate (tokens/sec, adaptive).
+# Each call reserves one token (the balance may go negative) and returns how
+# long the caller must sleep before using it, so waiters are served in order.
+# The rate creeps back up towards max_rate as time passes after a 429.
+_ACQUIRE_SCRIPT = """
+local max_rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local recovery = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+local rate = tonumber(state[3]) or max_rate
+local elapsed = math.max(0, now - ts)
+rate = math.min(max_rate, rate + recovery * elapsed)
+tokens = math.min(capacity, tokens + rate * elapsed) - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 86400)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+# Multiplicative decrease after a 429, shared by everyone using the bucket.
+_PENALIZE_SCRIPT = """
+local min_rate = tonumber(ARGV[1])
+local max_rate = tonumber(ARGV[2])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or max_rate
+rate = math.max(min_rate, rate * tonumber(ARGV[3]))
+redis.call('HSET', KEYS[1], 'rate', rate)
+redis.call('HINCRBY', KEYS[1], 'throttled', 1)
+return tostring(rate)
+"""
+
+
+class SheetsRateLimiter:
+    """
+    Redis-backed token bucket for Google Sheets/Drive API calls.
+    Callers block until a token is available instead of failing; a 429 from
+    Google halves the shared rate (down to a floor) and the rate then climbs
+    back to the configured quota over SHEETS_RATE_LIMIT_RECOVERY_SECONDS.
+    If Redis is unreachable, calls go through unthrottled; after one failure
+    the limiter is bypassed for `retry_after` seconds so a dead Redis does not
+    cost a socket timeout per API call.
+    """
+
+    key = "sheets-quota:bucket"
+    backoff_factor = 0.5
+    max_throttled_attempts = 5
+    retry_after = 30
+
+    def __init__(self):
+        self._redis = None
+        self._acquire = None
+        self._penalize = None
+        self._disabled_until = 0.0
+
+    @property
+    def max_rate(self):
+        return settings.SHEETS_RATE_LIMIT_PER_MINUTE / 60
+
+    @property
+    def min_rate(self):
+        return settings.SHEETS_RATE_LIMIT_MIN_PER_MINUTE / 60
+
+    def _client(self):
+        if self._redis is None:
+            self._redis = redis.Redis.from_url(
+                settings.SHEETS_RATE_LIMIT_REDIS_URL,
+                socket_timeout=settings.SHEETS_RATE_LIMIT_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.SHEETS_RATE_LIMIT_SOCKET_TIMEOUT,
+            )
+            self._acquire = self._redis.register_script(_ACQUIRE_SCRIPT)
+            self._penalize = self._redis.register_script(_PENALIZE_SCRIPT)
+        return self._redis
+
+    def _available(self):
+        return time.monotonic() >= self._disabled_until
+
+    def _failed(self, e):
+        logger.warning(f"Sheets rate limiter unavailable, not throttling: {e}")
+        self._disabled_until = time.monotonic() + self.retry_after
+
+    def acquire(self):
+        """Blocks until a token is available. Returns the seconds waited."""
+        if not self._available():
+            return 0.0
+        try:
+            self._client()
+            recovery = (self.max_rate - self.min_rate) / max(
+                settings.SHEETS_RATE_LIMIT_RECOVERY_SECONDS, 1
+            )
+            wait = float(
+                self._acquire(
+                    keys=[self.key],
+                    args=[self.max_rate, settings.SHEETS_RATE_LIMIT_BURST, recovery],
+                )
+            )
+        except redis.RedisError as e:
+            self._failed(e)
+            return 0.0
+        if wait > 0:
+            time.sleep(wait)
+            try:
+                self._redis.hincrbyfloat(self.key, "waited", wait)
+            except redis.RedisError:
+                pass
+        return wait
+
+    def penalize(self):
+        """Lowers the shared rate after Google answered 429."""
+        if not self._available():
+            return
+        try:
+            self._client()
+            rate = float(
+                self._penalize(
+                    keys=[self.key],
+                    args=[self.min_rate, self.max_rate, self.backoff_factor],
+                )
+            )
+            logger.warning(
+                f"Sheets API returned 429, rate lowered to {rate * 60:.1f}/min."
+            )
+        except redis.RedisError as e:
+            self._failed(e)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) once a token is available, retrying it
+        after a 429 at the lowered rate. Returns (result, seconds_waited).
+        """
+        waited = 0.0
+        for attempt in range(1, self.max_throttled_attempts + 1):
+            waited += self.acquire()
+            try:
+                return func(*args, **kwargs), waited
+            except gspread.exceptions.APIError as e:
+                if (
+                    e.response.status_code != 429
+                    or attempt == self.max_throttled_attempts
+                ):
+                    raise
+                self.penalize()
+
+    def stats(self):
+        """Current shared rate and cumulative throttling, for tuning."""
+        try:
+            state = self._client().hgetall(self.key)
+        except redis.RedisError as e:
+            return {"available": False, "error": str(e)}
+        state = {k.decode(): float(v) for k, v in state.items()}
+        return {
+            "available": True,
+            "rate_per_minute": round(state.get("rate", self.max_rate) * 60, 2),
+            "max_rate_per_minute": settings.SHEETS_RATE_LIMIT_PER_MINUTE,
+            "tokens": round(state.get("tokens", settings.SHEETS_RATE_LIMIT_BURST), 2),
+            "total_wait_seconds": round(state.get("waited", 0.0), 2),
+            "throttled_responses": int(state.get("throttled", 0)),
+        }
+
+
+sheets_rate_limiter = SheetsRateLimiter()
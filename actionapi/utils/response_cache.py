@@ -0,0 +1,192 @@
+# actionapi/utils/response_cache.py
+import logging
+import time
+from collections import namedtuple
+
+import redis
+from django.conf import settings
+from django.dispatch import receiver
+
+from ..models import Customer
+from ..signals import customer_deleted, customer_tree_changed
+
+logger = logging.getLogger(__name__)
+
+# Per customer: a version key holding the current content_version, and one
+# entry hash (body, modified) per version. A change only bumps the version
+# key; entries cached under older versions are never read again and expire
+# on their own.
+VERSION_KEY = "customer-cache:version:{did_number}"
+ENTRY_KEY = "customer-cache:entry:{did_number}:{version}"
+STATS_KEY = "customer-cache:stats"
+
+# One round trip per read: resolve the version, read the entry, count it.
+# Returns {version or false, body or false, modified or false}.
+_GET_SCRIPT = """
+local version = redis.call('GET', KEYS[1])
+if not version then
+    redis.call('HINCRBY', KEYS[2], 'misses', 1)
+    return {false, false, false}
+end
+local entry = redis.call('HMGET', ARGV[1] .. version, 'body', 'modified')
+if entry[1] then
+    redis.call('HINCRBY', KEYS[2], 'hits', 1)
+    redis.call('HINCRBY', KEYS[2], 'bytes', string.len(entry[1]))
+else
+    redis.call('HINCRBY', KEYS[2], 'misses', 1)
+end
+return {version, entry[1], entry[2]}
+"""
+
+# Versions only move forward, even if notifications arrive out of order
+_SET_VERSION_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]))
+if current and current >= tonumber(ARGV[1]) then
+    return current
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return tonumber(ARGV[1])
+"""
+
+# A rendered retrieve body with what its validators are built from: the
+# content_version it was rendered at and Customer.tree_updated_at as a
+# Unix timestamp.
+CachedBody = namedtuple("CachedBody", ["version", "modified", "body"])
+
+
+class CustomerResponseCache:
+    """
+    Redis cache of rendered CustomerViewSet.retrieve bodies, keyed by DID and
+    Customer.content_version. Any Redis failure is logged and treated as a
+    miss; after one, the cache is bypassed for `retry_after` seconds so a
+    dead Redis costs nothing per request.
+    """
+
+    retry_after = 30
+
+    def __init__(self):
+        self._redis = None
+        self._get = None
+        self._set_version = None
+        self._disabled_until = 0.0
+
+    def _client(self):
+        if self._redis is None:
+            self._redis = redis.Redis.from_url(
+                settings.CUSTOMER_CACHE_REDIS_URL,
+                socket_timeout=settings.CUSTOMER_CACHE_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.CUSTOMER_CACHE_SOCKET_TIMEOUT,
+            )
+            self._get = self._redis.register_script(_GET_SCRIPT)
+            self._set_version = self._redis.register_script(_SET_VERSION_SCRIPT)
+        return self._redis
+
+    def _available(self):
+        return (
+            settings.CUSTOMER_CACHE_ENABLED
+            and time.monotonic() >= self._disabled_until
+        )
+
+    def _failed(self, e):
+        logger.warning(f"Customer response cache unavailable, reading from DB: {e}")
+        self._disabled_until = time.monotonic() + self.retry_after
+
+    def get(self, did_number):
+        """The CachedBody for the customer's current version, or None."""
+        if not self._available():
+            return None
+        try:
+            self._client()
+            version, body, modified = self._get(
+                keys=[VERSION_KEY.format(did_number=did_number), STATS_KEY],
+                args=[ENTRY_KEY.format(did_number=did_number, version="")],
+            )
+        except redis.RedisError as e:
+            self._failed(e)
+            return None
+        if not body:
+            return None
+        return CachedBody(int(version), int(modified), body)
+
+    def set(self, did_number, entry):
+        """Caches a CachedBody as the response for its content_version."""
+        if not self._available():
+            return
+        ttl = settings.CUSTOMER_CACHE_TTL
+        key = ENTRY_KEY.format(did_number=did_number, version=entry.version)
+        try:
+            client = self._client()
+            pipe = client.pipeline()
+            pipe.hset(key, mapping={"body": entry.body, "modified": entry.modified})
+            pipe.expire(key, ttl)
+            pipe.execute()
+            # Records the version if the key expired or was never set
+            self._set_version(
+                keys=[VERSION_KEY.format(did_number=did_number)],
+                args=[entry.version, ttl],
+            )
+        except redis.RedisError as e:
+            self._failed(e)
+
+    def bump(self, did_number, version):
+        """Makes `version` the customer's current one; older bodies stop being served."""
+        if not settings.CUSTOMER_CACHE_ENABLED:
+            return
+        try:
+            self._client()
+            self._set_version(
+                keys=[VERSION_KEY.format(did_number=did_number)],
+                args=[version, settings.CUSTOMER_CACHE_TTL],
+            )
+        except redis.RedisError as e:
+            self._failed(e)
+
+    def forget(self, did_number):
+        """Drops the customer's version key and every body cached for it."""
+        if not settings.CUSTOMER_CACHE_ENABLED:
+            return
+        try:
+            client = self._client()
+            keys = [VERSION_KEY.format(did_number=did_number)]
+            keys += client.scan_iter(
+                match=ENTRY_KEY.format(did_number=did_number, version="*")
+            )
+            client.delete(*keys)
+        except redis.RedisError as e:
+            self._failed(e)
+
+    def stats(self):
+        """Shared hit/miss/byte counters of every worker."""
+        try:
+            state = self._client().hgetall(STATS_KEY)
+        except redis.RedisError as e:
+            return {"available": False, "error": str(e)}
+        state = {k.decode(): int(v) for k, v in state.items()}
+        hits = state.get("hits", 0)
+        misses = state.get("misses", 0)
+        return {
+            "available": True,
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 3) if hits + misses else None,
+            "bytes_served": state.get("bytes", 0),
+        }
+
+
+customer_response_cache = CustomerResponseCache()
+
+
+@receiver(customer_tree_changed)
+def bump_cached_version_on_change(sender, did_number, **kwargs):
+    version = (
+        Customer.objects.filter(pk=did_number)
+        .values_list("content_version", flat=True)
+        .first()
+    )
+    if version is not None:
+        customer_response_cache.bump(did_number, version)
+
+
+@receiver(customer_deleted)
+def forget_cached_bodies_on_delete(sender, did_number, **kwargs):
+    customer_response_cache.forget(did_number)
@@ -0,0 +1,193 @@
+# actionapi/utils/search.py
+import re
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models import F
+
+from ..models import Action, CustomerSearchEntry, Demand, DemandTitle, PatientType
+
+SEARCH_ENTRY_BATCH_SIZE = 1000
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def _active_tree_entries(did_number):
+    """{(kind, node_id): (text, path)} for every searchable node of the active tree."""
+    active_titles = DemandTitle.objects.filter(
+        customer_id=did_number, version=F("customer__active_version")
+    )
+    titles = dict(active_titles.values_list("id", "title"))
+    entries = {}
+
+    demand_paths = {}
+    for demand_id, title_id, name in Demand.objects.filter(
+        demand_title__in=active_titles
+    ).values_list("id", "demand_title_id", "name"):
+        path = [titles[title_id]]
+        entries[(CustomerSearchEntry.KIND_DEMAND, demand_id)] = (name, path)
+        demand_paths[demand_id] = path + [name]
+
+    patient_type_paths = {}
+    for patient_type_id, demand_id, name in PatientType.objects.filter(
+        demand__demand_title__in=active_titles
+    ).values_list("id", "demand_id", "name"):
+        path = demand_paths[demand_id]
+        entries[(CustomerSearchEntry.KIND_PATIENT_TYPE, patient_type_id)] = (name, path)
+        patient_type_paths[patient_type_id] = path + [name]
+
+    for action_id, patient_type_id, description, dire_text in Action.objects.filter(
+        patient_type__demand__demand_title__in=active_titles
+    ).values_list("id", "patient_type_id", "description", "dire_text"):
+        text = "\n".join(part for part in (description, dire_text) if part)
+        if text:
+            entries[(CustomerSearchEntry.KIND_ACTION, action_id)] = (
+                text,
+                patient_type_paths[patient_type_id],
+            )
+    return entries
+
+
+def refresh_customer_search_index(did_number):
+    """
+    Brings the customer's CustomerSearchEntry rows in line with its active
+    tree, writing only what changed. Entries are matched to nodes on what
+    they hold (kind, ancestor path and text), not on node IDs: a full
+    rebuild gives every node a new ID, and re-pointing an entry's node_id
+    is one bulk UPDATE that leaves the full-text index alone (its SQLite
+    trigger only fires on text; on PostgreSQL the row's index entries are
+    still rewritten), instead of a delete and an insert per node. Entries
+    left without a node are deleted, nodes left without an entry get one.
+    Returns the number of entries added, re-pointed and removed.
+    """
+    wanted = defaultdict(list)
+    for (kind, node_id), (text, path) in _active_tree_entries(did_number).items():
+        wanted[(kind, text, tuple(path))].append(node_id)
+    existing = defaultdict(list)
+    for entry in CustomerSearchEntry.objects.filter(customer_id=did_number).only(
+        "id", "kind", "node_id", "text", "path"
+    ):
+        existing[(entry.kind, entry.text, tuple(entry.path))].append(entry)
+
+    stale = []
+    moved = []
+    missing = []
+    # Tree order first, so new entries are inserted (and rank ties broken) in it
+    for key in [*wanted, *(key for key in existing if key not in wanted)]:
+        node_ids = wanted.get(key, [])
+        entries = existing.get(key, [])
+        indexed_ids = {entry.node_id for entry in entries}
+        unindexed_ids = [node_id for node_id in node_ids if node_id not in indexed_ids]
+        wanted_ids = set(node_ids)
+        loose = [entry for entry in entries if entry.node_id not in wanted_ids]
+        moved += zip(loose, unindexed_ids)
+        stale += loose[len(unindexed_ids) :]
+        missing += [(key, node_id) for node_id in unindexed_ids[len(loose) :]]
+
+    # A node_id still held by another moved entry (nodes that swapped texts
+    # in an incremental sync) would break the unique constraint mid-UPDATE
+    held = {(entry.kind, entry.node_id) for entry, _ in moved}
+    repointed = []
+    for entry, node_id in moved:
+        if (entry.kind, node_id) in held:
+            stale.append(entry)
+            missing.append(((entry.kind, entry.text, tuple(entry.path)), node_id))
+        else:
+            entry.node_id = node_id
+            repointed.append(entry)
+
+    stale_ids = [entry.id for entry in stale]
+    for start in range(0, len(stale_ids), SEARCH_ENTRY_BATCH_SIZE):
+        CustomerSearchEntry.objects.filter(
+            id__in=stale_ids[start : start + SEARCH_ENTRY_BATCH_SIZE]
+        ).delete()
+    CustomerSearchEntry.objects.bulk_update(
+        repointed, ["node_id"], batch_size=SEARCH_ENTRY_BATCH_SIZE
+    )
+    added = CustomerSearchEntry.objects.bulk_create(
+        (
+            CustomerSearchEntry(
+                customer_id=did_number,
+                kind=kind,
+                node_id=node_id,
+                text=text,
+                path=list(path),
+            )
+            for (kind, text, path), node_id in missing
+        ),
+        batch_size=SEARCH_ENTRY_BATCH_SIZE,
+    )
+    return {"added": len(added), "updated": len(repointed), "removed": len(stale_ids)}
+
+
+def _sqlite_matches(did_number, tokens, limit):
+    # Prefix match on every word; bm25() is lower for better matches
+    match = " ".join(f'"{token}"*' for token in tokens)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT e.id, -bm25(actionapi_customersearchentry_fts)
+            FROM actionapi_customersearchentry_fts
+            JOIN actionapi_customersearchentry e
+                ON e.id = actionapi_customersearchentry_fts.rowid
+            WHERE actionapi_customersearchentry_fts MATCH %s AND e.customer_id = %s
+            ORDER BY bm25(actionapi_customersearchentry_fts), e.id
+            LIMIT %s
+            """,
+            [match, did_number, limit],
+        )
+        return cursor.fetchall()
+
+
+def _postgresql_matches(did_number, tokens, limit):
+    # Same expression as the GIN index of migration 0017
+    query = " & ".join(f"{token}:*" for token in tokens)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT id, ts_rank(to_tsvector('simple', text), query)
+            FROM actionapi_customersearchentry, to_tsquery('simple', %s) query
+            WHERE customer_id = %s AND to_tsvector('simple', text) @@ query
+            ORDER BY 2 DESC, id
+            LIMIT %s
+            """,
+            [query, did_number, limit],
+        )
+        return cursor.fetchall()
+
+
+def _unindexed_matches(did_number, tokens, limit):
+    entries = CustomerSearchEntry.objects.filter(customer_id=did_number)
+    for token in tokens:
+        entries = entries.filter(text__icontains=token)
+    entry_ids = entries.order_by("id").values_list("id", flat=True)[:limit]
+    return [(entry_id, 0.0) for entry_id in entry_ids]
+
+
+def search_customer_tree(did_number, query, limit):
+    """
+    Demands, patient types and actions of the customer's active tree whose
+    text contains every word of `query` (as a word prefix), best match
+    first, each with the names of its ancestors.
+    """
+    tokens = [token.lower() for token in _TOKEN_RE.findall(query)]
+    if not tokens:
+        return []
+    if connection.vendor == "sqlite":
+        matches = _sqlite_matches(did_number, tokens, limit)
+    elif connection.vendor == "postgresql":
+        matches = _postgresql_matches(did_number, tokens, limit)
+    else:
+        matches = _unindexed_matches(did_number, tokens, limit)
+
+    entries = CustomerSearchEntry.objects.in_bulk([entry_id for entry_id, _ in matches])
+    return [
+        {
+            "kind": entries[entry_id].kind,
+            "id": entries[entry_id].node_id,
+            "text": entries[entry_id].text,
+            "path": entries[entry_id].path,
+            "rank": round(rank, 4),
+        }
+        for entry_id, rank in matches
+    ]
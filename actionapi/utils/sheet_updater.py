@@ -1,229 +1,1109 @@
 # actionapi/utils/sheet_updater.py
+import hashlib
+import json
 import re
+import time
 import traceback  # Import traceback for better error logging
 from collections import defaultdict
-from pathlib import Path
 
 import gspread
+import requests
+from django.conf import settings
 from django.db import transaction
-from google.oauth2.service_account import Credentials
+from django.db.models import F
+from django.utils import timezone
 
-from ..models import Action, Demand, DemandTitle, PatientType
+from ..models import Action, Customer, Demand, DemandTitle, PatientType
+from ..signals import notify_customer_changed
+from .change_detection import select_customers_to_sync, sheet_id_from_url
+from .google_client import GOOGLE_SHEET_CREDENTIALS_FILE, get_sheets_client
+from .rate_limiter import sheets_rate_limiter
+from .search import refresh_customer_search_index
+from .snapshots import (
+    SnapshotEncoder,
+    encode_sheet_values,
+    save_sheet_snapshot,
+    touch_sheet_snapshot,
+)
 
-BASE_DIR = Path(__file__).resolve().parent.parent
-GOOGLE_SHEET_CREDENTIALS_FILE = BASE_DIR / "utils" / "urlvalidate.json"
+# Rows per INSERT statement when rebuilding a customer's tree
+BULK_CREATE_BATCH_SIZE = 1000
+# Rows per DELETE statement when garbage-collecting superseded tree versions
+TREE_GC_BATCH_SIZE = 1000
 
+# Worksheet holding the customer's tree
+DETAIL_WORKSHEET = "detail"
+# Columns used by a sync: title, demand, patient type, action, dire text
+# (row 1 holds name, address and the three notes in the same columns)
+DETAIL_COLUMN_COUNT = 5
+DETAIL_LAST_COLUMN = "E"
+# Field mask for the single spreadsheets.get call made per sync
+SHEET_FETCH_FIELDS = "properties.title,sheets.data.rowData.values.formattedValue"
+# Field mask for the layout lookup that starts a streaming sync
+SHEET_LAYOUT_FIELDS = "properties.title,sheets.properties.gridProperties.rowCount"
 
-def update_customer_from_sheet(customer, created):
+# Google API statuses worth retrying later (quota, transient server errors)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# How the parsed sheet is written to the DB:
+# - "replace": delete the customer's whole tree and bulk-insert it again
+# - "incremental": diff against the existing tree, keeping primary keys stable
+# - "stream": like "replace", but the sheet is fetched, parsed and written
+#   SHEET_SYNC_STREAM_CHUNK_ROWS rows at a time, for very large sheets
+SYNC_MODE_REPLACE = "replace"
+SYNC_MODE_INCREMENTAL = "incremental"
+SYNC_MODE_STREAM = "stream"
+SYNC_MODES = (SYNC_MODE_REPLACE, SYNC_MODE_INCREMENTAL, SYNC_MODE_STREAM)
+
+
+def _grid_to_values(row_data):
     """
-    Fetches data from the customer's Google Sheet (starting from row 3),
-    processes it based on fixed column order, and updates related models.
+    Converts spreadsheets.get rowData into the padded list of lists that
+    Worksheet.get_values() returns: formatted values, trailing empty rows
+    dropped and every row padded with "" to the widest non-empty row.
     """
-    with transaction.atomic():
-        try:
-            # Step 1: Setup Google Sheets client (Unchanged)
-            scopes = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-            creds = Credentials.from_service_account_file(
-                GOOGLE_SHEET_CREDENTIALS_FILE, scopes=scopes
+    rows = []
+    for row in row_data:
+        values = [cell.get("formattedValue", "") for cell in row.get("values", [])]
+        while values and values[-1] == "":
+            values.pop()
+        rows.append(values)
+    while rows and not rows[-1]:
+        rows.pop()
+    if not rows:
+        return [[]]
+    width = max(len(row) for row in rows)
+    return [row + [""] * (width - len(row)) for row in rows]
+
+
+def _fetch_worksheet_metadata(client, sheet_id, worksheet_name, fields, grid_data):
+    """
+    One field-masked spreadsheets.get call restricted to `worksheet_name`,
+    made through the shared Sheets rate limiter. Returns (metadata, waited).
+    """
+    try:
+        return sheets_rate_limiter.call(
+            client.http_client.fetch_sheet_metadata,
+            sheet_id,
+            params={
+                "includeGridData": "true" if grid_data else "false",
+                "ranges": worksheet_name,
+                "fields": fields,
+            },
+        )
+    except gspread.exceptions.APIError as e:
+        # An unknown sheet name in `ranges` comes back as a 400 parse error
+        if e.response.status_code == 400 and "Unable to parse range" in str(e):
+            raise gspread.exceptions.WorksheetNotFound(worksheet_name) from e
+        if e.response.status_code == 404:
+            raise gspread.exceptions.SpreadsheetNotFound(sheet_id) from e
+        raise
+
+
+def fetch_sheet_values(client, sheet_id, worksheet_name=DETAIL_WORKSHEET):
+    """
+    Fetches the spreadsheet title and the values of `worksheet_name` with a
+    single field-masked spreadsheets.get request (instead of open_by_key +
+    worksheet() + get_values()). The call goes through the shared Sheets
+    rate limiter. Returns (spreadsheet_title, all_values, seconds_waited).
+    """
+    metadata, waited = _fetch_worksheet_metadata(
+        client, sheet_id, worksheet_name, SHEET_FETCH_FIELDS, grid_data=True
+    )
+    sheets = metadata.get("sheets", [])
+    grid_data = sheets[0].get("data", []) if sheets else []
+    row_data = grid_data[0].get("rowData", []) if grid_data else []
+    return metadata["properties"]["title"], _grid_to_values(row_data), waited
+
+
+def fetch_sheet_layout(client, sheet_id, worksheet_name=DETAIL_WORKSHEET):
+    """
+    Fetches the spreadsheet title and the row count of `worksheet_name`
+    without any cell data. Returns (spreadsheet_title, row_count, seconds_waited).
+    """
+    metadata, waited = _fetch_worksheet_metadata(
+        client, sheet_id, worksheet_name, SHEET_LAYOUT_FIELDS, grid_data=False
+    )
+    sheets = metadata.get("sheets", [])
+    grid = sheets[0]["properties"].get("gridProperties", {}) if sheets else {}
+    return metadata["properties"]["title"], grid.get("rowCount", 0), waited
+
+
+def iter_sheet_chunks(
+    client, sheet_id, row_count, chunk_rows, worksheet_name=DETAIL_WORKSHEET
+):
+    """
+    Yields (first_row_number, rows, seconds_waited) for columns A-E of the
+    worksheet, `chunk_rows` rows per values.get call (A1:E2000,
+    A2001:E4000, ...). A chunk is only requested once the previous one has
+    been consumed. Rows the API leaves out (trailing empty ones) are yielded
+    as [] so every chunk has its full length.
+    """
+    for start in range(1, row_count + 1, chunk_rows):
+        end = min(start + chunk_rows - 1, row_count)
+        cell_range = f"'{worksheet_name}'!A{start}:{DETAIL_LAST_COLUMN}{end}"
+        response, waited = sheets_rate_limiter.call(
+            client.http_client.values_get, sheet_id, cell_range
+        )
+        rows = response.get("values", [])
+        rows += [[] for _ in range(end - start + 1 - len(rows))]
+        yield start, rows, waited
+
+
+class SheetHasher:
+    """
+    Incremental SHA-256 of the sheet values a sync uses: columns A-E of each
+    row, trailing empty cells and trailing empty rows left out, so a sheet
+    hashes the same whether it was fetched whole or in chunks.
+    """
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+        self._pending_empty_rows = 0
+
+    def update(self, row):
+        row = list(row[:DETAIL_COLUMN_COUNT])
+        while row and row[-1] == "":
+            row.pop()
+        if not row:
+            # Only hashed if a non-empty row follows
+            self._pending_empty_rows += 1
+            return
+        self._digest.update(b"[]\n" * self._pending_empty_rows)
+        self._pending_empty_rows = 0
+        self._digest.update(json.dumps(row, ensure_ascii=False).encode("utf-8"))
+        self._digest.update(b"\n")
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+def compute_sheet_hash(all_values):
+    """Stable SHA-256 of the fetched sheet values (header rows included)."""
+    hasher = SheetHasher()
+    for row in all_values:
+        hasher.update(row)
+    return hasher.hexdigest()
+
+
+def _bulk_create_tree(customer, structured_data, version):
+    """
+    Writes the nested title -> demand -> patient type -> actions mapping under
+    tree `version`, with one bulk_create per level, so the number of INSERTs
+    depends on the batch size rather than on the number of rows in the sheet.
+    Every node gets its position in the sheet among its siblings.
+    Relies on bulk_create setting primary keys (PostgreSQL, SQLite >= 3.35).
+    """
+    demand_titles = DemandTitle.objects.bulk_create(
+        [
+            DemandTitle(customer=customer, title=title, version=version, position=i)
+            for i, title in enumerate(structured_data)
+        ],
+        batch_size=BULK_CREATE_BATCH_SIZE,
+    )
+
+    demands = []
+    demand_children = []
+    for dt, demands_data in zip(demand_titles, structured_data.values()):
+        for i, (demand_name, patient_types_data) in enumerate(demands_data.items()):
+            demands.append(Demand(demand_title=dt, name=demand_name, position=i))
+            demand_children.append(patient_types_data)
+    Demand.objects.bulk_create(demands, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    patient_types = []
+    patient_type_children = []
+    for d, patient_types_data in zip(demands, demand_children):
+        for i, (patient_type_name, actions_data) in enumerate(
+            patient_types_data.items()
+        ):
+            patient_types.append(
+                PatientType(demand=d, name=patient_type_name, position=i)
             )
-            client = gspread.authorize(creds)
-            print("✅ Google Sheets client authorized.")
-
-            # Step 2: Open the sheet and get the worksheet (Unchanged)
-            print(f"📄 Original sheet URL: {customer.sheet_url}")
-            sheet_id = customer.sheet_url.split("/d/")[1].split("/")[0]
-            print(f"🔑 Extracted Sheet ID: {sheet_id}")
-            sheet = client.open_by_key(sheet_id)
-            worksheet = sheet.worksheet("detail")  # Make sure worksheet name is correct
-            print(f"📖 Worksheet '{worksheet.title}' accessed.")
-
-            # Step 3: Get spreadsheet title and save to customer (Unchanged)
-            spreadsheet_title = sheet.title
-
-            sanitized_title = re.sub(r"-\d+$", "", spreadsheet_title)
-
-            customer.filetitle = sanitized_title
-
-            if created:
-                customer.save(
-                    update_fields=["filetitle"]
-                )  # uncomment to update sheetname in each refresh
-            print(f"💾 Customer filetitle updated to: {sanitized_title}")
-
-            # --- MODIFIED DATA READING ---
-            print(f"📊 Attempting to fetch all values from worksheet...")
-            # Step 4: Read all rows as lists using get_values()
-            all_values = worksheet.get_values()
-            first_row = all_values[0]
-            customer_name, customer_address, note1, note2, note3 = first_row[0:5]
-            print(
-                "additional fields",
-                customer_name,
-                customer_address,
-                note1,
-                note2,
-                note3,
+            patient_type_children.append(actions_data)
+    PatientType.objects.bulk_create(patient_types, batch_size=BULK_CREATE_BATCH_SIZE)
+
+    actions = [
+        Action(
+            patient_type=pt,
+            description=action_data["description"],
+            dire_text=action_data["dire_text"],
+            position=i,
+        )
+        for pt, actions_data in zip(patient_types, patient_type_children)
+        for i, action_data in enumerate(actions_data)
+    ]
+    Action.objects.bulk_create(actions, batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def _reposition(model, moved):
+    """Saves the new position of existing nodes whose place in the sheet changed."""
+    model.objects.bulk_update(moved, ["position"], batch_size=BULK_CREATE_BATCH_SIZE)
+    return len(moved)
+
+
+def _sync_tree_incremental(customer, structured_data):
+    """
+    Applies the nested title -> demand -> patient type -> actions mapping as
+    a diff against the customer's active tree version: only new nodes are inserted,
+    only changed or moved nodes are updated and only vanished nodes are deleted,
+    so unchanged nodes keep their primary keys.
+    Titles, demands and patient types are matched on their natural keys;
+    actions (which have none) are matched by position within their patient type.
+    Returns a dict with the created/updated/deleted node counts.
+    """
+    stats = {"created": 0, "updated": 0, "deleted": 0}
+
+    # Serialize concurrent syncs of the same customer on its row lock
+    version = (
+        Customer.objects.select_for_update()
+        .filter(pk=customer.pk)
+        .values_list("active_version", flat=True)
+        .first()
+    )
+    customer.active_version = version
+    active_titles = DemandTitle.objects.filter(customer=customer, version=version)
+
+    # Level 1: demand titles, keyed by title
+    title_positions = {title: i for i, title in enumerate(structured_data)}
+    title_ids = {}
+    stale_titles = []
+    moved_titles = []
+    for pk, title, position in active_titles.values_list("id", "title", "position"):
+        if title not in title_positions:
+            stale_titles.append(pk)
+            continue
+        title_ids[title] = pk
+        if position != title_positions[title]:
+            moved_titles.append(DemandTitle(id=pk, position=title_positions[title]))
+    if stale_titles:
+        DemandTitle.objects.filter(id__in=stale_titles).delete()
+        stats["deleted"] += len(stale_titles)
+    stats["updated"] += _reposition(DemandTitle, moved_titles)
+    new_titles = DemandTitle.objects.bulk_create(
+        [
+            DemandTitle(customer=customer, title=title, version=version, position=i)
+            for title, i in title_positions.items()
+            if title not in title_ids
+        ],
+        batch_size=BULK_CREATE_BATCH_SIZE,
+    )
+    stats["created"] += len(new_titles)
+    title_ids.update((dt.title, dt.id) for dt in new_titles)
+
+    # Level 2: demands, keyed by (demand_title_id, name)
+    wanted_demands = {
+        (title_ids[title], demand_name): (i, patient_types_data)
+        for title, demands_data in structured_data.items()
+        for i, (demand_name, patient_types_data) in enumerate(demands_data.items())
+    }
+    demand_ids = {}
+    stale_demands = []
+    moved_demands = []
+    for pk, dt_id, name, position in Demand.objects.filter(
+        demand_title__in=active_titles
+    ).values_list("id", "demand_title_id", "name", "position"):
+        key = (dt_id, name)
+        if key not in wanted_demands:
+            stale_demands.append(pk)
+            continue
+        demand_ids[key] = pk
+        if position != wanted_demands[key][0]:
+            moved_demands.append(Demand(id=pk, position=wanted_demands[key][0]))
+    if stale_demands:
+        Demand.objects.filter(id__in=stale_demands).delete()
+        stats["deleted"] += len(stale_demands)
+    stats["updated"] += _reposition(Demand, moved_demands)
+    new_demands = Demand.objects.bulk_create(
+        [
+            Demand(demand_title_id=dt_id, name=name, position=i)
+            for (dt_id, name), (i, _) in wanted_demands.items()
+            if (dt_id, name) not in demand_ids
+        ],
+        batch_size=BULK_CREATE_BATCH_SIZE,
+    )
+    stats["created"] += len(new_demands)
+    demand_ids.update(((d.demand_title_id, d.name), d.id) for d in new_demands)
+
+    # Level 3: patient types, keyed by (demand_id, name)
+    wanted_patient_types = {
+        (demand_ids[demand_key], pt_name): (i, actions_data)
+        for demand_key, (_, patient_types_data) in wanted_demands.items()
+        for i, (pt_name, actions_data) in enumerate(patient_types_data.items())
+    }
+    patient_type_ids = {}
+    stale_patient_types = []
+    moved_patient_types = []
+    for pk, demand_id, name, position in PatientType.objects.filter(
+        demand__demand_title__in=active_titles
+    ).values_list("id", "demand_id", "name", "position"):
+        key = (demand_id, name)
+        if key not in wanted_patient_types:
+            stale_patient_types.append(pk)
+            continue
+        patient_type_ids[key] = pk
+        if position != wanted_patient_types[key][0]:
+            moved_patient_types.append(
+                PatientType(id=pk, position=wanted_patient_types[key][0])
             )
-            update_fields = [
-                attr
-                for attr, value in [
-                    ("name", customer_name),
-                    ("address", customer_address),
-                    ("note1", note1),
-                    ("note2", note2),
-                    ("note3", note3),
-                ]
-                if not setattr(customer, attr, value)
-            ]
-            customer.save(update_fields=update_fields)
-            # Check if sheet has data starting from row 3 (index 2)
-            if not all_values or len(all_values) < 3:
-                print("⚠️ Sheet does not contain data starting from row 3.")
-                customer.demand_titles.all().delete()
-                print("🧹 Old data deleted (sheet has less than 3 rows).")
-                return {
-                    "status": "success",
-                    "records_added": 0,
-                    "spreadsheet_title": spreadsheet_title,
-                    "message": "Sheet processed successfully (No data found starting from row 3).",
-                }
-
-            print(f"📊 Total rows fetched: {len(all_values)}")
-            # --- Start processing from the 3rd row (index 2) ---
-            data_rows = all_values[2:]
-            print(f"ℹ️ Processing {len(data_rows)} rows starting from sheet row 3.")
-
-            # --- Column Indices (Based on your confirmation) ---
-            title_idx = 0  # Column A
-            demand_idx = 1  # Column B
-            patient_type_idx = 2  # Column C
-            action_desc_idx = 3  # Column D
-            dire_text_idx = 4  # Column E
-            print(
-                f"Using column indices: Title={title_idx}, Demand={demand_idx},"
-                f" PatientType={patient_type_idx}, ActionDesc={action_desc_idx},"
-                f" DireText={dire_text_idx}"
+    if stale_patient_types:
+        PatientType.objects.filter(id__in=stale_patient_types).delete()
+        stats["deleted"] += len(stale_patient_types)
+    stats["updated"] += _reposition(PatientType, moved_patient_types)
+    new_patient_types = PatientType.objects.bulk_create(
+        [
+            PatientType(demand_id=demand_id, name=name, position=i)
+            for (demand_id, name), (i, _) in wanted_patient_types.items()
+            if (demand_id, name) not in patient_type_ids
+        ],
+        batch_size=BULK_CREATE_BATCH_SIZE,
+    )
+    stats["created"] += len(new_patient_types)
+    patient_type_ids.update(
+        ((pt.demand_id, pt.name), pt.id) for pt in new_patient_types
+    )
+
+    # Level 4: actions, matched by position inside each patient type
+    existing_actions = defaultdict(list)
+    for action in (
+        Action.objects.filter(patient_type__demand__demand_title__in=active_titles)
+        .only("id", "patient_type_id", "description", "dire_text", "position")
+        .order_by("patient_type_id", "position", "id")
+    ):
+        existing_actions[action.patient_type_id].append(action)
+
+    actions_to_create = []
+    actions_to_update = []
+    stale_actions = []
+    for pt_key, (_, actions_data) in wanted_patient_types.items():
+        pt_id = patient_type_ids[pt_key]
+        current = existing_actions.get(pt_id, [])
+        for position, action_data in enumerate(actions_data):
+            if position < len(current):
+                action = current[position]
+                if (
+                    action.description != action_data["description"]
+                    or action.dire_text != action_data["dire_text"]
+                    or action.position != position
+                ):
+                    action.description = action_data["description"]
+                    action.dire_text = action_data["dire_text"]
+                    action.position = position
+                    actions_to_update.append(action)
+            else:
+                actions_to_create.append(
+                    Action(
+                        patient_type_id=pt_id,
+                        description=action_data["description"],
+                        dire_text=action_data["dire_text"],
+                        position=position,
+                    )
+                )
+        stale_actions.extend(action.id for action in current[len(actions_data) :])
+
+    if stale_actions:
+        Action.objects.filter(id__in=stale_actions).delete()
+    Action.objects.bulk_update(
+        actions_to_update,
+        ["description", "dire_text", "position"],
+        batch_size=BULK_CREATE_BATCH_SIZE,
+    )
+    Action.objects.bulk_create(actions_to_create, batch_size=BULK_CREATE_BATCH_SIZE)
+    stats["created"] += len(actions_to_create)
+    stats["updated"] += len(actions_to_update)
+    stats["deleted"] += len(stale_actions)
+    return stats
+
+
+def _allocate_tree_version(customer):
+    """
+    Hands out the customer's next tree version number. The UPDATE locks the
+    customer row, so inside a transaction it also serializes concurrent syncs.
+    """
+    with transaction.atomic():
+        Customer.objects.filter(pk=customer.pk).update(
+            latest_version=F("latest_version") + 1
+        )
+        return (
+            Customer.objects.filter(pk=customer.pk)
+            .values_list("latest_version", flat=True)
+            .get()
+        )
+
+
+def _write_new_tree_version(customer, structured_data):
+    """
+    Writes the tree under a fresh version number, leaving the active version
+    untouched for concurrent readers. Returns the new version; the caller
+    makes it visible by saving it to customer.active_version.
+    """
+    version = _allocate_tree_version(customer)
+    _bulk_create_tree(customer, structured_data, version)
+    return version
+
+
+class _StreamingTreeWriter:
+    """
+    Writes one tree version chunk by chunk. Each chunk's new titles, demands
+    and patient types are bulk-inserted level by level, then its actions;
+    only the natural key -> id maps of the three upper levels (and how many
+    children each of their nodes has so far, for positions) are kept in
+    memory, never the actions.
+    """
+
+    def __init__(self, customer, version):
+        self.customer = customer
+        self.version = version
+        self.title_ids = {}
+        self.demand_ids = {}
+        self.patient_type_ids = {}
+        # Children written so far per parent: None (the customer) for titles,
+        # ("title", id), ("demand", id) and ("patient_type", id) below
+        self.child_counts = defaultdict(int)
+
+    def _next_position(self, parent):
+        position = self.child_counts[parent]
+        self.child_counts[parent] += 1
+        return position
+
+    def write(self, entries):
+        """Writes (title, demand, patient_type, action) entries in one transaction."""
+        with transaction.atomic():
+            new_titles = DemandTitle.objects.bulk_create(
+                [
+                    DemandTitle(
+                        customer=self.customer,
+                        title=title,
+                        version=self.version,
+                        position=self._next_position(None),
+                    )
+                    for title in dict.fromkeys(e[0] for e in entries)
+                    if title not in self.title_ids
+                ],
+                batch_size=BULK_CREATE_BATCH_SIZE,
             )
+            self.title_ids.update((dt.title, dt.id) for dt in new_titles)
 
-            # Step 5: Delete old data (Unchanged)
-            customer.demand_titles.all().delete()
-            print("🧹 Old data deleted.")
+            demand_keys = dict.fromkeys((self.title_ids[e[0]], e[1]) for e in entries)
+            new_demands = Demand.objects.bulk_create(
+                [
+                    Demand(
+                        demand_title_id=dt_id,
+                        name=name,
+                        position=self._next_position(("title", dt_id)),
+                    )
+                    for dt_id, name in demand_keys
+                    if (dt_id, name) not in self.demand_ids
+                ],
+                batch_size=BULK_CREATE_BATCH_SIZE,
+            )
+            self.demand_ids.update(((d.demand_title_id, d.name), d.id) for d in new_demands)
 
-            # Step 6: Build nested data structure in memory using indices
-            structured_data = defaultdict(
-                lambda: defaultdict(lambda: defaultdict(list))
+            pt_keys = dict.fromkeys(
+                (self.demand_ids[(self.title_ids[e[0]], e[1])], e[2]) for e in entries
             )
-            processed_rows_count = 0
-            skipped_rows_count = 0
-            for row_idx, row in enumerate(data_rows):
-                sheet_row_num = row_idx + 3
-                try:
-                    # Check if row has enough columns for the first 4 essential fields
-                    min_essential_cols = patient_type_idx + 1
-                    if len(row) < min_essential_cols:
-                        # print(f"⚠️ Skipping sheet row {sheet_row_num} due to insufficient columns for essential data ({len(row)} found, {min_essential_cols} expected). Row: {row}")
-                        skipped_rows_count += 1
-                        continue
-
-                    title_name = str(row[title_idx]).strip()
-                    demand_name = str(row[demand_idx]).strip()
-                    patient_type_name = str(row[patient_type_idx]).strip()
-                    # action_description = str(row[action_desc_idx]).strip()
-
-                    # --- NEW Condition: Skip row if any of the first 4 columns are empty ---
-                    if (
-                        not title_name or not demand_name or not patient_type_name
-                        # or not action_description
-                    ):
-                        # print(f"Skipping sheet row {sheet_row_num} due to missing data in one of the first four essential columns.")
-                        skipped_rows_count += 1
-                        continue
-
-                    if len(row) > action_desc_idx:
-                        action_description = str(row[action_desc_idx]).strip()
-
-                    # Safely get dire_text (column E), default to empty string if missing
-                    current_dire_text = ""
-                    if len(row) > dire_text_idx:
-                        current_dire_text = str(row[dire_text_idx]).strip()
-
-                    # Now, append the data. It's okay if action_description is empty.
-                    structured_data[title_name][demand_name][patient_type_name].append(
-                        {
-                            "description": action_description,
-                            "dire_text": current_dire_text,
-                        }
+            new_patient_types = PatientType.objects.bulk_create(
+                [
+                    PatientType(
+                        demand_id=demand_id,
+                        name=name,
+                        position=self._next_position(("demand", demand_id)),
                     )
-                    processed_rows_count += 1
+                    for demand_id, name in pt_keys
+                    if (demand_id, name) not in self.patient_type_ids
+                ],
+                batch_size=BULK_CREATE_BATCH_SIZE,
+            )
+            self.patient_type_ids.update(
+                ((pt.demand_id, pt.name), pt.id) for pt in new_patient_types
+            )
 
-                except (
-                    Exception
-                ) as inner_ex:  # Catch any other unexpected error for this row
-                    print(
-                        f"⚠️ Error processing sheet row {sheet_row_num}: {inner_ex}. Row data: {row}"
+            actions = []
+            for title, demand, patient_type, action_data in entries:
+                pt_id = self.patient_type_ids[
+                    (self.demand_ids[(self.title_ids[title], demand)], patient_type)
+                ]
+                actions.append(
+                    Action(
+                        patient_type_id=pt_id,
+                        description=action_data["description"],
+                        dire_text=action_data["dire_text"],
+                        position=self._next_position(("patient_type", pt_id)),
                     )
-                    skipped_rows_count += 1
-                    continue
+                )
+            Action.objects.bulk_create(actions, batch_size=BULK_CREATE_BATCH_SIZE)
+
+
+def _delete_titles_in_batches(titles, batch_size=TREE_GC_BATCH_SIZE):
+    """
+    Deletes the given demand titles and everything under them, bottom-up and
+    `batch_size` rows per statement. Returns the number of deleted rows.
+    """
+    levels = [
+        Action.objects.filter(patient_type__demand__demand_title__in=titles),
+        PatientType.objects.filter(demand__demand_title__in=titles),
+        Demand.objects.filter(demand_title__in=titles),
+        titles,
+    ]
+    deleted = 0
+    for queryset in levels:
+        while True:
+            batch = list(queryset.values_list("id", flat=True)[:batch_size])
+            if not batch:
+                break
+            deleted += queryset.model.objects.filter(id__in=batch).delete()[0]
+    return deleted
+
+
+def delete_superseded_tree_versions(did_number, batch_size=TREE_GC_BATCH_SIZE):
+    """
+    Deletes the customer's tree versions older than its active version,
+    bottom-up and `batch_size` rows per statement, so no single DELETE
+    touches a whole tree. Versions newer than the active one are left alone
+    (a sync may be writing them). Returns the number of deleted rows.
+    """
+    active_version = (
+        Customer.objects.filter(pk=did_number)
+        .values_list("active_version", flat=True)
+        .first()
+    )
+    if active_version is None:
+        return 0
+    return _delete_titles_in_batches(
+        DemandTitle.objects.filter(customer_id=did_number, version__lt=active_version),
+        batch_size,
+    )
+
+
+def fetch_customer_sheet(customer):
+    """
+    Network stage of a sync: fetches the spreadsheet title and the 'detail'
+    values for `customer`. Does not touch the database, so it can run in
+    worker threads ahead of the DB writes. Returns a dict with status
+    "fetched" (plus spreadsheet_title, all_values, quota_wait_seconds,
+    fetch_seconds and fetched_at) or the same error dict update_customer_from_sheet returns.
+    """
+    started = time.perf_counter()
+    try:
+        # Step 1: Reuse the process-wide Google Sheets client
+        client = get_sheets_client()
+
+        # Step 2: Fetch the title and the 'detail' values in one request
+        print(f"📄 Original sheet URL: {customer.sheet_url}")
+        sheet_id = sheet_id_from_url(customer.sheet_url)
+        print(f"🔑 Extracted Sheet ID: {sheet_id}")
+        print(f"📊 Fetching title and '{DETAIL_WORKSHEET}' values...")
+        spreadsheet_title, all_values, quota_wait = fetch_sheet_values(
+            client, sheet_id
+        )
+        print(
+            f"📖 Worksheet '{DETAIL_WORKSHEET}' fetched"
+            f" (waited {quota_wait:.2f}s for Sheets quota)."
+        )
+
+        return {
+            "status": "fetched",
+            "spreadsheet_title": spreadsheet_title,
+            "all_values": all_values,
+            "quota_wait_seconds": quota_wait,
+            "fetch_seconds": time.perf_counter() - started,
+            "fetched_at": timezone.now(),
+        }
+
+    except Exception as e:
+        return _sheet_error_result(
+            e,
+            "fetch_customer_sheet",
+            "Unexpected server error while fetching the sheet",
+        )
+
+
+def is_transient_error(e):
+    """
+    Whether an exception raised while syncing a sheet is worth retrying
+    later: a Google API quota or server error, or a connection problem or
+    timeout. Anything else would fail the same way again.
+    """
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(
+        e,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            ConnectionError,
+            TimeoutError,
+        ),
+    )
+
+
+def _sheet_error_result(e, where, unexpected_message):
+    """
+    Maps an exception raised while reading a customer's sheet to the error
+    dict returned by the sync functions ("retryable" marks transient ones).
+    """
+    if isinstance(e, gspread.exceptions.APIError):
+        print(f"❌ gspread API Error: {e}")
+        error_details = f"Google Sheets API error ({e.response.status_code} {e.response.reason}). Check permissions/URL or quotas."
+        try:
+            error_json = e.response.json()
+            error_message = error_json.get("error", {}).get("message", "")
+            if error_message:
+                error_details = f"Google Sheets API error: {error_message}"
+        except Exception:
+            pass
+        return {
+            "status": "error",
+            "error": error_details,
+            "retryable": is_transient_error(e),
+        }
+    if isinstance(e, gspread.exceptions.SpreadsheetNotFound):
+        print(f"❌ Spreadsheet not found for ID extracted from URL.")
+        return {"status": "error", "error": "Google Sheet not found. Check URL."}
+    if isinstance(e, gspread.exceptions.WorksheetNotFound):
+        print(f"❌ Worksheet 'detail' not found in sheet.")
+        return {"status": "error", "error": "Worksheet 'detail' not found."}
+    if isinstance(e, requests.exceptions.RequestException):
+        print(f"❌ Network error talking to Google: {e}")
+        return {
+            "status": "error",
+            "error": f"Network error while fetching the sheet: {e}",
+            "retryable": is_transient_error(e),
+        }
+    if isinstance(e, FileNotFoundError):
+        print(f"❌ Credentials file not found: {GOOGLE_SHEET_CREDENTIALS_FILE}")
+        return {"status": "error", "error": "Server config error: Credentials."}
+    print(f"❌ Unexpected Exception in {where}: {type(e).__name__} - {e}")
+    print("".join(traceback.format_exception(e)))
+    return {"status": "error", "error": f"{unexpected_message}: {str(e)}"}
+
+
+def _customer_fields_from_row(first_row):
+    """Name, address and the three notes held in row 1 (columns A-E)."""
+    first_row = list(first_row[:DETAIL_COLUMN_COUNT])
+    first_row += [""] * (DETAIL_COLUMN_COUNT - len(first_row))
+    customer_name, customer_address, note1, note2, note3 = first_row
+    print(
+        "additional fields",
+        customer_name,
+        customer_address,
+        note1,
+        note2,
+        note3,
+    )
+    return {
+        "name": customer_name,
+        "address": customer_address,
+        "note1": note1,
+        "note2": note2,
+        "note3": note3,
+    }
+
+
+def _parse_data_row(row):
+    """
+    Parses one data row (fixed column order: title, demand, patient type,
+    action description, dire text). Returns (title, demand, patient_type,
+    action) or None when one of the first three columns is empty.
+    """
+    # --- Column Indices (Based on your confirmation) ---
+    title_idx = 0  # Column A
+    demand_idx = 1  # Column B
+    patient_type_idx = 2  # Column C
+    action_desc_idx = 3  # Column D
+    dire_text_idx = 4  # Column E
+
+    # Check if row has enough columns for the first 3 essential fields
+    if len(row) < patient_type_idx + 1:
+        return None
+    title_name = str(row[title_idx]).strip()
+    demand_name = str(row[demand_idx]).strip()
+    patient_type_name = str(row[patient_type_idx]).strip()
+    if not title_name or not demand_name or not patient_type_name:
+        return None
+
+    # Action description and dire text may be empty or missing
+    action_description = ""
+    if len(row) > action_desc_idx:
+        action_description = str(row[action_desc_idx]).strip()
+    current_dire_text = ""
+    if len(row) > dire_text_idx:
+        current_dire_text = str(row[dire_text_idx]).strip()
+    return (
+        title_name,
+        demand_name,
+        patient_type_name,
+        {"description": action_description, "dire_text": current_dire_text},
+    )
+
+
+def parse_sheet_values(all_values):
+    """
+    Parse stage of a sync (no network, no DB): reads the customer's details
+    from row 1 and builds the nested title -> demand -> patient type ->
+    actions mapping from the data rows (row 3 onwards, fixed column order).
+    """
+    parsed = {
+        "customer_fields": _customer_fields_from_row(all_values[0]),
+        "has_data": True,
+        "structured_data": {},
+        "processed_rows": 0,
+        "skipped_rows": 0,
+    }
+    # Check if sheet has data starting from row 3 (index 2)
+    if not all_values or len(all_values) < 3:
+        print("⚠️ Sheet does not contain data starting from row 3.")
+        parsed["has_data"] = False
+        return parsed
+
+    print(f"📊 Total rows fetched: {len(all_values)}")
+    # --- Start processing from the 3rd row (index 2) ---
+    data_rows = all_values[2:]
+    print(f"ℹ️ Processing {len(data_rows)} rows starting from sheet row 3.")
 
+    # Build nested data structure in memory
+    structured_data = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+    processed_rows_count = 0
+    skipped_rows_count = 0
+    for row_idx, row in enumerate(data_rows):
+        sheet_row_num = row_idx + 3
+        try:
+            entry = _parse_data_row(row)
+        except Exception as inner_ex:  # Catch any unexpected error for this row
             print(
-                f"🏗️ Structured data built with defaultdict. Processed={processed_rows_count}, Skipped={skipped_rows_count}"
+                f"⚠️ Error processing sheet row {sheet_row_num}: {inner_ex}. Row data: {row}"
             )
+            entry = None
+        if entry is None:
+            skipped_rows_count += 1
+            continue
+        title_name, demand_name, patient_type_name, action_data = entry
+        structured_data[title_name][demand_name][patient_type_name].append(action_data)
+        processed_rows_count += 1
+
+    print(
+        f"🏗️ Structured data built with defaultdict. Processed={processed_rows_count}, Skipped={skipped_rows_count}"
+    )
+    parsed["structured_data"] = structured_data
+    parsed["processed_rows"] = processed_rows_count
+    parsed["skipped_rows"] = skipped_rows_count
+    return parsed
+
+
+def apply_parsed_sheet(customer, created, spreadsheet_title, sheet_hash, parsed, mode):
+    """
+    Apply stage of a sync: the only stage that writes, in one short
+    transaction (the network fetch and parsing happen before it). Any error
+    rolls the whole apply back. Returns the incremental change counts, or
+    None for a full rebuild.
+    A full rebuild writes a new tree version and flips customer.active_version
+    in the same UPDATE as the other customer fields; the superseded version
+    is deleted afterwards by delete_superseded_tree_versions_task.
+    """
+    from ..tasks import delete_superseded_tree_versions_task
+
+    with transaction.atomic():
+        # Save the spreadsheet title and the details from row 1
+        sanitized_title = re.sub(r"-\d+$", "", spreadsheet_title)
+        customer.filetitle = sanitized_title
+        print(f"💾 Customer filetitle updated to: {sanitized_title}")
+        update_fields = ["sheet_hash"]
+        if created:
+            update_fields.append("filetitle")
+        for attr, value in parsed["customer_fields"].items():
+            setattr(customer, attr, value)
+            update_fields.append(attr)
+        customer.sheet_hash = sheet_hash
 
-            # Step 7: Save to DB with full nesting (Unchanged logic)
-            for title_name_db, demands_db in structured_data.items():
-                dt = DemandTitle.objects.create(customer=customer, title=title_name_db)
-                for demand_name_db, patient_types_db in demands_db.items():
-                    d = Demand.objects.create(demand_title=dt, name=demand_name_db)
-                    for (
-                        patient_type_name_db,
-                        actions_list_of_dicts,
-                    ) in patient_types_db.items():
-                        pt = PatientType.objects.create(
-                            demand=d, name=patient_type_name_db
-                        )
-                        for action_data_dict in actions_list_of_dicts:
-                            Action.objects.create(
-                                patient_type=pt,
-                                description=action_data_dict["description"],
-                                dire_text=action_data_dict["dire_text"],
-                            )
-            print(f"💾 Database updated for customer {customer.did_number}.")
+        changes = None
+        if parsed["has_data"] and mode == SYNC_MODE_INCREMENTAL:
+            changes = _sync_tree_incremental(customer, parsed["structured_data"])
+            print(f"🔁 Tree synced incrementally: {changes}")
+        else:
+            # An empty sheet also gets a new (empty) version
+            structured_data = parsed["structured_data"] if parsed["has_data"] else {}
+            customer.active_version = _write_new_tree_version(
+                customer, structured_data
+            )
+            update_fields.append("active_version")
+            print(f"🆕 Tree written as version {customer.active_version}.")
+            did_number = customer.did_number
+            transaction.on_commit(
+                lambda: delete_superseded_tree_versions_task.delay(did_number)
+            )
+        customer.save(update_fields=update_fields)
+        search_changes = refresh_customer_search_index(customer.did_number)
+        print(f"🔎 Search index updated: {search_changes}")
+        notify_customer_changed(customer.did_number)
+        print(f"💾 Database updated for customer {customer.did_number}.")
+    return changes
 
+
+def stream_customer_from_sheet(
+    customer, created, progress=None, force=False, prechecked=False
+):
+    """
+    Streaming sync for very large sheets: fetches the 'detail' worksheet
+    SHEET_SYNC_STREAM_CHUNK_ROWS rows at a time and writes each chunk into a
+    new tree version as soon as it is parsed, so memory use does not grow
+    with the sheet. The new version is only made active once every chunk is
+    written (and is discarded if the sheet turns out unchanged or a chunk
+    fails). The rows are also stored as the customer's SheetSnapshot.
+    The sheet hash is only known once every chunk has been written, so an
+    unchanged sheet is first detected from its Drive modifiedTime (one
+    metadata call); only a sheet modified without changing its values (or
+    whose modifiedTime is unknown) is still written, then discarded. The
+    metadata call is skipped when `prechecked` is set: the caller already
+    ran select_customers_to_sync and records the modifiedTime itself.
+    Returns the same dicts as update_customer_from_sheet.
+    """
+    from ..tasks import delete_superseded_tree_versions_task
+
+    progress = progress or (lambda stage: None)
+    modified_time = None
+    if not created and not force and not prechecked:
+        _, skipped, modified_times = select_customers_to_sync([customer])
+        modified_time = modified_times[customer.did_number]
+        if skipped:
+            print(f"⏭️ Sheet not modified for customer {customer.did_number}.")
             return {
-                "status": "success",
-                "records_added": processed_rows_count,
+                "status": "unchanged",
+                "records_added": 0,
+                "spreadsheet_title": customer.filetitle,
+                "message": "Sheet not modified since last sync. Nothing to update.",
+                "quota_wait_seconds": 0.0,
+            }
+    # Recorded on success, so the next sync can skip an unmodified sheet
+    modified_fields = {"sheet_modified_time": modified_time} if modified_time else {}
+
+    version = None
+    try:
+        # Step 1: Title and row count, then the rows chunk by chunk
+        progress("fetching")
+        client = get_sheets_client()
+        sheet_id = sheet_id_from_url(customer.sheet_url)
+        spreadsheet_title, row_count, quota_wait = fetch_sheet_layout(
+            client, sheet_id
+        )
+        print(f"📊 Streaming {row_count} rows of '{DETAIL_WORKSHEET}'...")
+        version = _allocate_tree_version(customer)
+        writer = _StreamingTreeWriter(customer, version)
+        hasher = SheetHasher()
+        snapshot = SnapshotEncoder()
+        customer_fields = _customer_fields_from_row([])
+        processed_rows_count = 0
+        skipped_rows_count = 0
+        for start, rows, waited in iter_sheet_chunks(
+            client, sheet_id, row_count, settings.SHEET_SYNC_STREAM_CHUNK_ROWS
+        ):
+            quota_wait += waited
+            for row in rows:
+                hasher.update(row)
+                snapshot.add(row)
+            if start == 1:
+                # Row 1 holds the customer's details, row 2 the headers
+                customer_fields = _customer_fields_from_row(rows[0])
+                rows = rows[2:]
+                start = 3
+
+            # Step 2: Parse the chunk and write it under the new version
+            entries = []
+            for row in rows:
+                entry = _parse_data_row(row)
+                if entry is None:
+                    skipped_rows_count += 1
+                else:
+                    entries.append(entry)
+            progress(f"writing rows {start}-{start + len(rows) - 1}")
+            writer.write(entries)
+            processed_rows_count += len(entries)
+        print(
+            f"🏗️ Tree version {version} streamed. Processed={processed_rows_count}, Skipped={skipped_rows_count}"
+        )
+        sheet_hash = hasher.hexdigest()
+        save_sheet_snapshot(
+            customer,
+            spreadsheet_title,
+            snapshot.finish(),
+            snapshot.row_count,
+            timezone.now(),
+        )
+    except Exception as e:
+        if version is not None:
+            _delete_titles_in_batches(
+                DemandTitle.objects.filter(customer=customer, version=version)
+            )
+        return _sheet_error_result(
+            e,
+            "stream_customer_from_sheet",
+            "Unexpected server error during sheet processing",
+        )
+
+    if not created and not force and customer.sheet_hash == sheet_hash:
+        print(f"⏭️ Sheet unchanged for customer {customer.did_number}.")
+        _delete_titles_in_batches(
+            DemandTitle.objects.filter(customer=customer, version=version)
+        )
+        if modified_fields:
+            Customer.objects.filter(pk=customer.pk).update(**modified_fields)
+        return {
+            "status": "unchanged",
+            "records_added": 0,
+            "spreadsheet_title": spreadsheet_title,
+            "message": "Sheet unchanged since last sync. Nothing to update.",
+            "quota_wait_seconds": quota_wait,
+        }
+
+    # Step 3: Make the new version active, unless a newer sync already did
+    fields = dict(
+        customer_fields,
+        sheet_hash=sheet_hash,
+        active_version=version,
+        **modified_fields,
+    )
+    customer.filetitle = re.sub(r"-\d+$", "", spreadsheet_title)
+    if created:
+        fields["filetitle"] = customer.filetitle
+    flipped = Customer.objects.filter(
+        pk=customer.pk, active_version__lt=version
+    ).update(**fields)
+    did_number = customer.did_number
+    transaction.on_commit(lambda: delete_superseded_tree_versions_task.delay(did_number))
+    if not flipped:
+        print(f"⏭️ A newer sync of customer {did_number} finished first.")
+        return {
+            "status": "unchanged",
+            "records_added": 0,
+            "spreadsheet_title": spreadsheet_title,
+            "message": "A newer sync of this sheet finished first.",
+            "quota_wait_seconds": quota_wait,
+        }
+    for attr, value in fields.items():
+        setattr(customer, attr, value)
+    notify_customer_changed(did_number)
+    search_changes = refresh_customer_search_index(did_number)
+    print(f"🔎 Search index updated: {search_changes}")
+    print(f"💾 Database updated for customer {did_number} (version {version}).")
+    return {
+        "status": "success",
+        "records_added": processed_rows_count,
+        "spreadsheet_title": spreadsheet_title,
+        "message": f"Sheet processed successfully. Processed {processed_rows_count} data rows.",
+        "sync_mode": SYNC_MODE_STREAM,
+        "changes": None,
+        "quota_wait_seconds": quota_wait,
+    }
+
+
+def update_customer_from_sheet(
+    customer,
+    created,
+    mode=None,
+    fetched=None,
+    progress=None,
+    force=False,
+    prechecked=False,
+):
+    """
+    Fetches data from the customer's Google Sheet (starting from row 3),
+    processes it based on fixed column order, and updates related models.
+    Runs as three stages: fetch_customer_sheet (network, no DB),
+    parse_sheet_values (CPU only) and apply_parsed_sheet (the only stage
+    holding a transaction and row locks).
+    `mode` is one of SYNC_MODES and defaults to settings.SHEET_SYNC_MODE.
+    `fetched` is an optional result of fetch_customer_sheet() obtained
+    beforehand (e.g. by a concurrent prefetcher); no network call is made then.
+    In "stream" mode the work is done by stream_customer_from_sheet, unless
+    the sheet was prefetched (it is then written like in "replace" mode).
+    The fetched values are stored as the customer's SheetSnapshot; a
+    `fetched` dict built from a snapshot (see load_snapshot_as_fetched) is
+    not stored again. `force` rewrites the tree even if the sheet is unchanged.
+    `prechecked` tells the stream mode that the caller already checked the
+    sheet's Drive modifiedTime (see stream_customer_from_sheet).
+    `progress` is an optional callable, called with the name of each stage
+    ("fetching", "parsing", "writing") as the sync reaches it.
+    """
+    progress = progress or (lambda stage: None)
+    mode = mode or getattr(settings, "SHEET_SYNC_MODE", SYNC_MODE_REPLACE)
+    if mode not in SYNC_MODES:
+        raise ValueError(f"Unknown sheet sync mode: {mode!r}")
+    if mode == SYNC_MODE_STREAM and fetched is None:
+        return stream_customer_from_sheet(
+            customer, created, progress, force, prechecked
+        )
+
+    try:
+        # Stage 1: Fetch the sheet unless the caller already prefetched it
+        if fetched is None:
+            progress("fetching")
+            fetched = fetch_customer_sheet(customer)
+        if fetched["status"] == "error":
+            return fetched
+        spreadsheet_title = fetched["spreadsheet_title"]
+        all_values = fetched["all_values"]
+        quota_wait = fetched["quota_wait_seconds"]
+
+        fetched_at = fetched.get("fetched_at") or timezone.now()
+        from_snapshot = fetched.get("from_snapshot", False)
+
+        # Skip the rebuild entirely when the sheet has not changed
+        sheet_hash = compute_sheet_hash(all_values)
+        if not created and not force and customer.sheet_hash == sheet_hash:
+            print(f"⏭️ Sheet unchanged for customer {customer.did_number}.")
+            if not from_snapshot:
+                touch_sheet_snapshot(
+                    customer, spreadsheet_title, all_values, fetched_at
+                )
+            return {
+                "status": "unchanged",
+                "records_added": 0,
                 "spreadsheet_title": spreadsheet_title,
-                "message": f"Sheet processed successfully. Processed {processed_rows_count} data rows.",
+                "message": "Sheet unchanged since last sync. Nothing to update.",
+                "quota_wait_seconds": quota_wait,
             }
 
-        # --- Enhanced Error Handling (Keep as is) ---
-        # Exception handling (keep enhanced version)
-        except gspread.exceptions.APIError as e:
-            print(f"❌ gspread API Error: {e}")
-            error_details = f"Google Sheets API error ({e.response.status_code} {e.response.reason}). Check permissions/URL or quotas."
-            try:
-                error_json = e.response.json()
-                error_message = error_json.get("error", {}).get("message", "")
-                if error_message:
-                    error_details = f"Google Sheets API error: {error_message}"
-            except Exception:
-                pass
-            return {"status": "error", "error": error_details}
-        except gspread.exceptions.SpreadsheetNotFound:
-            print(f"❌ Spreadsheet not found for ID extracted from URL.")
-            return {"status": "error", "error": "Google Sheet not found. Check URL."}
-        except gspread.exceptions.WorksheetNotFound:
-            print(f"❌ Worksheet 'detail' not found in sheet.")
-            return {"status": "error", "error": "Worksheet 'detail' not found."}
-        except FileNotFoundError:
-            print(f"❌ Credentials file not found: {GOOGLE_SHEET_CREDENTIALS_FILE}")
-            return {"status": "error", "error": "Server config error: Credentials."}
-        except Exception as e:
-            print(
-                f"❌ Unexpected Exception in update_customer_from_sheet: {type(e).__name__} - {e}"
+        # Stage 2: Parse the rows into the nested structure
+        progress("parsing")
+        parsed = parse_sheet_values(all_values)
+
+        # Stage 3: Save to DB with full nesting (full rebuild or diff)
+        progress("writing")
+        changes = apply_parsed_sheet(
+            customer, created, spreadsheet_title, sheet_hash, parsed, mode
+        )
+        if not from_snapshot:
+            save_sheet_snapshot(
+                customer,
+                spreadsheet_title,
+                encode_sheet_values(all_values),
+                len(all_values),
+                fetched_at,
             )
-            print(traceback.format_exc())
+
+        if not parsed["has_data"]:
             return {
-                "status": "error",
-                "error": f"Unexpected server error during sheet processing: {str(e)}",
+                "status": "success",
+                "records_added": 0,
+                "spreadsheet_title": spreadsheet_title,
+                "message": "Sheet processed successfully (No data found starting from row 3).",
+                "quota_wait_seconds": quota_wait,
             }
+        processed_rows_count = parsed["processed_rows"]
+        return {
+            "status": "success",
+            "records_added": processed_rows_count,
+            "spreadsheet_title": spreadsheet_title,
+            "message": f"Sheet processed successfully. Processed {processed_rows_count} data rows.",
+            "sync_mode": mode,
+            "changes": changes,
+            "quota_wait_seconds": quota_wait,
+        }
+
+    except Exception as e:
+        print(
+            f"❌ Unexpected Exception in update_customer_from_sheet: {type(e).__name__} - {e}"
+        )
+        print(traceback.format_exc())
+        return {
+            "status": "error",
+            "error": f"Unexpected server error during sheet processing: {str(e)}",
+        }
@@ -0,0 +1,88 @@
+# actionapi/utils/snapshots.py
+import json
+import zlib
+
+from ..models import SheetSnapshot
+
+
+class SnapshotEncoder:
+    """
+    Compresses sheet rows into a SheetSnapshot blob (zlib-compressed JSON
+    lines). Rows can be added one at a time, so a streaming sync never holds
+    more than the compressed bytes.
+    """
+
+    def __init__(self):
+        self._compressor = zlib.compressobj()
+        self._chunks = []
+        self.row_count = 0
+
+    def add(self, row):
+        line = json.dumps(row, ensure_ascii=False).encode("utf-8") + b"\n"
+        self._chunks.append(self._compressor.compress(line))
+        self.row_count += 1
+
+    def finish(self):
+        self._chunks.append(self._compressor.flush())
+        return b"".join(self._chunks)
+
+
+def encode_sheet_values(all_values):
+    """Compresses a whole list of rows into a snapshot blob."""
+    encoder = SnapshotEncoder()
+    for row in all_values:
+        encoder.add(row)
+    return encoder.finish()
+
+
+def decode_sheet_values(data):
+    """Inverse of encode_sheet_values: returns the list of rows."""
+    text = zlib.decompress(bytes(data)).decode("utf-8")
+    return [json.loads(line) for line in text.splitlines()]
+
+
+def save_sheet_snapshot(customer, spreadsheet_title, data, row_count, fetched_at):
+    """Stores (or replaces) the customer's snapshot."""
+    SheetSnapshot.objects.update_or_create(
+        customer=customer,
+        defaults={
+            "spreadsheet_title": spreadsheet_title,
+            "data": data,
+            "row_count": row_count,
+            "fetched_at": fetched_at,
+        },
+    )
+
+
+def touch_sheet_snapshot(customer, spreadsheet_title, all_values, fetched_at):
+    """
+    Records that the sheet was fetched again without changes: only the
+    timestamp is updated, unless the customer has no snapshot yet.
+    """
+    touched = SheetSnapshot.objects.filter(customer=customer).update(
+        fetched_at=fetched_at
+    )
+    if not touched:
+        save_sheet_snapshot(
+            customer,
+            spreadsheet_title,
+            encode_sheet_values(all_values),
+            len(all_values),
+            fetched_at,
+        )
+
+
+def load_snapshot_as_fetched(snapshot):
+    """
+    Turns a snapshot into the dict fetch_customer_sheet returns, so it can be
+    passed to update_customer_from_sheet(fetched=...) instead of a fetch.
+    """
+    return {
+        "status": "fetched",
+        "spreadsheet_title": snapshot.spreadsheet_title,
+        "all_values": decode_sheet_values(snapshot.data),
+        "quota_wait_seconds": 0.0,
+        "fetch_seconds": 0.0,
+        "fetched_at": snapshot.fetched_at,
+        "from_snapshot": True,
+    }
@@ -0,0 +1,111 @@
+# actionapi/utils/sync_debounce.py
+import time
+import uuid
+
+import redis
+from django.conf import settings
+
+# Per customer, two Redis keys coalesce bursts of sheet edits into one sync:
+# - the "dirty" key holds the time of the latest edit notification;
+# - the "scheduled" key exists while a debounced sync task is pending and
+#   holds that task's token, so a task can tell whether it still owns it.
+DIRTY_KEY = "sheet-sync:dirty:{did_number}"
+SCHEDULED_KEY = "sheet-sync:scheduled:{did_number}"
+
+# KEYS[1] = scheduled key; ARGV = token, TTL. Keeps the key alive for the
+# task holding it (taking it back if it expired meanwhile); returns 0 if
+# another task holds it.
+_KEEP_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current == false then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+elseif current == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# KEYS[1] = scheduled key; ARGV[1] = token. Deletes the key if the task
+# holds it (or if it expired); returns 0 if another task holds it.
+_RELEASE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current == false then
+    return 1
+elseif current == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+"""
+
+_redis = None
+
+
+def _client():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.SHEET_SYNC_REDIS_URL)
+    return _redis
+
+
+def _scheduled_ttl():
+    # The TTL frees the slot if the scheduled task is ever lost
+    return settings.SHEET_EDIT_QUIET_SECONDS * 10
+
+
+def mark_customer_dirty(did_number):
+    """
+    Records that the customer's sheet was just edited. Returns a token when
+    no debounced sync is pending yet, i.e. the caller must schedule one and
+    pass it the token; returns None otherwise.
+    Raises redis.RedisError if Redis is unreachable.
+    """
+    client = _client()
+    ttl = _scheduled_ttl()
+    client.set(DIRTY_KEY.format(did_number=did_number), time.time(), ex=ttl)
+    token = uuid.uuid4().hex
+    if client.set(SCHEDULED_KEY.format(did_number=did_number), token, nx=True, ex=ttl):
+        return token
+    return None
+
+
+def quiet_time_remaining(did_number):
+    """Seconds until the customer's sheet has been quiet for long enough."""
+    last_edit = _client().get(DIRTY_KEY.format(did_number=did_number))
+    if last_edit is None:
+        return 0.0
+    elapsed = time.time() - float(last_edit)
+    return max(0.0, settings.SHEET_EDIT_QUIET_SECONDS - elapsed)
+
+
+def keep_customer_scheduled(did_number, token):
+    """
+    Called when the debounced sync reschedules itself: refreshes the TTL of
+    the scheduled key, so that a long burst of edits cannot outlive it and
+    let a second task be scheduled. Returns False if another task owns it.
+    """
+    client = _client()
+    return bool(
+        client.eval(
+            _KEEP_SCRIPT,
+            1,
+            SCHEDULED_KEY.format(did_number=did_number),
+            token,
+            _scheduled_ttl(),
+        )
+    )
+
+
+def release_customer(did_number, token):
+    """
+    Called right before the debounced sync fetches the sheet: edits made from
+    now on may not be covered by that fetch, so they must schedule a new sync.
+    Returns False if another task owns the customer, which then syncs instead.
+    """
+    return bool(
+        _client().eval(
+            _RELEASE_SCRIPT, 1, SCHEDULED_KEY.format(did_number=did_number), token
+        )
+    )
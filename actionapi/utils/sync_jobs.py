@@ -0,0 +1,65 @@
+# actionapi/utils/sync_jobs.py
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from ..models import SheetSyncJob
+from ..tasks import run_sheet_sync_job_task
+
+logger = logging.getLogger(__name__)
+
+
+def _fail_job(jobs, error):
+    """Marks the still-queued ones among `jobs` failed; returns how many."""
+    return jobs.filter(status=SheetSyncJob.STATUS_QUEUED).update(
+        status=SheetSyncJob.STATUS_FAILED,
+        progress="done",
+        result={"status": "error", "error": error},
+    )
+
+
+def enqueue_sheet_sync_job(customer, created=False):
+    """
+    Returns the customer's queued SheetSyncJob, creating it (and dispatching
+    run_sheet_sync_job_task once the transaction commits) if there is none.
+    Concurrent requests for the same customer attach to the same job.
+    A job queued for longer than settings.SHEET_SYNC_JOB_STALE_SECONDS is
+    taken as lost and marked failed first, so it cannot hold the slot.
+    Returns (job, is_new).
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.SHEET_SYNC_JOB_STALE_SECONDS)
+    if _fail_job(
+        SheetSyncJob.objects.filter(customer=customer, created_at__lt=cutoff),
+        "Sync job was never picked up by a worker.",
+    ):
+        logger.warning(f"Marked a stale queued sync job of {customer} failed.")
+
+    job = SheetSyncJob.objects.filter(
+        customer=customer, status=SheetSyncJob.STATUS_QUEUED
+    ).first()
+    if job is not None:
+        return job, False
+    try:
+        with transaction.atomic():
+            job = SheetSyncJob.objects.create(customer=customer, created=created)
+    except IntegrityError:
+        # Lost the race against another request: attach to its job
+        job = SheetSyncJob.objects.get(
+            customer=customer, status=SheetSyncJob.STATUS_QUEUED
+        )
+        return job, False
+
+    def dispatch():
+        try:
+            run_sheet_sync_job_task.delay(str(job.id))
+        except Exception as e:
+            # Nothing will ever run the job: fail it rather than leave it queued
+            logger.error(f"Failed to queue sync job {job.id}: {e}", exc_info=True)
+            _fail_job(SheetSyncJob.objects.filter(id=job.id), f"Failed to queue: {e}")
+            job.refresh_from_db()
+
+    transaction.on_commit(dispatch)
+    return job, True
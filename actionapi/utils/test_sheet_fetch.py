@@ -1,4 +1,4 @@
-from sheet_updater import update_customer_from_sheet, BASE_DIR
+from sheet_updater import update_customer_from_sheet
 
 customer = {
     "name": "2 cab",
@@ -1,16 +1,212 @@
 # actionapi/views.py
+import redis
 from django.conf import settings
-from django.db import transaction  # Import transaction
-from django.http import Http404  # Import Http404
+from django.db.models import Count, F
+from django.http import Http404, HttpResponse  # Import Http404
+from django.urls import reverse
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
+from django.utils.http import http_date
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
 # from django.db import transaction # Consider using transactions later if needed
-from .models import Customer  # Assuming models are in the same app
-from .serializers import CustomerSerializer  # Assuming serializers are in the same app
-from .tasks import update_all_customers_task
+from .models import (  # Assuming models are in the same app
+    Action,
+    Customer,
+    CustomerDocument,
+    Demand,
+    DemandTitle,
+    PatientType,
+    SheetSyncJob,
+)
+from .pagination import CustomerCursorPagination
+from .serializers import (  # Assuming serializers are in the same app
+    CustomerListSerializer,
+    CustomerSerializer,
+    SheetSyncJobSerializer,
+    customer_tree_prefetches,
+    customer_tree_representation,
+    indexed_customer_representation,
+)
+from .renderers import MessagePackRenderer
+from .tasks import debounced_sync_customer_task, update_all_customers_task
+from .signals import notify_customer_changed, notify_customer_deleted
+from .utils.change_detection import mark_customer_edited
+from .utils.local_cache import local_customer_cache
+from .utils.response_cache import CachedBody, customer_response_cache
+from .utils.search import search_customer_tree
 from .utils.sheet_updater import update_customer_from_sheet
+from .utils.sync_debounce import mark_customer_dirty
+from .utils.sync_jobs import enqueue_sheet_sync_job
+
+
+def _has_valid_api_key(request):
+    """Checks the X-API-KEY header sent by our Apps Script integrations."""
+    provided_key = request.headers.get("X-API-KEY")
+    return bool(provided_key) and provided_key == settings.APPS_SCRIPT_API_KEY
+
+
+def _wants_async(request):
+    """True when the client opted into a background sync (?async=true or "async": true)."""
+    value = request.query_params.get("async", request.data.get("async", False))
+    return str(value).lower() in ("1", "true", "yes")
+
+
+# ?layout= of the customer endpoints (see indexed_customer_representation)
+LAYOUT_NESTED = "nested"
+LAYOUT_INDEXED = "indexed"
+CUSTOMER_LAYOUTS = (LAYOUT_NESTED, LAYOUT_INDEXED)
+
+
+def _customer_layout(request):
+    layout = request.query_params.get("layout", LAYOUT_NESTED)
+    if layout not in CUSTOMER_LAYOUTS:
+        raise ValidationError(
+            {"layout": [f"Must be one of: {', '.join(CUSTOMER_LAYOUTS)}."]}
+        )
+    return layout
+
+
+# ?limit= of the customer tree search
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# ?expand= of the customer list: nested data left out of the summary
+CUSTOMER_LIST_EXPANSIONS = ("demand_titles",)
+
+
+def _customer_list_fields(request):
+    """
+    Fields of each customer in the list: the summary by default, or
+    ?fields=did_number,name,... (any field of CustomerListSerializer), plus
+    whatever ?expand= adds.
+    """
+    fields = request.query_params.get("fields")
+    if fields:
+        fields = [name.strip() for name in fields.split(",") if name.strip()]
+    else:
+        fields = list(CustomerListSerializer.summary_fields)
+    available = CustomerListSerializer(fields="__all__").fields
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        raise ValidationError({"fields": [f"Unknown fields: {', '.join(unknown)}."]})
+
+    expand = request.query_params.get("expand")
+    for name in (expand.split(",") if expand else []):
+        name = name.strip()
+        if name not in CUSTOMER_LIST_EXPANSIONS:
+            raise ValidationError(
+                {"expand": [f"Must be one of: {', '.join(CUSTOMER_LIST_EXPANSIONS)}."]}
+            )
+        if name not in fields:
+            fields.append(name)
+    return fields
+
+
+def _customer_data(request, representation):
+    """The customer representation in the layout the request asked for."""
+    if _customer_layout(request) == LAYOUT_INDEXED:
+        return indexed_customer_representation(representation)
+    return representation
+
+
+def _representation_variant(request):
+    """
+    What tells the negotiated representation apart from compact JSON in the
+    nested layout (exactly the bytes stored in CustomerDocument): "" for
+    that one, e.g. "msgpack-indexed" for others, None when the output is
+    not stable (browsable API, ?indent=).
+    """
+    renderer = request.accepted_renderer
+    if (
+        type(renderer) not in (JSONRenderer, MessagePackRenderer)
+        or "indent" in request.accepted_media_type
+    ):
+        return None
+    parts = [] if type(renderer) is JSONRenderer else [renderer.format]
+    layout = _customer_layout(request)
+    if layout != LAYOUT_NESTED:
+        parts.append(layout)
+    return "-".join(parts)
+
+
+def _current_document(did_number):
+    """The customer's materialized document as a CachedBody, unless it is stale."""
+    row = (
+        CustomerDocument.objects.filter(customer_id=did_number)
+        .values_list(
+            "body", "version", "customer__content_version", "customer__tree_updated_at"
+        )
+        .first()
+    )
+    if row is None or row[1] != row[2]:
+        return None
+    return CachedBody(row[1], int(row[3].timestamp()), bytes(row[0]))
+
+
+def _validated_response(request, version, modified, render, variant=""):
+    """
+    Answers If-None-Match / If-Modified-Since for the customer's content at
+    `version` (a 304 when the client is up to date) and only calls `render`
+    for the full response otherwise. Both carry a strong ETag (suffixed by
+    the representation variant) and Last-Modified; no-cache makes clients
+    revalidate instead of guessing.
+    """
+    etag = f'"{version}-{variant}"' if variant else f'"{version}"'
+    response = get_conditional_response(request, etag=etag, last_modified=modified)
+    if response is None:
+        response = render()
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(modified)
+    patch_cache_control(response, no_cache=True)
+    patch_vary_headers(response, ("Accept",))
+    return response
+
+
+def _tree_level_response(request, parent, customer_path, rows, not_found):
+    """
+    One level of a customer's active tree, for the drill-down endpoints.
+    `parent` filters the customer or node the level hangs from, `customer_path`
+    leads from it to the customer ("" or e.g. "customer__"). A missing parent
+    is a 404; conditional requests are answered from the customer's
+    validators before `rows` (a values() queryset) is evaluated.
+    """
+    found = parent.values_list(
+        f"{customer_path}content_version", f"{customer_path}tree_updated_at"
+    ).first()
+    if found is None:
+        return Response({"detail": not_found}, status=status.HTTP_404_NOT_FOUND)
+    version, updated_at = found
+
+    def render():
+        return Response(list(rows))
+
+    variant = _representation_variant(request)
+    if variant is None:
+        return render()
+    return _validated_response(
+        request, version, int(updated_at.timestamp()), render, variant
+    )
+
+
+def _sync_job_accepted(request, job):
+    """202 response pointing the client at the job's status endpoint."""
+    data = SheetSyncJobSerializer(job).data
+    data["status_url"] = request.build_absolute_uri(
+        reverse(
+            "customer-sync-job",
+            kwargs={"did_number": job.customer_id, "job_id": str(job.id)},
+        )
+    )
+    return Response(data, status=status.HTTP_202_ACCEPTED)
 
 
 class CustomerViewSet(viewsets.ModelViewSet):
@@ -20,9 +216,51 @@ class CustomerViewSet(viewsets.ModelViewSet):
 
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
+    renderer_classes = [
+        *api_settings.DEFAULT_RENDERER_CLASSES,
+        MessagePackRenderer,
+    ]
     lookup_field = (
         "did_number"  # <--- ADD THIS LINE: Explicitly use did_number for URL lookups
     )
+    pagination_class = CustomerCursorPagination
+
+    def get_queryset(self):
+        # retrieve reads the tree itself (customer_tree_representation), list
+        # only loads it when expanded
+        return Customer.objects.order_by("pk")
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        mark_customer_edited(serializer.instance.did_number)
+        notify_customer_changed(serializer.instance.did_number)
+
+    def perform_destroy(self, instance):
+        did_number = instance.did_number
+        super().perform_destroy(instance)
+        notify_customer_deleted(did_number)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Customer summaries (DID, name, filetitle, node counts), a page at a
+        time. ?fields= picks other fields, ?expand=demand_titles adds trees.
+        """
+        layout = _customer_layout(request)
+        fields = _customer_list_fields(request)
+        queryset = self.filter_queryset(self.get_queryset())
+        if "demand_titles" in fields:
+            # Load whole trees with one query per level, whatever their size
+            queryset = queryset.prefetch_related(*customer_tree_prefetches())
+        else:
+            queryset = queryset.only(*fields)
+
+        page = self.paginate_queryset(queryset)
+        data = CustomerListSerializer(
+            page, many=True, fields=fields, context=self.get_serializer_context()
+        ).data
+        if layout == LAYOUT_INDEXED and "demand_titles" in fields:
+            data = [indexed_customer_representation(customer) for customer in data]
+        return self.get_paginated_response(data)
 
     # Overriding retrieve to add logging and use get_object()
     def retrieve(self, request, *args, **kwargs):
@@ -47,6 +285,29 @@ class CustomerViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        # This process's cache, the shared response cache, then the
+        # materialized document (a single primary key lookup)
+        variant = _representation_variant(request)
+        if variant == "":
+            entry = local_customer_cache.get(lookup_value)
+            if entry is None:
+                generation = local_customer_cache.generation(lookup_value)
+                entry = customer_response_cache.get(lookup_value)
+                if entry is None:
+                    entry = _current_document(lookup_value)
+                    if entry is not None:
+                        customer_response_cache.set(lookup_value, entry)
+                if entry is not None:
+                    local_customer_cache.set(lookup_value, entry, generation)
+            if entry is not None:
+                print(f"Serving materialized document of customer {lookup_value}")
+                return _validated_response(
+                    request,
+                    entry.version,
+                    entry.modified,
+                    lambda: HttpResponse(entry.body, content_type="application/json"),
+                )
+
         try:
             # Use the standard get_object() method - it handles lookup based on lookup_field
             instance = self.get_object()
@@ -72,25 +333,45 @@ class CustomerViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
-        # Serialize and return the data if found
-        serializer = self.get_serializer(instance)
-        return Response(serializer.data)
+        # Serialize and return the data if found (fast read path, same
+        # output as CustomerSerializer)
+        def render():
+            return Response(
+                _customer_data(
+                    request,
+                    customer_tree_representation(
+                        instance, context=self.get_serializer_context()
+                    ),
+                )
+            )
+
+        if variant is None:
+            return render()
+        return _validated_response(
+            request,
+            instance.content_version,
+            int(instance.tree_updated_at.timestamp()),
+            render,
+            variant,
+        )
 
     @action(detail=True, methods=["post"])
-    def update_from_sheet(self, request, pk=None):
-        # Note: This action uses the default 'pk' lookup unless lookup_field is changed globally
-        # If using lookup_field='did_number', get_object() here will also use 'did_number'
+    def update_from_sheet(self, request, did_number=None):
         customer = self.get_object()  # Uses lookup_field='did_number' now
+        if _wants_async(request):
+            job, is_new = enqueue_sheet_sync_job(customer, created=False)
+            print(f"{'Queued' if is_new else 'Attached to'} sync job {job.id} for: {customer}")
+            return _sync_job_accepted(request, job)
+
         print(f"Triggering update_from_sheet for: {customer}")
         result = update_customer_from_sheet(customer, created=False)
 
-        if result.get("status") == "success":
+        if result.get("status") in ("success", "unchanged"):
             return Response(result, status=status.HTTP_200_OK)
         else:
             # Consider returning more specific error codes based on result['error'] if possible
             return Response(result, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    @transaction.atomic
     @action(detail=False, methods=["post"], url_path="create-or-update-from-sheet")
     def create_or_update_from_sheet(self, request):
         # Extract data from request
@@ -124,6 +405,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
                     # filetitle will be set later by update_customer_from_sheet if successful
                 )
                 created = True  # Set flag
+                notify_customer_changed(customer.did_number)
                 print(f"Successfully created new customer: {customer}")
             except Exception as e:
                 # Catch potential errors during creation (like duplicate DID if race condition)
@@ -140,13 +422,27 @@ class CustomerViewSet(viewsets.ModelViewSet):
                 f"Customer with DID {did_number} found. Updating name/URL if changed."
             )
             # Update fields from the request in case they changed
-            customer.name = name
-            customer.sheet_url = sheet_url
-            # Save only these potentially changed fields before triggering sheet update
-            customer.save(update_fields=["name", "sheet_url"])
+            if (customer.name, customer.sheet_url) != (name, sheet_url):
+                if customer.sheet_url != sheet_url:
+                    # A different sheet: its hash and modifiedTime are unknown
+                    mark_customer_edited(customer.did_number)
+                    customer.refresh_from_db(
+                        fields=["sheet_hash", "sheet_modified_time"]
+                    )
+                customer.name = name
+                customer.sheet_url = sheet_url
+                # Save only these changed fields before triggering sheet update
+                customer.save(update_fields=["name", "sheet_url"])
+                # Tree changes are announced by the sync itself
+                notify_customer_changed(customer.did_number)
 
         # --- Process Sheet Data (for both Created and Found customers) ---
         # Now 'customer' is guaranteed to be a valid Customer object (either found or created)
+        if _wants_async(request):
+            job, is_new = enqueue_sheet_sync_job(customer, created)
+            print(f"{'Queued' if is_new else 'Attached to'} sync job {job.id} for: {customer}")
+            return _sync_job_accepted(request, job)
+
         print(f"Proceeding to update sheet data for: {customer}")
         result = update_customer_from_sheet(
             customer, created
@@ -154,7 +450,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
         print(f"Result from update_customer_from_sheet: {result}")
 
         # --- Handle Response ---
-        if result.get("status") == "success":
+        if result.get("status") in ("success", "unchanged"):
             # Determine appropriate success message and status code
             message = (
                 "Customer created and sheet data processed successfully."
@@ -188,8 +484,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
         """
         Triggers a background Celery task to update all customers from their sheets.
         """
-        provided_key = request.headers.get("X-API-KEY")
-        if not provided_key or provided_key != settings.APPS_SCRIPT_API_KEY:
+        if not _has_valid_api_key(request):
             return Response(
                 {"error": "Unauthorized: Invalid or missing API key."},
                 status=status.HTTP_401_UNAUTHORIZED,
@@ -212,4 +507,177 @@ class CustomerViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
+    @action(detail=False, methods=["get"], url_path="cache-stats")
+    def cache_stats(self, request):
+        """Hit, miss and byte counters of the shared customer response cache."""
+        if not _has_valid_api_key(request):
+            return Response(
+                {"error": "Unauthorized: Invalid or missing API key."},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+        return Response(customer_response_cache.stats())
+
+    @action(detail=True, methods=["post"], url_path="sheet-edited")
+    def sheet_edited(self, request, did_number=None):
+        """
+        Webhook for the Apps Script onEdit trigger. Marks the customer dirty
+        and returns immediately; a debounced Celery task syncs the sheet once
+        edits have stopped for SHEET_EDIT_QUIET_SECONDS.
+        """
+        if not _has_valid_api_key(request):
+            return Response(
+                {"error": "Unauthorized: Invalid or missing API key."},
+                status=status.HTTP_401_UNAUTHORIZED,
+            )
+        if not Customer.objects.filter(did_number=did_number).exists():
+            return Response(
+                {"detail": "Customer not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        try:
+            token = mark_customer_dirty(did_number)
+            if token:
+                debounced_sync_customer_task.apply_async(
+                    (did_number, token), countdown=settings.SHEET_EDIT_QUIET_SECONDS
+                )
+        except redis.RedisError as e:
+            return Response(
+                {"error": f"Failed to record sheet edit: {str(e)}"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            )
+        return Response(
+            {"message": "Sheet edit recorded. Sync will run once edits settle."},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path=r"sync-jobs/(?P<job_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})",
+    )
+    def sync_job(self, request, did_number=None, job_id=None):
+        """
+        Status of a background sheet sync: status, current stage and, once
+        finished, the result dict of update_customer_from_sheet.
+        """
+        job = SheetSyncJob.objects.filter(customer_id=did_number, id=job_id).first()
+        if job is None:
+            return Response(
+                {"detail": "Sync job not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(SheetSyncJobSerializer(job).data)
+
+    @action(detail=True, methods=["get"])
+    def search(self, request, did_number=None):
+        """
+        Demands, patient types and actions of the customer matching ?q=, best
+        match first, each with its ancestor path. ?limit= caps the results
+        (default SEARCH_DEFAULT_LIMIT, at most SEARCH_MAX_LIMIT).
+        """
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response(
+                {"detail": "Missing search query (?q=)."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            limit = int(request.query_params.get("limit", SEARCH_DEFAULT_LIMIT))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= SEARCH_MAX_LIMIT:
+            return Response(
+                {"detail": f"limit must be between 1 and {SEARCH_MAX_LIMIT}."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if not Customer.objects.filter(pk=did_number).exists():
+            return Response(
+                {"detail": "Customer not found."}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(search_customer_tree(did_number, query, limit))
+
+    # Drill-down through the active tree, one level per request. Node IDs are
+    # stable across incremental syncs; a full rebuild gives new ones (404).
+
+    @action(detail=True, methods=["get"], url_path="demand-titles")
+    def demand_titles(self, request, did_number=None):
+        """Demand titles of the customer, each with its number of demands."""
+        return _tree_level_response(
+            request,
+            Customer.objects.filter(pk=did_number),
+            "",
+            DemandTitle.objects.filter(
+                customer_id=did_number, version=F("customer__active_version")
+            )
+            .annotate(demand_count=Count("demands"))
+            .order_by("position", "id")
+            .values("id", "title", "demand_count"),
+            "Customer not found.",
+        )
+
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path=r"demand-titles/(?P<demand_title_id>[0-9]+)/demands",
+    )
+    def demands(self, request, did_number=None, demand_title_id=None):
+        """Demands under one demand title, each with its number of patient types."""
+        return _tree_level_response(
+            request,
+            DemandTitle.objects.filter(
+                pk=demand_title_id,
+                customer_id=did_number,
+                version=F("customer__active_version"),
+            ),
+            "customer__",
+            Demand.objects.filter(demand_title_id=demand_title_id)
+            .annotate(patient_type_count=Count("patient_types"))
+            .order_by("position", "id")
+            .values("id", "name", "patient_type_count"),
+            "Demand title not found.",
+        )
+
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path=r"demands/(?P<demand_id>[0-9]+)/patient-types",
+    )
+    def patient_types(self, request, did_number=None, demand_id=None):
+        """Patient types under one demand, each with its number of actions."""
+        return _tree_level_response(
+            request,
+            Demand.objects.filter(
+                pk=demand_id,
+                demand_title__customer_id=did_number,
+                demand_title__version=F("demand_title__customer__active_version"),
+            ),
+            "demand_title__customer__",
+            PatientType.objects.filter(demand_id=demand_id)
+            .annotate(action_count=Count("actions"))
+            .order_by("position", "id")
+            .values("id", "name", "action_count"),
+            "Demand not found.",
+        )
+
+    @action(
+        detail=True,
+        methods=["get"],
+        url_path=r"patient-types/(?P<patient_type_id>[0-9]+)/actions",
+    )
+    def patient_type_actions(self, request, did_number=None, patient_type_id=None):
+        """Actions of one patient type."""
+        return _tree_level_response(
+            request,
+            PatientType.objects.filter(
+                pk=patient_type_id,
+                demand__demand_title__customer_id=did_number,
+                demand__demand_title__version=F(
+                    "demand__demand_title__customer__active_version"
+                ),
+            ),
+            "demand__demand_title__customer__",
+            Action.objects.filter(patient_type_id=patient_type_id)
+            .order_by("position", "id")
+            .values("id", "description", "dire_text"),
+            "Patient type not found.",
+        )
+
     # ... (other methods like retrieve, update_from_sheet) ...
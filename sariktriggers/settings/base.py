@@ -68,6 +68,8 @@ MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
+    # gzip, or Brotli when the client accepts it
+    "actionapi.middleware.CompressionMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -150,6 +152,64 @@ REST_FRAMEWORK = {
 CELERY_BROKER_URL = "redis://localhost:6379/0"
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
+# Needed by the chord that aggregates update_all_customers_task
+CELERY_RESULT_BACKEND = "redis://localhost:6379/0"
+CELERY_RESULT_EXPIRES = 60 * 60 * 24
+
+# update_all_customers_task fan-out: at most this many customers sync at once,
+# transient failures retry with exponential backoff (seconds).
+SHEET_SYNC_MAX_CONCURRENCY = int(os.getenv("SHEET_SYNC_MAX_CONCURRENCY", "4"))
+SHEET_SYNC_MAX_RETRIES = 5
+SHEET_SYNC_RETRY_BACKOFF = 30
+SHEET_SYNC_RETRY_BACKOFF_MAX = 600
+
+# Async sheet syncs (?async=true): a job still queued after this many seconds
+# is taken as lost (worker down, broker purged) and marked failed, so a new
+# request gets a fresh job instead of attaching to it forever.
+SHEET_SYNC_JOB_STALE_SECONDS = int(os.getenv("SHEET_SYNC_JOB_STALE_SECONDS", "600"))
+
+# Shared token bucket for Google Sheets API reads (see actionapi.utils.rate_limiter).
+# A 429 lowers the rate towards the minimum; it recovers over RECOVERY_SECONDS.
+SHEETS_RATE_LIMIT_REDIS_URL = CELERY_BROKER_URL
+SHEETS_RATE_LIMIT_PER_MINUTE = int(os.getenv("SHEETS_RATE_LIMIT_PER_MINUTE", "60"))
+SHEETS_RATE_LIMIT_MIN_PER_MINUTE = 6
+SHEETS_RATE_LIMIT_BURST = 10
+SHEETS_RATE_LIMIT_RECOVERY_SECONDS = 300
+SHEETS_RATE_LIMIT_SOCKET_TIMEOUT = 1
+
+# Where the nightly sync reads spreadsheets' Drive modifiedTime from.
+# actionapi.utils.change_detection.FakeDriveTransport works offline.
+SHEET_CHANGE_TRANSPORT = "actionapi.utils.change_detection.DriveMetadataTransport"
+
+# Push-triggered syncs: an edit notification marks the customer dirty in Redis
+# and one sync runs once the sheet has been quiet for this many seconds.
+SHEET_SYNC_REDIS_URL = CELERY_BROKER_URL
+SHEET_EDIT_QUIET_SECONDS = int(os.getenv("SHEET_EDIT_QUIET_SECONDS", "15"))
+
+# How update_customer_from_sheet writes a sheet: "incremental" diffs against
+# the existing tree (stable IDs), "replace" writes it as a new tree version,
+# "stream" does the same chunk by chunk (bounded memory for huge sheets).
+SHEET_SYNC_MODE = os.getenv("SHEET_SYNC_MODE", "incremental")
+# Rows fetched, parsed and written per step in "stream" mode
+SHEET_SYNC_STREAM_CHUNK_ROWS = int(os.getenv("SHEET_SYNC_STREAM_CHUNK_ROWS", 2000))
+
+# Shared cache of customer retrieve responses (actionapi.utils.response_cache),
+# keyed by content version. The TTL also bounds how long a version bump missed
+# while Redis was unreachable can go unnoticed.
+CUSTOMER_CACHE_ENABLED = os.getenv("CUSTOMER_CACHE_ENABLED", "true").lower() == "true"
+CUSTOMER_CACHE_REDIS_URL = os.getenv("CUSTOMER_CACHE_REDIS_URL", CELERY_BROKER_URL)
+CUSTOMER_CACHE_TTL = int(os.getenv("CUSTOMER_CACHE_TTL", 600))
+CUSTOMER_CACHE_SOCKET_TIMEOUT = 0.25
+# Per-process LRU in front of it (actionapi.utils.local_cache), evicted through
+# Redis pub/sub. Bounded by the total size of the cached bodies.
+CUSTOMER_LOCAL_CACHE_ENABLED = (
+    os.getenv("CUSTOMER_LOCAL_CACHE_ENABLED", "true").lower() == "true"
+)
+CUSTOMER_LOCAL_CACHE_MAX_BYTES = int(
+    os.getenv("CUSTOMER_LOCAL_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+CUSTOMER_LOCAL_CACHE_TTL = int(os.getenv("CUSTOMER_LOCAL_CACHE_TTL", 300))
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
@@ -7,6 +7,8 @@ MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     #"whitenoise.middleware.WhiteNoiseMiddleware",
+    # gzip, or Brotli when installed (pip install brotli)
+    "actionapi.middleware.CompressionMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",